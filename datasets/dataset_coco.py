@@ -10,6 +10,7 @@ from lib.layers import *
 import torch
 import tools.image_utils as utils
 import torch.utils.data
+from functools import partial
 from lib.workflow import SEE_ONE_EXAMPLE, EXAMPLE_COCO_IND
 
 
@@ -317,6 +318,44 @@ class Dataset(object):
             class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_mask_rle(self, image_id):
+        """Same as load_mask() but keeps the instances in RLE (and polygon) form;
+        no full-resolution mask is decoded here. See utils.minimize_mask_from_rle().
+
+        Returns:
+        rles: a list of RLEs at the original image resolution, one per instance.
+        polygons: a list of polygon lists; None if the instance is given as RLE.
+        class_ids: a 1D array of class IDs of the instances.
+        """
+        image_info = self.image_info[image_id]
+        if image_info["source"] != "coco":
+            return [], [], np.empty([0], np.int32)
+
+        height, width = image_info["height"], image_info["width"]
+        rles, polygons, class_ids = [], [], []
+        for annotation in image_info["annotations"]:
+            class_id = self.map_source_class_id(
+                "coco.{}".format(annotation['category_id']))
+            if class_id:
+                rle = self.annToRLE(annotation, height, width)
+                # Some objects are so small that they're less than 1 pixel area
+                # and end up rounded out. Skip those objects.
+                if maskUtils.area(rle) < 1:
+                    continue
+                segm = annotation['segmentation']
+                polygon = segm if isinstance(segm, list) else None
+                if annotation['iscrowd']:
+                    # Use negative class ID for crowds
+                    class_id *= -1
+                    # same as load_mask(): a crowd RLE of the wrong size covers the whole image
+                    if list(rle['size']) != [height, width]:
+                        rle = maskUtils.encode(np.ones([height, width, 1], dtype=np.uint8, order='F'))[0]
+                        polygon = None
+                rles.append(rle)
+                polygons.append(polygon)
+                class_ids.append(class_id)
+        return rles, polygons, np.array(class_ids, dtype=np.int32)
+
     # def image_reference(self, image_id):
     #     """Return a link to the image in the COCO Website."""
     #     info = self.image_info[image_id]
@@ -421,10 +460,14 @@ class COCODataset(torch.utils.data.Dataset):
             gt_boxes = gt_boxes[ids]
             gt_masks = gt_masks[:, :, ids]
 
-        image = image.astype(np.float32) - self.config.DATA.MEAN_PIXEL
-        image = torch.from_numpy(image.transpose(2, 0, 1)).float()
+        if self.config.DATA.DEVICE_NORMALIZE:
+            # uint8; cast and mean subtraction are done in MaskRCNN.forward
+            image = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        else:
+            image = image.astype(np.float32) - self.config.DATA.MEAN_PIXEL
+            image = torch.from_numpy(image.transpose(2, 0, 1)).float()
         image_metas = torch.from_numpy(image_metas)
-        gt_masks = gt_masks.astype(int).transpose(2, 0, 1)
+        gt_masks = gt_masks.astype(np.uint8).transpose(2, 0, 1)
 
         return image, gt_class_ids, gt_boxes, gt_masks, image_metas
 
@@ -432,9 +475,101 @@ class COCODataset(torch.utils.data.Dataset):
         return self.dataset.image_ids.shape[0]
 
 
-def detection_collate(batch):
+class ResumableBatchSampler(torch.utils.data.sampler.Sampler):
+    """Shuffled batches of indices, reproducible from (seed, epoch), used when images are
+    padded to a square (DATA.IMAGE_PADDING=True). set_start(n) makes the next pass skip
+    its first n batches (mid-epoch resume, see save_model); skipped images are not loaded.
+
+    Distributed (num_replicas > 1): batch_size is per process; all processes build the same
+    batch list (same seed and epoch) and take every num_replicas-th batch, truncated so that
+    every process runs the same number of iterations.
+    """
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, seed=0, num_replicas=1, rank=0):
+        self.num_images = len(dataset)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # (epoch, batches) of the last _make_batches() call; __len__ and __iter__ share it
+        self._cache = (None, None)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, num_batches):
+        self.start = num_batches
+
+    def _make_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(self.num_images) if self.shuffle else np.arange(self.num_images)
+        end = len(order) // self.batch_size * self.batch_size if self.drop_last else len(order)
+        batches = [order[i:i+self.batch_size] for i in range(0, end, self.batch_size)]
+        return self._split(batches)
+
+    def _split(self, batches):
+        if self.num_replicas > 1:
+            num_per_replica = len(batches) // self.num_replicas
+            batches = batches[self.rank::self.num_replicas][:num_per_replica]
+        return [[int(x) for x in batch] for batch in batches]
+
+    def _epoch_batches(self):
+        if self._cache[0] != self.epoch:
+            self._cache = (self.epoch, self._make_batches())
+        return self._cache[1]
+
+    def __iter__(self):
+        # the skip applies to one pass only
+        start, self.start = self.start, 0
+        return iter(self._epoch_batches()[start:])
+
+    def __len__(self):
+        return len(self._epoch_batches())
+
+
+class GroupedBatchSampler(ResumableBatchSampler):
+    """Batch sampler used when images are not padded to a square (DATA.IMAGE_PADDING=False).
+    Images of the same aspect-ratio group (landscape: w >= h, or portrait) are put in the
+    same batch so that padding each batch to its own max size wastes little.
+    Leftovers of each group are batched together at the end of the epoch.
+    Epoch, resume and distributed handling as in ResumableBatchSampler.
+    """
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, seed=0, num_replicas=1, rank=0):
+        super(GroupedBatchSampler, self).__init__(dataset, batch_size, shuffle, drop_last, seed, num_replicas, rank)
+        image_info = dataset.dataset.image_info
+        self.group_ids = np.array([0 if info['width'] >= info['height'] else 1 for info in image_info])
+
+    def _make_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.group_ids)) if self.shuffle else np.arange(len(self.group_ids))
+
+        batches, leftover = [], []
+        for group in np.unique(self.group_ids):
+            idx = order[self.group_ids[order] == group]
+            full = len(idx) // self.batch_size * self.batch_size
+            batches.extend([idx[i:i+self.batch_size] for i in range(0, full, self.batch_size)])
+            leftover.extend(idx[full:])
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if not self.drop_last:
+            batches.extend([leftover[i:i+self.batch_size] for i in range(0, len(leftover), self.batch_size)])
+        return self._split(batches)
+
+
+def detection_collate(batch, pad_value=None):
     """Custom collate function for dealing with batches of images that have a different
     number of associated object annotations (bounding boxes).
+
+    GTs are zero-padded to the max number of instances within the batch here (in the
+    worker processes) with compact types: int16 class ids and uint8 masks; they are cast
+    to float on the GPU in MaskRCNN.adjust_input_gt().
+
+    If images are of different size (DATA.IMAGE_PADDING=False), they are padded (bottom and
+    right) to the max size of the batch rounded up to 64, with pad_value per channel; full-size
+    masks (MRCNN.USE_MINI_MASK=False) are zero-padded the same way.
     """
     imgs = []
     imgs_metas = []
@@ -449,8 +584,35 @@ def detection_collate(batch):
         gt_masks.append(sample[3])
         imgs_metas.append(sample[4])
 
-    return torch.stack(imgs, 0), \
-           gt_class_ids, gt_boxes, gt_masks, \
+    gt_num = [x.shape[0] for x in gt_class_ids]
+    max_gt_num = max(gt_num)
+    bs = len(gt_class_ids)
+    h, w = utils.pad_batch_size([x.size()[1:] for x in imgs])
+    # full-size masks have the size of their image: padded with it; mini-masks are all the same size
+    full_size_mask = all(tuple(m.shape[1:]) == tuple(x.size()[1:]) for m, x in zip(gt_masks, imgs))
+    mask_h, mask_w = (h, w) if full_size_mask else gt_masks[0].shape[1:]
+
+    GT_CLS_IDS = torch.zeros(bs, max_gt_num).short()
+    GT_BOXES = torch.zeros(bs, max_gt_num, 4)
+    GT_MASKS = torch.zeros(bs, max_gt_num, mask_h, mask_w).byte()
+    for i in range(bs):
+        if gt_num[i] == 0:
+            continue
+        GT_CLS_IDS[i, :gt_num[i]] = torch.from_numpy(gt_class_ids[i].astype(np.int16))
+        GT_BOXES[i, :gt_num[i], :] = torch.from_numpy(gt_boxes[i].astype(np.float32))
+        GT_MASKS[i, :gt_num[i], :gt_masks[i].shape[1], :gt_masks[i].shape[2]] = torch.from_numpy(gt_masks[i])
+
+    if any([x.size(1) != h or x.size(2) != w for x in imgs]):
+        IMGS = imgs[0].new(bs, imgs[0].size(0), h, w)
+        for c in range(IMGS.size(1)):
+            IMGS[:, c] = 0 if pad_value is None else pad_value[c]
+        for i in range(bs):
+            IMGS[i, :, :imgs[i].size(1), :imgs[i].size(2)] = imgs[i]
+    else:
+        IMGS = torch.stack(imgs, 0)
+
+    return IMGS, \
+           GT_CLS_IDS, GT_BOXES, GT_MASKS, torch.LongTensor(gt_num), \
            torch.stack(imgs_metas, 0)
 
 
@@ -476,11 +638,27 @@ def get_data(config):
         # if QUICK_VERIFY=True, use this
         dset_train = dset_val
 
-    train_generator = None if config.CTRL.PHASE == 'inference' else \
-        torch.utils.data.DataLoader(dset_train, batch_size=config.TRAIN.BATCH_SIZE,
-                                    shuffle=True, num_workers=config.DATA.LOADER_WORKER_NUM,
-                                    collate_fn=detection_collate)
-                                    # collate_fn=detection_collate, drop_last=True, pin_memory=True)
+    # distributed: each process loads its own share of every (total) batch
+    num_replicas, rank = config.MISC.WORLD_SIZE, config.MISC.RANK
+    batch_size = config.TRAIN.BATCH_SIZE // num_replicas
+
+    if config.CTRL.PHASE == 'inference':
+        train_generator = None
+    elif config.DATA.IMAGE_PADDING:
+        train_generator = torch.utils.data.DataLoader(
+            dset_train, num_workers=config.DATA.LOADER_WORKER_NUM,
+            batch_sampler=ResumableBatchSampler(dset_train, batch_size, seed=config.MISC.SEED,
+                                                num_replicas=num_replicas, rank=rank),
+            collate_fn=detection_collate, pin_memory=True)
+    else:
+        # group by aspect ratio; each batch is padded to its own size.
+        # padded pixels hold the same value as in the square case (zero before mean subtraction)
+        pad_value = None if config.DATA.DEVICE_NORMALIZE else [-x for x in config.DATA.MEAN_PIXEL]
+        train_generator = torch.utils.data.DataLoader(
+            dset_train, num_workers=config.DATA.LOADER_WORKER_NUM,
+            batch_sampler=GroupedBatchSampler(dset_train, batch_size, seed=config.MISC.SEED,
+                                              num_replicas=num_replicas, rank=rank),
+            collate_fn=partial(detection_collate, pad_value=pad_value), pin_memory=True)
 
     return train_generator, dset_val, val_coco_api
 
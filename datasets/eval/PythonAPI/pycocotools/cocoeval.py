@@ -89,6 +89,19 @@ class COCOeval:
             for ann in anns:
                 rle = coco.annToRLE(ann)
                 ann['segmentation'] = rle
+
+        def _gtToMask(anns, coco):
+            # gt RLEs (and their tight boxes) are cached on the gt api: polygons are converted once
+            # over all evaluations of the same gt set; copies, the gt annotations are not modified
+            if not hasattr(coco, 'rleCache'):
+                coco.rleCache = {}
+            missing = [ann for ann in anns if ann['id'] not in coco.rleCache]
+            if len(missing) > 0:
+                rles = [coco.annToRLE(ann) for ann in missing]
+                for ann, rle, box in zip(missing, rles, maskUtils.toBbox(rles)):
+                    coco.rleCache[ann['id']] = (rle, box)
+            return [dict(ann, segmentation=coco.rleCache[ann['id']][0], maskBbox=coco.rleCache[ann['id']][1])
+                    for ann in anns]
         p = self.params
         if p.useCats:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
@@ -99,8 +112,12 @@ class COCOeval:
 
         # convert ground truth to mask if iouType == 'segm'
         if p.iouType == 'segm':
-            _toMask(gts, self.cocoGt)
+            gts = _gtToMask(gts, self.cocoGt)
             _toMask(dts, self.cocoDt)
+            if len(dts) > 0:
+                # tight boxes of the masks, for the pre-filter in computeIoU
+                for dt, box in zip(dts, maskUtils.toBbox([dt['segmentation'] for dt in dts])):
+                    dt['maskBbox'] = box
         # set ignore flag
         for gt in gts:
             gt['ignore'] = gt['ignore'] if 'ignore' in gt else 0
@@ -174,8 +191,7 @@ class COCOeval:
             dt=dt[0:p.maxDets[-1]]
 
         if p.iouType == 'segm':
-            g = [g['segmentation'] for g in gt]
-            d = [d['segmentation'] for d in dt]
+            return self._computeMaskIoU(dt, gt)
         elif p.iouType == 'bbox':
             g = [g['bbox'] for g in gt]
             d = [d['bbox'] for d in dt]
@@ -187,6 +203,23 @@ class COCOeval:
         ious = maskUtils.iou(d,g,iscrowd)
         return ious
 
+    def _computeMaskIoU(self, dt, gt):
+        # a mask lies in its box: the RLE iou (and the RLE decoding) is only needed for the
+        # dt and gt whose tight boxes overlap some box of the other side; the others are 0
+        if len(gt) == 0 or len(dt) == 0:
+            return []
+        iscrowd = [int(o['iscrowd']) for o in gt]
+        box_ious = maskUtils.iou(np.array([d['maskBbox'] for d in dt], dtype=np.double),
+                                 np.array([g['maskBbox'] for g in gt], dtype=np.double), iscrowd)
+        rows = np.nonzero(box_ious.max(axis=1) > 0)[0]
+        cols = np.nonzero(box_ious.max(axis=0) > 0)[0]
+        ious = np.zeros((len(dt), len(gt)))
+        if len(rows) > 0:
+            ious[np.ix_(rows, cols)] = maskUtils.iou([dt[i]['segmentation'] for i in rows],
+                                                     [gt[j]['segmentation'] for j in cols],
+                                                     [iscrowd[j] for j in cols])
+        return ious
+
     def computeOks(self, imgId, catId):
         p = self.params
         # dimention here should be Nxm
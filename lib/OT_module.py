@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
+from tools.utils import fp32_op, to_device
 EPS = 1e-20
 
 
@@ -72,7 +73,12 @@ class OptTrans(nn.Module):
                 x shape (small feature):  say 15 x 1024 x 1
                 y shape (big feature): same as 15 x 1024 x 1; it should be detached already.
         """
-        x_upsample = self.G_net(x)
+        if self.two_dim:
+            # upsample to the actual size of y (not necessarily exactly 2x of x)
+            x_upsample = self.G_net[0](x, output_size=y.size()[-2:])
+            x_upsample = self.G_net[2](self.G_net[1](x_upsample))
+        else:
+            x_upsample = self.G_net(x)
         if self.remove_bias:
             loss = self._basic_compute_loss(x_upsample, y)
         else:
@@ -102,6 +108,7 @@ class OptTrans(nn.Module):
             loss.append(self._sinkhorn_iterate(x_all[i].squeeze(dim=0), y_all[i].squeeze(dim=0)))
         return torch.stack(loss)
 
+    @fp32_op
     def _sinkhorn_iterate(self, x, y):
         sample_num = x.size(0)
         if self.C_form == 'l2':
@@ -116,8 +123,8 @@ class OptTrans(nn.Module):
 
         K = torch.exp(-self.epsilon*C)
         # Sinkhorn iterate
-        b = Variable(torch.ones(sample_num, 1)*(1./sample_num), requires_grad=True).cuda()
-        const = Variable(torch.ones(sample_num, 1)*(1./sample_num), requires_grad=False).cuda()
+        b = to_device(Variable(torch.ones(sample_num, 1)*(1./sample_num), requires_grad=True), K.is_cuda)
+        const = to_device(Variable(torch.ones(sample_num, 1)*(1./sample_num), requires_grad=False), K.is_cuda)
         for i in range(self.L):
             a = const / (torch.mm(K, b) + EPS)
             b = const / (torch.mm(K.permute(1, 0), a) + EPS)
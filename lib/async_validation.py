@@ -0,0 +1,207 @@
+"""TRAIN.ASYNC_VALIDATION: validation in a separate process, on its own gpu, while training goes on.
+
+The worker (spawned; the trainer has cuda initialized) builds its own model and minival once and
+waits for jobs:
+    - a checkpoint file (full minival); it waits for the file to be on disk, as the checkpoint
+      writer is asynchronous;
+    - a cpu state_dict (the weights every TRAIN.ASYNC_VAL_EVERY iterations), evaluated on the
+      fixed stratified subset of TRAIN.ASYNC_VAL_SUBSET images (lib/eval_subset.py); the tensors
+      go through shared memory, not the disk.
+One job is queued at most: submit(block=False) drops a job while the worker is busy. Results are
+collected with poll() and reported by the trainer (train log, visdom); the worker keeps its own
+log (async_validation_log.txt). The worker needs a visible gpu of its own, outside the training ones
+(0 .. MISC.GPU_COUNT - 1, or the MISC.WORLD_SIZE local ranks): e.g. CUDA_VISIBLE_DEVICES=0,1,2,3,4
+with --device_id=0,1,2,3 (DataParallel is given device_ids, see set_model).
+"""
+import copy
+import os
+import queue
+import time
+import traceback
+import torch
+import torch.multiprocessing as mp
+from tools.collections import AttrDict
+from tools.utils import *
+from tools.utils import _cpu_snapshot
+
+# the worker waits this long (seconds) for a checkpoint file to be written
+CKPT_WAIT = 1800
+
+
+def _config_state(config):
+    """the sections of config (class-level AttrDicts are not pickled with the instance)"""
+    return {name: copy.deepcopy(getattr(config, name)) for name in dir(config)
+            if name.isupper() and isinstance(getattr(config, name), AttrDict)}
+
+
+def _wait_for(model_file):
+    t = time.time()
+    while not os.path.exists(model_file):
+        if time.time() - t > CKPT_WAIT:
+            raise Exception('{:s} not written after {:d}s'.format(model_file, CKPT_WAIT))
+        time.sleep(1)
+
+
+def _worker(config_state, device, jobs, results):
+    # lib.workflow imports this module
+    from lib.config import Config
+    from lib.model import MaskRCNN
+    from lib.eval_subset import select_stratified_subset
+    from datasets.dataset_coco import get_data
+
+    torch.cuda.set_device(device)
+    config = Config()
+    for name, section in config_state.items():
+        setattr(config, name, section)
+    config.CTRL.PHASE = 'inference'
+    config.MISC.GPU_COUNT = 1
+    config.MISC.DISTRIBUTED = False
+    config.MISC.USE_VISDOM = False
+    config.MISC.DET_RESULT_FILE = None
+    config.TEST.SAVE_IM = False
+    config.TEST.CACHE_HEAD_OUTPUTS = False
+    # the default skips the COCO evaluation (no mAP)
+    config.TSNE.SKIP_INFERENCE = False
+    config.MISC.LOG_FILE = os.path.join(config.MISC.RESULT_FOLDER, 'async_validation_log.txt')
+
+    _, valset, coco_api = get_data(config)
+    subset = select_stratified_subset(coco_api, valset.dataset, config.TRAIN.ASYNC_VAL_SUBSET,
+                                      seed=config.MISC.SEED)
+    model = MaskRCNN(config).cuda()
+    print_log('[async validation] gpu {:d}; subset of {:d} images'.format(device, len(subset)),
+              config.MISC.LOG_FILE, init=True)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        results.put(_run_job(model, valset, coco_api, subset, job))
+
+
+def _run_job(model, valset, coco_api, subset, job):
+    """one job of _worker: the result dict, with a float mAP or the error (logged with its traceback)"""
+    from lib.workflow import test_model
+
+    config = model.config
+    result = {k: job[k] for k in ['name', 'epoch', 'iter', 'subset']}
+    t = time.time()
+    try:
+        if job['model_file'] is not None:
+            _wait_for(job['model_file'])
+            checkpoints = torch.load(job['model_file'], map_location=lambda storage, loc: storage)
+            state_dict = checkpoints['state_dict']
+        else:
+            state_dict = job['state_dict']
+        model.load_state_dict(state_dict, strict=False)
+        del state_dict, job
+        # test_model names the run after MODEL.INIT_MODEL
+        config.MODEL.INIT_MODEL = result['name']
+        image_ids = subset if result['subset'] else None
+        mAP = test_model(model, valset, coco_api, image_ids=image_ids, during_train=False, vis=None)
+        if mAP is None:
+            raise Exception('no mAP from test_model (TSNE.SKIP_INFERENCE?)')
+        result['mAP'] = float(mAP)
+        result['images'] = len(image_ids or valset.dataset.image_ids)
+    except Exception as e:
+        print_log('[async validation] {:s} failed:\n{:s}'.format(result['name'], traceback.format_exc()),
+                  config.MISC.LOG_FILE)
+        result['error'] = repr(e)
+    result['seconds'] = time.time() - t
+    return result
+
+
+def async_val_device(config):
+    """the gpu of the worker: TRAIN.ASYNC_VAL_DEVICE, or the first visible one after the training gpus
+    if < 0; raises if it is a training gpu or not visible (checked in main.py before training)"""
+    num_train = config.MISC.WORLD_SIZE if config.MISC.DISTRIBUTED else max(config.MISC.GPU_COUNT, 0)
+    device = config.TRAIN.ASYNC_VAL_DEVICE
+    if device < 0:
+        device = num_train
+    elif device < num_train:
+        raise Exception('TRAIN.ASYNC_VAL_DEVICE {:d} is a training gpu (0 - {:d})'.format(device, num_train - 1))
+    if device >= torch.cuda.device_count():
+        raise Exception('no visible gpu {:d} for TRAIN.ASYNC_VALIDATION ({:d} visible, {:d} for training); '
+                        'add one to CUDA_VISIBLE_DEVICES'.format(device, torch.cuda.device_count(), num_train))
+    return device
+
+
+class AsyncValidator(object):
+    def __init__(self, config):
+        device = async_val_device(config)
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue(maxsize=1)
+        self.results = ctx.Queue()
+        self.pending = 0
+        self.log_file = config.MISC.LOG_FILE
+        self.process = ctx.Process(target=_worker, args=(_config_state(config), device, self.jobs, self.results),
+                                   name='async_validation', daemon=True)
+        self.process.start()
+        print_log('[async validation] worker started on gpu {:d}'.format(device), self.log_file)
+
+    def busy(self):
+        return self.pending > 0
+
+    def submit(self, epoch, iter_ind, model_file=None, state_dict=None, block=True):
+        """full minival on model_file, or the stratified subset on state_dict (copied to cpu here);
+        returns False if not block and the queue is full"""
+        self._check_alive()
+        subset = model_file is None
+        if subset:
+            state_dict = _cpu_snapshot(state_dict)
+        name = 'mask_rcnn_ep_{:04d}_iter_{:06d}{:s}.pth'.format(epoch, iter_ind, '_subset' if subset else '')
+        job = {'name': name, 'epoch': epoch, 'iter': iter_ind, 'subset': subset,
+               'model_file': model_file, 'state_dict': state_dict}
+        try:
+            self.jobs.put(job, block=block)
+        except queue.Full:
+            return False
+        self.pending += 1
+        return True
+
+    def poll(self, block=False):
+        """finished jobs (dicts: name, epoch, iter, subset, mAP, images, seconds or error);
+        block: wait for all the pending ones"""
+        done = []
+        while self.pending > 0:
+            try:
+                done.append(self.results.get(block=block, timeout=10 if block else None))
+            except queue.Empty:
+                if not block:
+                    break
+                self._check_alive()
+                continue
+            self.pending -= 1
+        return done
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError('async validation worker exited (code {}); see async_validation_log.txt'.format(
+                self.process.exitcode))
+
+    def close(self):
+        """wait for the pending jobs, stop the worker; returns the results not polled yet"""
+        done = self.poll(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        return done
+
+
+_VALIDATOR = None
+
+
+def get_async_validator(config):
+    """None unless TRAIN.ASYNC_VALIDATION (main process only)"""
+    global _VALIDATOR
+    if not config.TRAIN.ASYNC_VALIDATION or not is_main_process():
+        return None
+    if _VALIDATOR is None:
+        _VALIDATOR = AsyncValidator(config)
+    return _VALIDATOR
+
+
+def close_async_validator():
+    global _VALIDATOR
+    if _VALIDATOR is None:
+        return []
+    done, _VALIDATOR = _VALIDATOR.close(), None
+    return done
@@ -58,6 +58,9 @@ class Config(object):
     MODEL.BACKBONE = 'resnet101'
     MODEL.BACKBONE_STRIDES = []
     MODEL.BACKBONE_SHAPES = []
+    # activation (gradient) checkpointing during train: trade compute for memory.
+    # any of 'C2', 'C3', 'C4', 'C5' (resnet stages), 'FPN' (top-down path) and 'MASK' (mask head)
+    MODEL.GRAD_CHECKPOINT = []
 
     # ==================================
     DATASET = AttrDict()
@@ -101,6 +104,9 @@ class Config(object):
     # memory load. Recommended when using high-resolution images.
     MRCNN.USE_MINI_MASK = True
     MRCNN.MINI_MASK_SHAPE = (56, 56)  # (height, width) of the mini-mask
+    # build boxes and mini-masks directly from the RLE/polygon annotations instead of
+    # decoding, resizing and cropping the full HxWxN mask stack (needs USE_MINI_MASK)
+    MRCNN.RLE_MASK = False
     # Pooled ROIs
     MRCNN.POOL_SIZE = 7         # cls/bbox stream
     MRCNN.MASK_POOL_SIZE = 14   # mask stream
@@ -115,10 +121,15 @@ class Config(object):
     DATA.IMAGE_MIN_DIM = 800
     DATA.IMAGE_MAX_DIM = 1024
     # If True, pad images with zeros such that they're (max_dim by max_dim)
-    DATA.IMAGE_PADDING = True  # currently, the False option is not supported
+    # If False, batches are grouped by aspect ratio (GroupedBatchSampler) and each batch
+    # is padded to its own max (h, w), rounded up to 64
+    DATA.IMAGE_PADDING = True
 
     # Image mean (RGB)
     DATA.MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
+    # if True, loaders emit uint8 images and the float cast and mean subtraction
+    # are done on gpu (MaskRCNN.mold_input); 4x less host-to-device traffic
+    DATA.DEVICE_NORMALIZE = False
 
     # Maximum number of ground truth instances to use in one image
     DATA.MAX_GT_INSTANCES = 100
@@ -158,10 +169,30 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     TEST.DET_NMS_THRESHOLD = 0.3
     TEST.SAVE_IM = False
+    # mixed precision (torch.cuda.amp.autocast, pytorch >= 1.6) for backbone, rpn and heads at inference
+    TEST.AMP = False
+    # fold BN into conv and drop SamePad2d before the 3x3 convs at inference (MaskRCNN.optimize_for_inference)
+    TEST.OPTIMIZE_FOR_INFERENCE = False
+    # save proposals, class probs and bbox deltas of each test image (lib/head_cache.py) so that the
+    # TEST.DET_* thresholds and RPN.POST_NMS_ROIS_INFERENCE can be swept without the network
+    # (tools/sweep_detection.py); probs/deltas of the CACHE_TOPK most likely classes per roi, fp16
+    TEST.CACHE_HEAD_OUTPUTS = False
+    TEST.CACHE_TOPK = 3
+    # in inference, evaluate the masks (segm mAP) as well as the boxes, from the same results; the
+    # returned/visdom mAP stays the bbox one
+    TEST.EVAL_SEGM = False
 
     # ==================================
     TRAIN = AttrDict()
     TRAIN.BATCH_SIZE = 6
+    # micro-batches (of BATCH_SIZE) per optimizer step; the effective batch size is
+    # BATCH_SIZE * ACCUM_STEPS and epochs, lr schedule and SAVE_FREQ_WITHIN_EPOCH count optimizer steps
+    TRAIN.ACCUM_STEPS = 1
+    # set BATCH_SIZE (per gpu x gpu number) to the largest that fits, see find_max_batch_size();
+    # keep AUTO_BATCH_MARGIN of the gpu memory free, search up to AUTO_BATCH_MAX per gpu
+    TRAIN.AUTO_BATCH_SIZE = False
+    TRAIN.AUTO_BATCH_MARGIN = 0.1
+    TRAIN.AUTO_BATCH_MAX = 32
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimzer implementation.
@@ -181,13 +212,33 @@ class Config(object):
 
     TRAIN.CLIP_GRAD = True
     TRAIN.MAX_GRAD_NORM = 5.0
+    # mixed precision training: autocast as in TEST.AMP plus dynamic loss scaling (GradScaler)
+    TRAIN.AMP = False
 
     # let bn learn and also apply the same weight decay when setting up optimizer
     TRAIN.BN_LEARN = False
 
     # evaluate mAP after each stage
     TRAIN.DO_VALIDATION = True
+    # checkpoints per epoch written by train_epoch; <= 0: none (train_model still saves at epoch end)
     TRAIN.SAVE_FREQ_WITHIN_EPOCH = 10
+    # checkpoints are copied to cpu and written by a background thread (ASYNC_SAVE, see CheckpointWriter);
+    # keep the last CKPT_KEEP_LAST files, the last one of every CKPT_KEEP_EVERY_EPOCH-th epoch and
+    # the best-mAP one; CKPT_KEEP_LAST <= 0 keeps all (default). Only the checkpoints written in
+    # the current run are pruned
+    TRAIN.ASYNC_SAVE = True
+    TRAIN.CKPT_KEEP_LAST = 0
+    TRAIN.CKPT_KEEP_EVERY_EPOCH = 1
+    # validation in a separate process on gpu ASYNC_VAL_DEVICE (-1: the first visible gpu not used for
+    # training; see lib/async_validation.py): the stage-end checkpoint (and any checkpoint written
+    # while the worker is idle) on the full minival, and every ASYNC_VAL_EVERY iterations (0: off)
+    # the current weights on a fixed stratified subset of ASYNC_VAL_SUBSET images (size: see
+    # tools/fast_eval.py).
+    # mAP is reported in the log and visdom
+    TRAIN.ASYNC_VALIDATION = False
+    TRAIN.ASYNC_VAL_DEVICE = -1
+    TRAIN.ASYNC_VAL_EVERY = 0
+    TRAIN.ASYNC_VAL_SUBSET = 500
     TRAIN.FORCE_START_EPOCH = 0   # when you resume training and change the batch size, this is useful
     # apply OT loss in FPN heads
     TRAIN.FPN_OT_LOSS = False
@@ -246,7 +297,12 @@ class Config(object):
     CTRL.QUICK_VERIFY = False
 
     CTRL.SHOW_INTERVAL = 50
-    CTRL.PROFILE_ANALYSIS = False  # show time for some pass
+    # time named scopes of the train step (data, forward/backbone, rpn, ..., backward, optimizer; see
+    # tools/profiler.py) over PROFILE_STEPS steps after PROFILE_WARMUP; percentiles in the log, csv and
+    # chrome trace next to the train log. Synchronizes once per step. PROFILE_STEPS -1: till the stage ends
+    CTRL.PROFILE_ANALYSIS = False
+    CTRL.PROFILE_WARMUP = 10
+    CTRL.PROFILE_STEPS = 100
 
     # ==============================
     TSNE = AttrDict()
@@ -274,6 +330,16 @@ class Config(object):
     MISC.RESULT_FOLDER = None
     MISC.DEVICE_ID = []
     MISC.GPU_COUNT = -1
+    # DistributedDataParallel training: one process per gpu, launched by torch.distributed.launch
+    # (see script/base_ddp.sh); TRAIN.BATCH_SIZE is still the total batch size over all processes.
+    # Use 'gloo' to run on cpu (with CUDA_VISIBLE_DEVICES='' on a gpu machine).
+    MISC.DISTRIBUTED = False
+    MISC.DIST_BACKEND = 'nccl'
+    MISC.DIST_URL = 'env://'
+    # the following will be set in init_distributed()
+    MISC.LOCAL_RANK = 0
+    MISC.RANK = 0
+    MISC.WORLD_SIZE = 1
 
     def display(self, log_file, quiet=False):
         """Display *final* configuration values."""
@@ -309,8 +375,8 @@ class Config(object):
         # set MISC.RESULT_FOLDER, 'results/base_101/train (or inference)/'
         self.MISC.RESULT_FOLDER = os.path.join(
             'results', self.CTRL.CONFIG_NAME.lower(), self.CTRL.PHASE)
-        if not os.path.exists(self.MISC.RESULT_FOLDER):
-            os.makedirs(self.MISC.RESULT_FOLDER)
+        # exist_ok: all processes get here at the same time in the distributed case
+        os.makedirs(self.MISC.RESULT_FOLDER, exist_ok=True)
 
         self.TEST.BATCH_SIZE = 2 * self.TRAIN.BATCH_SIZE
 
@@ -354,6 +420,11 @@ class Config(object):
             if self.TRAIN.FPN_OT_LOSS:
                 self.MISC.VIS.LOSS_LEGEND.append('fpn_ot_loss')
 
+        if self.MISC.DISTRIBUTED:
+            # gpu per process; gloo without a visible gpu is a cpu run (GPU_COUNT = 0)
+            cpu_run = self.MISC.DIST_BACKEND == 'gloo' and not torch.cuda.is_available()
+            self.MISC.GPU_COUNT = 0 if cpu_run else 1
+
         if self.MISC.GPU_COUNT == 8:
             self.DATA.LOADER_WORKER_NUM = 32
         elif self.MISC.GPU_COUNT == 4:
@@ -394,6 +465,8 @@ class CocoConfig(Config):
 
         self.MISC.DEVICE_ID = [int(x) for x in args.device_id.split(',')]
         self.MISC.GPU_COUNT = len(self.MISC.DEVICE_ID)
+        # passed by torch.distributed.launch; not present in tools/ scripts
+        self.MISC.LOCAL_RANK = getattr(args, 'local_rank', 0)
 
         _ignore_yaml = False
         # ================ (CUSTOMIZED CONFIG) =========================
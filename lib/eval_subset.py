@@ -0,0 +1,135 @@
+"""Fixed stratified subsets of minival for fast mAP estimates (TRAIN.ASYNC_VAL_EVERY).
+
+Each image is put in a stratum (rarest category in the image, dominant object size); a
+subset takes from every stratum in proportion to its size, so rare categories and the
+small/medium/large mix of the full set are kept. The selection only depends on the gt
+and the seed: subsets of the same size are the same across runs and checkpoints.
+
+Confidence intervals: ap_tables() keeps, per category, what COCOeval.accumulate() needs from
+the per-image evalImgs (area 'all', the largest maxDets); weighted_map() gives the mAP
+(AP@[.5:.95], stats[0]) of any weighting of the images, so a bootstrap resample (multinomial
+weights) or a subset of an evaluated run (0/1 weights) needs no new COCOeval.evaluate().
+See tools/fast_eval.py.
+"""
+from collections import defaultdict
+import numpy as np
+
+# COCO area ranges (pixels^2) of the small / medium / large APs
+SIZE_BUCKETS = [32 ** 2, 96 ** 2]
+
+
+def size_bucket(area):
+    """0: small, 1: medium, 2: large"""
+    return int(np.searchsorted(SIZE_BUCKETS, area, side='right'))
+
+
+def image_strata(coco_api, dataset):
+    """(rarest category id, dominant size bucket) of each image in dataset.image_ids;
+    categories are ranked by the number of images they appear in; crowds are ignored"""
+    cat_freq = {cat_id: len(set(coco_api.catToImgs[cat_id])) for cat_id in coco_api.getCatIds()}
+    strata = []
+    for ind in dataset.image_ids:
+        anns = [ann for ann in coco_api.imgToAnns[dataset.image_info[ind]['id']] if not ann['iscrowd']]
+        if len(anns) == 0:
+            strata.append((-1, -1))
+            continue
+        rarest = min(anns, key=lambda ann: (cat_freq[ann['category_id']], ann['category_id']))
+        buckets = np.bincount([size_bucket(ann['area']) for ann in anns], minlength=len(SIZE_BUCKETS) + 1)
+        strata.append((rarest['category_id'], int(buckets.argmax())))
+    return strata
+
+
+def select_stratified_subset(coco_api, dataset, num_images, seed=0):
+    """num_images of dataset.image_ids (sorted), proportionally allocated over image_strata()
+    (largest remainder) and drawn at random within each stratum"""
+    if num_images <= 0 or num_images >= len(dataset.image_ids):
+        return list(dataset.image_ids)
+    groups = defaultdict(list)
+    for ind, stratum in zip(dataset.image_ids, image_strata(coco_api, dataset)):
+        groups[stratum].append(ind)
+    keys = sorted(groups.keys())
+    quota = np.array([len(groups[k]) for k in keys], dtype=np.float64) * num_images / len(dataset.image_ids)
+    counts = np.floor(quota).astype(np.int64)
+    counts[np.argsort(counts - quota, kind='mergesort')[:num_images - counts.sum()]] += 1
+
+    rng = np.random.RandomState(seed)
+    subset = []
+    for k, n in zip(keys, counts):
+        subset.extend(rng.choice(groups[k], n, replace=False).tolist())
+    return sorted(subset)
+
+
+def ap_tables(coco_eval):
+    """per category of coco_eval (after evaluate()): the detections of all images sorted by score
+    as in accumulate() - image index [D] into params.imgIds, tp and fp [T, D] - and the number of
+    non-ignored gt per image [I]"""
+    p = coco_eval.params
+    num_im, num_area = len(p.imgIds), len(p.areaRng)
+    area_ind = p.areaRngLbl.index('all')
+    max_det = p.maxDets[-1]
+    tables = []
+    for k in range(len(p.catIds)):
+        start = (k * num_area + area_ind) * num_im
+        evals = [(i, e) for i, e in enumerate(coco_eval.evalImgs[start:start + num_im]) if e is not None]
+        if len(evals) == 0:
+            continue
+        num_gt = np.zeros(num_im)
+        images, scores, dt_matches, dt_ignore = [], [], [], []
+        for i, e in evals:
+            num_gt[i] = np.count_nonzero(e['gtIgnore'] == 0)
+            images.append(np.full(len(e['dtScores'][:max_det]), i, dtype=np.int64))
+            scores.append(np.asarray(e['dtScores'][:max_det], dtype=np.float64))
+            dt_matches.append(e['dtMatches'][:, :max_det])
+            dt_ignore.append(e['dtIgnore'][:, :max_det])
+        order = np.argsort(-np.concatenate(scores), kind='mergesort')
+        dt_matches = np.concatenate(dt_matches, axis=1)[:, order]
+        dt_ignore = np.concatenate(dt_ignore, axis=1)[:, order]
+        tables.append({
+            'image':    np.concatenate(images)[order],
+            'tp':       np.logical_and(dt_matches, np.logical_not(dt_ignore)),
+            'fp':       np.logical_and(np.logical_not(dt_matches), np.logical_not(dt_ignore)),
+            'num_gt':   num_gt,
+        })
+    return tables
+
+
+def weighted_map(tables, weights, rec_thrs):
+    """mAP as COCOeval.stats[0] with image i counted weights[i] times (all ones: the full run)"""
+    precisions = []
+    for table in tables:
+        num_pos = np.dot(weights, table['num_gt'])
+        if num_pos == 0:
+            # absent category: -1 in accumulate(), left out of the mean
+            continue
+        det_weights = weights[table['image']]
+        tp = np.cumsum(table['tp'] * det_weights, axis=1)
+        fp = np.cumsum(table['fp'] * det_weights, axis=1)
+        rc = tp / num_pos
+        # precision envelope (max to the right)
+        pr = np.maximum.accumulate((tp / (tp + fp + np.spacing(1)))[:, ::-1], axis=1)[:, ::-1]
+        for t in range(rc.shape[0]):
+            inds = np.searchsorted(rc[t], rec_thrs, side='left')
+            q = np.zeros(len(rec_thrs))
+            valid = inds < rc.shape[1]
+            q[valid] = pr[t, inds[valid]]
+            precisions.append(q)
+    return float(np.mean(precisions)) if len(precisions) > 0 else 0.
+
+
+def bootstrap_map(tables, rec_thrs, members, num_samples=200, alpha=0.05, seed=0):
+    """mAP of the images at positions members (into params.imgIds) and its (1 - alpha) percentile
+    bootstrap interval over the images: (mAP, low, high)"""
+    num_im = len(tables[0]['num_gt']) if len(tables) > 0 else 0
+    members = np.asarray(members, dtype=np.int64)
+    weights = np.zeros(num_im)
+    weights[members] = 1.
+    mAP = weighted_map(tables, weights, rec_thrs)
+
+    rng = np.random.RandomState(seed)
+    samples = []
+    for counts in rng.multinomial(len(members), np.ones(len(members)) / len(members), size=num_samples):
+        weights = np.zeros(num_im)
+        weights[members] = counts
+        samples.append(weighted_map(tables, weights, rec_thrs))
+    low, high = np.percentile(samples, [100. * alpha / 2, 100. * (1 - alpha / 2)])
+    return mAP, float(low), float(high)
@@ -0,0 +1,92 @@
+"""TorchScript / ONNX export of the static part of MaskRCNN (backbone + FPN + RPN head
+over all levels) at a fixed input shape. Proposals, detection and the mask head (numpy,
+cuda extensions, data-dependent shapes) run in python on top (ExportedMaskRCNN).
+
+    backbone = BackboneRPN(model)
+    export_torchscript(backbone, example_images, 'backbone_rpn.pt')
+    export_onnx(backbone, example_images, 'backbone_rpn.onnx')
+    runner = ExportedMaskRCNN(model, torch.jit.load('backbone_rpn.pt'))    # or OnnxBackboneRPN(...)
+    detections, mrcnn_mask = runner(molded_images, image_metas)
+
+see tools/export_model.py for the parity test and latency comparison.
+"""
+import numpy as np
+import torch
+import torch.nn as nn
+from tools.utils import *
+from lib.layers import proposal_layer
+
+OUTPUT_NAMES = ['p2', 'p3', 'p4', 'p5', 'rpn_class', 'rpn_bbox']
+
+
+class BackboneRPN(nn.Module):
+    """images [bs, 3, h, w] as given to MaskRCNN.forward (uint8 if DATA.DEVICE_NORMALIZE)
+    -> p2, p3, p4, p5, rpn_class [bs, anchors, 2], rpn_bbox [bs, anchors, 4].
+    SamePad2d sizes are traced as constants, so the export is for one input shape;
+    call model.optimize_for_inference() first to fold BN and drop most SamePad2d."""
+    def __init__(self, model):
+        super(BackboneRPN, self).__init__()
+        self.fpn = model.fpn
+        self.rpn = model.rpn
+        self.mold_input = model.mold_input
+        self.device_normalize = model.config.DATA.DEVICE_NORMALIZE
+
+    def forward(self, images):
+        if self.device_normalize:
+            images = self.mold_input(images)
+        fpn = self.fpn
+        x = fpn.C1(images)
+        c2_out = fpn.C2(x)
+        c3_out = fpn.C3(c2_out)
+        c4_out = fpn.C4(c3_out)
+        p5_out = fpn.P5_conv1(fpn.C5(c4_out))
+        p2_out, p3_out, p4_out, p5_out = fpn._top_down(c2_out, c3_out, c4_out, p5_out)
+        p6_out = fpn.P6(p5_out)
+
+        layer_outputs = [self.rpn(p) for p in [p2_out, p3_out, p4_out, p5_out, p6_out]]
+        _, rpn_class, rpn_bbox = [torch.cat(list(o), dim=1) for o in zip(*layer_outputs)]
+        return p2_out, p3_out, p4_out, p5_out, rpn_class, rpn_bbox
+
+
+def export_torchscript(backbone, example_images, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(backbone.eval(), example_images)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(backbone, example_images, path, opset_version=11):
+    with torch.no_grad():
+        torch.onnx.export(backbone.eval(), example_images, path, opset_version=opset_version,
+                          input_names=['images'], output_names=OUTPUT_NAMES)
+
+
+class OnnxBackboneRPN(object):
+    """onnxruntime session with the interface of BackboneRPN (cuda tensors in and out)."""
+    def __init__(self, path, providers=('CUDAExecutionProvider', 'CPUExecutionProvider')):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=list(providers))
+
+    def __call__(self, images):
+        images = images.data if isinstance(images, Variable) else images
+        outputs = self.session.run(OUTPUT_NAMES, {'images': images.cpu().numpy()})
+        return tuple(torch.from_numpy(np.ascontiguousarray(o)).to(images.device) for o in outputs)
+
+
+class ExportedMaskRCNN(object):
+    """Inference with an exported backbone (traced module or OnnxBackboneRPN); proposal
+    layer and MaskRCNN.detect() (classifier, detections, mask head) stay in python."""
+    def __init__(self, model, backbone):
+        self.model = model.eval()
+        self.backbone = backbone
+
+    def __call__(self, molded_images, image_metas):
+        config = self.model.config
+        image_shape = molded_images.size()[2:]
+        with torch.no_grad():
+            p2_out, p3_out, p4_out, p5_out, rpn_class, rpn_bbox = self.backbone(molded_images)
+            proposals = proposal_layer([rpn_class, rpn_bbox],
+                                       proposal_count=config.RPN.POST_NMS_ROIS_INFERENCE,
+                                       nms_threshold=config.RPN.NMS_THRESHOLD,
+                                       config=config, image_shape=image_shape)
+            return self.model.detect([p2_out, p3_out, p4_out, p5_out], proposals, image_metas, image_shape)
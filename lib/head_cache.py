@@ -0,0 +1,60 @@
+"""Per-image cache of the pre-NMS head outputs of test_model (TEST.CACHE_HEAD_OUTPUTS):
+rpn proposals, mrcnn_class probs and mrcnn_bbox deltas. replay_detections() runs only
+detection_layer on the cache, so TEST.DET_MIN_CONFIDENCE, TEST.DET_NMS_THRESHOLD,
+TEST.DET_MAX_INSTANCES and RPN.POST_NMS_ROIS_INFERENCE (up to the cached count; the
+proposals are sorted by score) can be swept without the backbone and heads.
+
+Probs and deltas are kept in fp16 for the TEST.CACHE_TOPK most likely classes per roi;
+detection_layer only uses the top class, so any topk >= 1 replays the same detections
+(up to fp16 rounding). Masks are not cached: the replay gives bbox results.
+See tools/sweep_detection.py.
+"""
+import numpy as np
+import torch
+from tools.utils import *
+
+
+def pack_head_outputs(proposals, mrcnn_class, mrcnn_bbox, topk):
+    """one image: proposals [R, 4], mrcnn_class [R, num_classes], mrcnn_bbox [R, num_classes, 4]
+    (Variables or tensors, any device) -> dict of compact cpu tensors"""
+    proposals, mrcnn_class, mrcnn_bbox = [x.data if isinstance(x, Variable) else x
+                                          for x in [proposals, mrcnn_class, mrcnn_bbox]]
+    probs, class_ids = mrcnn_class.topk(topk, dim=1)
+    deltas = mrcnn_bbox.gather(1, class_ids.unsqueeze(2).expand(class_ids.size(0), topk, 4))
+    return {'proposals': proposals.float().cpu(),
+            'class_ids': class_ids.byte().cpu(),
+            'probs': probs.half().cpu(),
+            'deltas': deltas.half().cpu()}
+
+
+def unpack_head_outputs(entry, num_classes, num_rois=None):
+    """inverse of pack_head_outputs (the classes not kept are zero) on gpu;
+    num_rois: keep the first (highest rpn score) proposals only"""
+    num_rois = num_rois or entry['proposals'].size(0)
+    if num_rois > entry['proposals'].size(0):
+        raise Exception('{:d} rois requested, {:d} cached'.format(num_rois, entry['proposals'].size(0)))
+    class_ids = entry['class_ids'][:num_rois].long().cuda()
+    probs = torch.zeros(num_rois, num_classes).cuda()
+    probs.scatter_(1, class_ids, entry['probs'][:num_rois].float().cuda())
+    deltas = torch.zeros(num_rois, num_classes, 4).cuda()
+    deltas.scatter_(1, class_ids.unsqueeze(2).expand(num_rois, class_ids.size(1), 4),
+                    entry['deltas'][:num_rois].float().cuda())
+    return entry['proposals'][:num_rois].cuda(), probs, deltas
+
+
+def replay_detections(config, cache, dataset):
+    """bbox results (COCO format, as in test_model) from the cached head outputs with the
+    current TEST.* and RPN.POST_NMS_ROIS_INFERENCE"""
+    # lib.workflow imports this module
+    from lib.layers import detection_layer
+    from lib.workflow import _bbox_results
+    results = []
+    num_classes = config.DATASET.NUM_CLASSES
+    for entry in cache['images']:
+        proposals, probs, deltas = unpack_head_outputs(entry, num_classes, config.RPN.POST_NMS_ROIS_INFERENCE)
+        windows = torch.from_numpy(np.array([entry['window']], dtype=np.float32)).cuda()
+        detections, _ = detection_layer(Variable(proposals.unsqueeze(0)), Variable(probs), Variable(deltas),
+                                        Variable(windows), config, image_shape=entry['batch_shape'])
+        results.extend(_bbox_results(detections.data.cpu().numpy()[0], entry['image_shape'], entry['window'],
+                                     entry['coco_id'], dataset))
+    return results
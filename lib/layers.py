@@ -1,9 +1,9 @@
 from lib.roi_align.crop_and_resize import CropAndResizeFunction
-from lib.roi_pooling.functions.roi_pool import RoIPoolFunction
 from lib.nms.nms_wrapper import nms
 from lib.workflow import SEE_ONE_EXAMPLE, EXAMPLE_COCO_IND
 from tools.box_utils import *
 from tools.utils import *
+from tools.profiler import PROFILER
 import torch.nn.functional as F
 
 
@@ -66,10 +66,45 @@ def generate_pyramid_priors(scales, ratios, feature_shapes, feature_strides, anc
     return np.concatenate(anchors, axis=0)
 
 
+class PriorCache(object):
+    """
+    Anchors per input resolution, generated lazily and kept on the gpu (cpu if MISC.GPU_COUNT < 1).
+    Key: (feature shapes, strides, scales, ratios, anchor stride, device).
+    """
+    def __init__(self):
+        self._cache = {}
+
+    def get(self, config, image_shape):
+        cuda = config.MISC.GPU_COUNT >= 1
+        h, w = int(image_shape[0]), int(image_shape[1])
+        strides = tuple(config.MODEL.BACKBONE_STRIDES)
+        feature_shapes = tuple((int(math.ceil(h / stride)), int(math.ceil(w / stride))) for stride in strides)
+        key = (feature_shapes, strides,
+               tuple(config.RPN.ANCHOR_SCALES), tuple(config.RPN.ANCHOR_RATIOS),
+               config.RPN.ANCHOR_STRIDE, torch.cuda.current_device() if cuda else 'cpu')
+        if key not in self._cache:
+            self._cache[key] = to_device(torch.from_numpy(
+                generate_pyramid_priors(config.RPN.ANCHOR_SCALES, config.RPN.ANCHOR_RATIOS,
+                                        np.array(feature_shapes), strides,
+                                        config.RPN.ANCHOR_STRIDE)).float(), cuda)
+        return self._cache[key]
+
+    def clear(self):
+        self._cache.clear()
+
+
+_PRIOR_CACHE = PriorCache()
+
+
+def get_priors(config, image_shape):
+    """anchors [num_anchors, (y1, x1, y2, x2)] (cuda Tensor unless MISC.GPU_COUNT < 1) for an input batch of [h, w]"""
+    return _PRIOR_CACHE.get(config, image_shape)
+
+
 ############################################################
 #  Proposal Layer
 ############################################################
-def proposal_layer(inputs, proposal_count, nms_threshold, priors, config=None):
+def proposal_layer(inputs, proposal_count, nms_threshold, config, image_shape=None):
     """Receives anchor scores and selects a subset to pass as proposals
     to the second stage. Filtering is done based on anchor scores and
     non-max suppression to remove overlaps. It also applies bounding
@@ -80,20 +115,23 @@ def proposal_layer(inputs, proposal_count, nms_threshold, priors, config=None):
             [1] rpn_bbox:   [batch, anchors, (dy, dx, log(dh), log(dw))]
         proposal_count:     maximum output
         nms_threshold:      for proposal
-        priors:             anchors
         config:             configuration
+        image_shape:        [height, width] of the input batch; DATA.IMAGE_SHAPE if not provided
+                            (anchors are taken from the prior cache for this shape)
     Returns:
         Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
     """
-    anchors = Variable(priors.cuda(), requires_grad=False)
+    image_shape = config.DATA.IMAGE_SHAPE if image_shape is None else image_shape
+    cuda = config.MISC.GPU_COUNT >= 1
+    anchors = Variable(get_priors(config, image_shape), requires_grad=False)
     bs, prior_num = inputs[0].size(0), anchors.size(0)
     # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
     scores = inputs[0][:, :, 1]
 
     # Box deltas [batch, num_rois, 4]
     deltas = inputs[1]
-    std_dev = Variable(torch.from_numpy(np.reshape(config.DATA.BBOX_STD_DEV, [1, 1, 4])).float(),
-                       requires_grad=False).cuda()
+    std_dev = to_device(Variable(torch.from_numpy(np.reshape(config.DATA.BBOX_STD_DEV, [1, 1, 4])).float(),
+                                 requires_grad=False), cuda)
     deltas = deltas * std_dev
 
     anchors = anchors.expand(bs, anchors.size(0), anchors.size(1))
@@ -105,8 +143,8 @@ def proposal_layer(inputs, proposal_count, nms_threshold, priors, config=None):
     scores = scores[:, :pre_nms_limit]
     order = order[:, :pre_nms_limit]
 
-    deltas_trim = Variable(torch.FloatTensor(bs, pre_nms_limit, 4).cuda())
-    anchors_trim = Variable(torch.FloatTensor(bs, pre_nms_limit, 4).cuda())
+    deltas_trim = Variable(to_device(torch.FloatTensor(bs, pre_nms_limit, 4), cuda))
+    anchors_trim = Variable(to_device(torch.FloatTensor(bs, pre_nms_limit, 4), cuda))
     # index two-dim (out_of_mem if directly index order.data)
     for i in range(bs):
         deltas_trim[i] = deltas[i][order.data[i], :]
@@ -118,9 +156,9 @@ def proposal_layer(inputs, proposal_count, nms_threshold, priors, config=None):
     boxes = apply_box_deltas(anchors_trim, deltas_trim)
 
     # Clip to image boundaries. [batch, N, (y1, x1, y2, x2)]
-    height, width = config.DATA.IMAGE_SHAPE[:2]
+    height, width = image_shape[:2]
     window = np.array([0, 0, height, width]).astype(np.float32)
-    window = Variable(torch.from_numpy(window).cuda(), requires_grad=False)
+    window = Variable(to_device(torch.from_numpy(window), cuda), requires_grad=False)
     boxes = clip_boxes(boxes, window)
 
     # Filter out small boxes
@@ -128,14 +166,17 @@ def proposal_layer(inputs, proposal_count, nms_threshold, priors, config=None):
     # for small objects, so we're skipping it.
 
     # Non-max suppression
+    PROFILER.push('nms')
     keep = nms(torch.cat((boxes, scores.unsqueeze(2)), 2).data, nms_threshold)
+    PROFILER.pop()
     keep = keep[:, :proposal_count]
-    boxes_keep = Variable(torch.FloatTensor(bs, keep.shape[1], 4).cuda())  # bs, proposal_count(1000), 4
+    boxes_keep = Variable(to_device(torch.FloatTensor(bs, keep.shape[1], 4), cuda))  # bs, proposal_count(1000), 4
     for i in range(bs):
         boxes_keep[i] = boxes[i][keep[i], :]
 
     # Normalize dimensions to range of 0 to 1.
-    norm = Variable(torch.from_numpy(np.array([height, width, height, width])).float(), requires_grad=False).cuda()
+    norm = to_device(Variable(torch.from_numpy(np.array([height, width, height, width])).float(),
+                              requires_grad=False), cuda)
     normalized_boxes = boxes_keep / norm
 
     return normalized_boxes   # proposals
@@ -175,8 +216,7 @@ def pyramid_roi_align(inputs, pool_size, image_shape, base=224.):
     # the fact that our coordinates are normalized here.
     # e.g. a 224x224 ROI (in pixels) maps to P4
     image_area = Variable(torch.FloatTensor([float(image_shape[0]*image_shape[1])]), requires_grad=False)
-    if boxes.is_cuda:
-        image_area = image_area.cuda()
+    image_area = to_device(image_area, boxes.is_cuda)
     roi_level = 4 + log2(torch.sqrt(h*w)/(base/torch.sqrt(image_area)))
     roi_level = roi_level.round().int()
     # in case batch size =1, we keep that dim
@@ -211,8 +251,8 @@ def pyramid_roi_align(inputs, pool_size, image_shape, base=224.):
     box_to_level = torch.cat(box_to_level, dim=0)
 
     # Rearrange pooled features to match the order of the original boxes
-    pooled_out = Variable(torch.zeros(
-        boxes.size(0), boxes.size(1), pooled.size(1), pooled.size(2), pooled.size(3)).cuda())
+    pooled_out = Variable(to_device(torch.zeros(
+        boxes.size(0), boxes.size(1), pooled.size(1), pooled.size(2), pooled.size(3)), boxes.is_cuda))
     pooled_out[box_to_level[:, 0], box_to_level[:, 1], :, :, :] = pooled
     # 3, 1000, 256, 7 (or 14), 7 -> 3000, 256, 7, 7
     pooled_out = pooled_out.view(-1, pooled_out.size(2), pooled_out.size(3), pooled_out.size(4))
@@ -227,6 +267,7 @@ def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
     # PER SAMPLE OPERATION
     # proposals: N, 4
     # gt_class_ids: size MAX_GT_NUM
+    cuda = config.MISC.GPU_COUNT >= 1
 
     if torch.nonzero(gt_class_ids < 0).size():
         # Handle COCO crowds
@@ -245,7 +286,7 @@ def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
         crowd_iou_max = torch.max(crowd_overlaps, dim=-1)[0]
         no_crowd_bool = crowd_iou_max < 0.001
     else:
-        no_crowd_bool = Variable(torch.ByteTensor(proposals.size(0)), requires_grad=False).cuda()
+        no_crowd_bool = to_device(Variable(torch.ByteTensor(proposals.size(0)), requires_grad=False), cuda)
         no_crowd_bool[:] = True
 
     # Compute overlaps matrix [bs, proposals, gt_boxes]
@@ -272,7 +313,7 @@ def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
         pos_ind = torch.nonzero(pos_roi_bool)[:, 0]
 
         pos_cnt_per_im = int(config.ROIS.TRAIN_ROIS_PER_IMAGE*config.ROIS.ROI_POSITIVE_RATIO)
-        rand_idx = torch.randperm(pos_ind.size(0)).cuda()
+        rand_idx = to_device(torch.randperm(pos_ind.size(0)), cuda)
         rand_idx = rand_idx[:pos_cnt_per_im]
         pos_ind = pos_ind[rand_idx]
         pos_cnt = pos_ind.size(0)
@@ -289,9 +330,7 @@ def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
         # DELTAS
         # Compute bbox refinement for positive ROIs
         DELTAS = Variable(box_refinement(POS_ROIS.data, roi_gt_boxes.data), requires_grad=False)
-        std_dev = Variable(torch.from_numpy(config.DATA.BBOX_STD_DEV).float(), requires_grad=False)
-        if config.MISC.GPU_COUNT:
-            std_dev = std_dev.cuda()
+        std_dev = to_device(Variable(torch.from_numpy(config.DATA.BBOX_STD_DEV).float(), requires_grad=False), cuda)
         DELTAS /= std_dev
 
         # MASKS
@@ -315,7 +354,7 @@ def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
 
         # box_ids ranges from 0 to the number of masks
         # UPDATE: no need to fixme if switched to roi_pool method; since mask branch is for segmentation
-        box_ids = Variable(torch.arange(roi_masks.size(0)), requires_grad=False).cuda().int()
+        box_ids = to_device(Variable(torch.arange(roi_masks.size(0)), requires_grad=False), cuda).int()
         masks = Variable(
             CropAndResizeFunction(config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1])
             (roi_masks.unsqueeze(1), boxes, box_ids).data,
@@ -332,10 +371,8 @@ def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
         neg_ind = torch.nonzero(neg_roi_bool)[:, 0]
         r = 1.0 / config.ROIS.ROI_POSITIVE_RATIO
         neg_cnt = int(r * pos_cnt - pos_cnt)
-        rand_idx = torch.randperm(neg_ind.size(0)).cuda()
+        rand_idx = to_device(torch.randperm(neg_ind.size(0)), cuda)
         rand_idx = rand_idx[:neg_cnt]
-        if config.MISC.GPU_COUNT:
-            rand_idx = rand_idx.cuda()
         neg_ind = neg_ind[rand_idx]
         neg_cnt = neg_ind.size(0)
         NEG_ROIS = proposals[neg_ind, :]
@@ -348,13 +385,13 @@ def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
 
         ROIS = torch.cat((POS_ROIS, NEG_ROIS), dim=0)
 
-        zeros = Variable(torch.zeros(neg_cnt).cuda(), requires_grad=False).int()
+        zeros = Variable(to_device(torch.zeros(neg_cnt), cuda), requires_grad=False).int()
         ROI_GT_CLASS_IDS = torch.cat([ROI_GT_CLASS_IDS, zeros], dim=0)
 
-        zeros = Variable(torch.zeros(neg_cnt, 4).cuda(), requires_grad=False)
+        zeros = Variable(to_device(torch.zeros(neg_cnt, 4), cuda), requires_grad=False)
         DELTAS = torch.cat([DELTAS, zeros], dim=0)
 
-        zeros = Variable(torch.zeros(neg_cnt, config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1]).cuda(),
+        zeros = Variable(to_device(torch.zeros(neg_cnt, config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1]), cuda),
                          requires_grad=False)
         MASKS = torch.cat([MASKS, zeros], dim=0)
 
@@ -366,13 +403,13 @@ def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
 
         ROIS = NEG_ROIS
 
-        zeros = Variable(torch.zeros(neg_cnt).cuda(), requires_grad=False).int()
+        zeros = Variable(to_device(torch.zeros(neg_cnt), cuda), requires_grad=False).int()
         ROI_GT_CLASS_IDS = zeros
 
-        zeros = Variable(torch.zeros(neg_cnt, 4).cuda(), requires_grad=False)
+        zeros = Variable(to_device(torch.zeros(neg_cnt, 4), cuda), requires_grad=False)
         DELTAS = zeros
 
-        zeros = Variable(torch.zeros(neg_cnt, config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1]).cuda(),
+        zeros = Variable(to_device(torch.zeros(neg_cnt, config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1]), cuda),
                          requires_grad=False)
         MASKS = zeros
 
@@ -413,11 +450,12 @@ def prepare_det_target(proposals, gt_class_ids, gt_boxes, gt_masks, config):
     num_rois = config.ROIS.TRAIN_ROIS_PER_IMAGE   # max_rois_per_image
     mask_sz = config.MRCNN.MASK_SHAPE[0]
 
-    rois_out = Variable(torch.zeros(bs, num_rois, 4).cuda())
+    cuda = config.MISC.GPU_COUNT >= 1
+    rois_out = Variable(to_device(torch.zeros(bs, num_rois, 4), cuda))
     # rois_out = []
-    target_class_ids = Variable(torch.IntTensor(bs, num_rois).zero_().cuda(), requires_grad=False)
-    target_deltas = Variable(torch.zeros(bs, num_rois, 4).cuda(), requires_grad=False)
-    target_mask = Variable(torch.zeros(bs, num_rois, mask_sz, mask_sz).cuda(), requires_grad=False)
+    target_class_ids = Variable(to_device(torch.IntTensor(bs, num_rois).zero_(), cuda), requires_grad=False)
+    target_deltas = Variable(to_device(torch.zeros(bs, num_rois, 4), cuda), requires_grad=False)
+    target_mask = Variable(to_device(torch.zeros(bs, num_rois, mask_sz, mask_sz), cuda), requires_grad=False)
 
     for i in range(bs):
         # per sample
@@ -451,13 +489,15 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
         print('this is the image you want to see: {}'.format(EXAMPLE_COCO_IND))
         a = 1
 
+    cuda = config.MISC.GPU_COUNT >= 1
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
-    target_rpn_match = Variable(torch.zeros(anchors.size(0)).cuda(), requires_grad=False)
+    target_rpn_match = Variable(to_device(torch.zeros(anchors.size(0)), cuda), requires_grad=False)
     # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    target_rpn_bbox = Variable(torch.zeros(config.RPN.TRAIN_ANCHORS_PER_IMAGE, 4).cuda(), requires_grad=False)
+    target_rpn_bbox = Variable(to_device(torch.zeros(config.RPN.TRAIN_ANCHORS_PER_IMAGE, 4), cuda),
+                               requires_grad=False)
 
     original_gt_full_size = gt_class_ids.size(0)
-    original_gt_num = torch.sum((gt_class_ids > 0).long()).data[0]
+    original_gt_num = torch.sum((gt_class_ids > 0).long()).item()
     if torch.nonzero(gt_class_ids < 0).size():
         # Filter out crowds from ground truth class IDs and boxes
         _ind_crowd = torch.nonzero(gt_class_ids < 0).squeeze()
@@ -472,14 +512,11 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
         crowd_overlaps = bbox_overlaps(anchors, crowd_boxes)
         crowd_iou_max = torch.max(crowd_overlaps, dim=-1)[0]
         no_crowd_bool = (crowd_iou_max < 0.001)
-        if config.CTRL.PROFILE_ANALYSIS:
-            print('\t\t[sample_id {}, im {}] 0. passed crowd reduction in generate_rpn_target'.
-                  format(curr_sample_id, coco_im_id[curr_sample_id]))
     else:
         # All anchors don't intersect a crowd
-        no_crowd_bool = Variable(torch.ByteTensor(anchors.size(0)), requires_grad=False).cuda()
+        no_crowd_bool = to_device(Variable(torch.ByteTensor(anchors.size(0)), requires_grad=False), cuda)
         no_crowd_bool[:] = True
-    actual_gt_num = torch.sum((gt_class_ids > 0).long()).data[0]
+    actual_gt_num = torch.sum((gt_class_ids > 0).long()).item()
 
     # Compute overlaps
     # previously known as "compute_overlaps"
@@ -505,13 +542,10 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
     # 3. Set anchors with high overlap as positive.
     target_rpn_match[anchor_iou_max >= config.RPN.TARGET_POS_THRES] = 1
 
-    if config.CTRL.PROFILE_ANALYSIS:
-        print('\t\t[sample_id {}, im {}] 1. passed initial assignment in generate_rpn_target'.
-              format(curr_sample_id, coco_im_id[curr_sample_id]))
     try:
-        _pos_num_before = torch.sum((target_rpn_match == 1).long()).data[0]
-        _neg_num_before = torch.sum((target_rpn_match == -1).long()).data[0]
-        _neutral_num_before = torch.sum((target_rpn_match == 0).long()).data[0]
+        _pos_num_before = torch.sum((target_rpn_match == 1).long()).item()
+        _neg_num_before = torch.sum((target_rpn_match == -1).long()).item()
+        _neutral_num_before = torch.sum((target_rpn_match == 0).long()).item()
     except RuntimeError:
         # import pdb
         # pdb.set_trace()
@@ -522,18 +556,12 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
     pos_ids = torch.nonzero(target_rpn_match == 1).squeeze()
     pos_extra = pos_ids.size(0) - (config.RPN.TRAIN_ANCHORS_PER_IMAGE // 2)
     if pos_extra > 0:
-        if config.CTRL.PROFILE_ANALYSIS:
-            print('\t\t\t[sample_id {}, im {}] enter pos reduction ...'.
-                  format(curr_sample_id, coco_im_id[curr_sample_id]))
         # Reset the extra ones to neutral
-        _tmp = torch.from_numpy(np.random.permutation(pos_ids.size(0))).cuda()
+        _tmp = to_device(torch.from_numpy(np.random.permutation(pos_ids.size(0))), cuda)
         # _tmp = torch.randperm(pos_ids.size(0)).cuda()
         _ids = pos_ids[_tmp[:pos_extra]]
         target_rpn_match[_ids] = 0
         pos_set_to_zero = _ids.size(0)
-        if config.CTRL.PROFILE_ANALYSIS:
-            print('\t\t\t[sample_id {}, im {}] set extra anchors of positive to neutral '
-                  'in generate_rpn_target'.format(curr_sample_id, coco_im_id[curr_sample_id]))
     else:
         pos_set_to_zero = -1
 
@@ -542,7 +570,7 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
     try:
         neg_ids = torch.nonzero(target_rpn_match == -1).squeeze()
         neg_extra = neg_ids.size(0) - (config.RPN.TRAIN_ANCHORS_PER_IMAGE -
-                                   torch.sum((target_rpn_match == 1).long()).data[0])
+                                   torch.sum((target_rpn_match == 1).long()).item())
     except RuntimeError:
         import pdb
         pdb.set_trace()
@@ -550,16 +578,16 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
 
     if neg_extra > 0:
         # Reset the extra ones to neutral
-        _tmp = torch.from_numpy(np.random.permutation(neg_ids.size(0))).cuda()
+        _tmp = to_device(torch.from_numpy(np.random.permutation(neg_ids.size(0))), cuda)
         _ids = neg_ids[_tmp[:neg_extra]]
         _neg_set_to_zero = _ids.size(0)
         target_rpn_match[_ids] = 0
     else:
         _neg_set_to_zero = -1
         RARE_CASE = True
-        _pos_num = torch.sum((target_rpn_match == 1).long()).data[0]
-        _neg_num = torch.sum((target_rpn_match == -1).long()).data[0]
-        _neutral_num = torch.sum((target_rpn_match == 0).long()).data[0]
+        _pos_num = torch.sum((target_rpn_match == 1).long()).item()
+        _neg_num = torch.sum((target_rpn_match == -1).long()).item()
+        _neutral_num = torch.sum((target_rpn_match == 0).long()).item()
         print_log('\n[im: {}][WARNING!!!], neg ids is smaller!'
                   '\t\tpos_num: {}, neg_num: {}, neutral_num: {}, anchors_num: {}\n'
                   .format(curr_im_name,
@@ -569,9 +597,9 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
     # TODO: bug this line. RuntimeError: cuda runtime error (59) : device-side assert triggered at
     # see issue here: https://github.com/pytorch/pytorch/issues/4144
     try:
-        _pos_num = torch.sum((target_rpn_match == 1).long()).data[0]
-        _neg_num = torch.sum((target_rpn_match == -1).long()).data[0]
-        _neutral_num = torch.sum((target_rpn_match == 0).long()).data[0]
+        _pos_num = torch.sum((target_rpn_match == 1).long()).item()
+        _neg_num = torch.sum((target_rpn_match == -1).long()).item()
+        _neutral_num = torch.sum((target_rpn_match == 0).long()).item()
     except RuntimeError:
         a = 1
 
@@ -596,10 +624,6 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
                          _pos_num_before, _neg_num_before, _neutral_num_before
                          ), config.MISC.LOG_FILE)
 
-    if config.CTRL.PROFILE_ANALYSIS:
-        print('\t\t[sample_id {}, im {}] 2. passed rpn_target_match'.
-              format(curr_sample_id, coco_im_id[curr_sample_id]))
-
     # For *positive* anchors, compute shift and scale needed to transform them
     # to match the corresponding GT boxes.
     ix = 0
@@ -610,22 +634,20 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
         anchor = anchors[pos_id]
         target_rpn_bbox[ix] = box_refinement(anchor, gt)
         ix += 1
-    # if config.CTRL.PROFILE_ANALYSIS:
-    #     print('\t\t[sample_id {}, im {}] passed rpn_target_bbox'.
-    #           format(curr_sample_id, coco_im_id[curr_sample_id]))
 
     return target_rpn_match, target_rpn_bbox
 
 
-def prepare_rpn_target(anchors, gt_class_ids, gt_boxes, config, curr_coco_im_id=None):
+def prepare_rpn_target(gt_class_ids, gt_boxes, config, image_shape=None, curr_coco_im_id=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     Args:
-        anchors:            [num_anchors, (y1, x1, y2, x2)] Tensor
         gt_class_ids:       [bs, num_gt_boxes] Variable (FloatTensor)
         gt_boxes:           [bs, num_gt_boxes, (y1, x1, y2, x2)]
         config:             configuration
+        image_shape:        [height, width] of the input batch; DATA.IMAGE_SHAPE if not provided
+                            (anchors are taken from the prior cache for this shape)
 
     Returns:
         target_rpn_match:   [bs, num_anchors] (int32) matches between anchors and GT boxes.
@@ -649,7 +671,8 @@ def prepare_rpn_target(anchors, gt_class_ids, gt_boxes, config, curr_coco_im_id=
     # curr_coco_im_id = my_vars['curr_coco_im_id']
 
     bs = gt_class_ids.size(0)
-    anchors = Variable(anchors.cuda(), requires_grad=False)
+    image_shape = config.DATA.IMAGE_SHAPE if image_shape is None else image_shape
+    anchors = Variable(get_priors(config, image_shape), requires_grad=False)
 
     rpn_match, rpn_bbox = [], []
 
@@ -661,7 +684,7 @@ def prepare_rpn_target(anchors, gt_class_ids, gt_boxes, config, curr_coco_im_id=
 
     rpn_match = torch.stack(rpn_match)
     rpn_bbox = torch.stack(rpn_bbox)
-    rpn_bbox /= Variable(torch.from_numpy(config.DATA.BBOX_STD_DEV).float().cuda())
+    rpn_bbox /= Variable(to_device(torch.from_numpy(config.DATA.BBOX_STD_DEV).float(), config.MISC.GPU_COUNT >= 1))
 
     return rpn_match, rpn_bbox
 
@@ -725,7 +748,7 @@ def conduct_nms(class_ids, refined_rois, class_scores, keep, config):
     return detections, final_index
 
 
-def detection_layer(rois, probs, deltas, windows, config, feature=None, small_feat_gt=None):
+def detection_layer(rois, probs, deltas, windows, config, feature=None, small_feat_gt=None, image_shape=None):
     """Takes classified proposal boxes and their bounding box deltas and
     returns the final detection boxes.
 
@@ -738,40 +761,40 @@ def detection_layer(rois, probs, deltas, windows, config, feature=None, small_fe
         config
         feature:                [bs*1000, 1024]
         DEPRECATED small_feat_gt: [bs*1000]
+        image_shape:            [height, width] of the input batch; DATA.IMAGE_SHAPE if not provided
     Returns:
         detections:             [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)]
     """
     bs = rois.size(0)
     box_num_per_sample = rois.size(1)
+    cuda = config.MISC.GPU_COUNT >= 1
     # init detections (result) all zeros
-    detections = Variable(torch.zeros(bs, config.TEST.DET_MAX_INSTANCES, 6).cuda(), volatile=True)
+    detections = Variable(to_device(torch.zeros(bs, config.TEST.DET_MAX_INSTANCES, 6), cuda), volatile=True)
     output_feat = None
     if feature is not None:
         feat_dim = feature.size(1)
-        output_feat = Variable(torch.zeros(bs, config.TEST.DET_MAX_INSTANCES, feat_dim).cuda(), volatile=True)
+        output_feat = Variable(to_device(torch.zeros(bs, config.TEST.DET_MAX_INSTANCES, feat_dim), cuda), volatile=True)
 
     # Class IDs per ROI
     class_scores, class_ids = torch.max(probs, dim=1)
 
     # Class probability of the top class of each ROI
     # Class-specific bounding box deltas
-    _idx = torch.arange(class_ids.size(0)).cuda().long()
+    _idx = to_device(torch.arange(class_ids.size(0)), cuda).long()
     deltas_specific = deltas[_idx, class_ids]   # TODO (important): good example of 2D index
 
     # Apply bounding box deltas
     # Shape: [boxes, (y1, x1, y2, x2)] in normalized coordinates
     std_dev = Variable(torch.from_numpy(np.reshape(config.DATA.BBOX_STD_DEV, [1, 4])).float(), requires_grad=False)
-    if config.MISC.GPU_COUNT:
-        std_dev = std_dev.cuda()
+    std_dev = to_device(std_dev, cuda)
     deltas_specific *= std_dev
 
     rois = rois.view(-1, 4)
     refined_rois = apply_box_deltas(rois.unsqueeze(0), deltas_specific.unsqueeze(0))
     # Convert coordinates to image domain
-    height, width = config.DATA.IMAGE_SHAPE[:2]
+    height, width = (config.DATA.IMAGE_SHAPE if image_shape is None else image_shape)[:2]
     scale = Variable(torch.from_numpy(np.array([height, width, height, width])).float(), requires_grad=False)
-    if config.MISC.GPU_COUNT:
-        scale = scale.cuda()
+    scale = to_device(scale, cuda)
     refined_rois *= scale
     # Clip boxes to image window
     refined_rois = clip_boxes(refined_rois, windows)
@@ -784,14 +807,14 @@ def detection_layer(rois, probs, deltas, windows, config, feature=None, small_fe
 
     if torch.nonzero(keep_bool).dim() == 0:
         # indicate no detected boxes!
-        return detections
+        return detections, output_feat
 
     # conduct nms per sample
     for i in range(bs):
         curr_start = i*box_num_per_sample
         curr_end = i*box_num_per_sample + box_num_per_sample
         curr_keep_bool = keep_bool[curr_start:curr_end]
-        if torch.sum(curr_keep_bool.long()).data[0] == 0:
+        if torch.sum(curr_keep_bool.long()).item() == 0:
             continue
 
         curr_dets, final_index = conduct_nms(
@@ -853,7 +876,7 @@ def compute_rpn_bbox_loss(target_rpn_bbox, target_rpn_match, rpn_bbox):
 
     # Trim target bounding box deltas to the same length as rpn_bbox.
     bs = target_rpn_bbox.size(0)
-    target_bbox_sort = Variable(torch.zeros(rpn_bbox.size()).cuda(), requires_grad=False)
+    target_bbox_sort = Variable(to_device(torch.zeros(rpn_bbox.size()), rpn_bbox.is_cuda), requires_grad=False)
     cnt = 0
     for i in range(bs):
         curr_size = sum(indices.data[:, 0] == i)
@@ -871,7 +894,7 @@ def compute_mrcnn_class_loss(target_class_ids, pred_class_logits):
     target_class_ids:   [batch, num_rois]. Integer class IDs. Uses zero padding to fill in the array.
     pred_class_logits:  [batch, num_rois, num_classes]
     """
-    if torch.sum(target_class_ids).data[0] != 0:
+    if torch.sum(target_class_ids).item() != 0:
         loss = F.cross_entropy(pred_class_logits.view(-1, pred_class_logits.size(2)),
                                target_class_ids.long().view(-1))
     else:
@@ -889,14 +912,15 @@ def compute_mrcnn_bbox_loss(target_bbox, target_class_ids, pred_bbox):
     pred_bbox:          [batch, num_rois, num_classes, (dy, dx, log(dh), log(dw))]
     """
 
-    if torch.sum(target_class_ids).data[0] != 0:
+    if torch.sum(target_class_ids).item() != 0:
         # # Only positive ROIs contribute to the loss. And only
         # # the right class_id of each ROI. Get their indices.
         # TODO: optimize here, loss
         # in my ugly manner
         ugly_ind = torch.nonzero(target_class_ids > 0).long()
-        target_bbox_sort = Variable(torch.zeros(ugly_ind.size(0), 4).cuda(), requires_grad=False)
-        temp = Variable(torch.zeros(ugly_ind.size(0), 4).cuda(), requires_grad=True)
+        target_bbox_sort = Variable(to_device(torch.zeros(ugly_ind.size(0), 4), target_bbox.is_cuda),
+                                    requires_grad=False)
+        temp = Variable(to_device(torch.zeros(ugly_ind.size(0), 4), target_bbox.is_cuda), requires_grad=True)
         pred_bbox_sort = temp.clone()
 
         for i in range(ugly_ind.size(0)):
@@ -920,14 +944,15 @@ def compute_mrcnn_mask_loss(target_masks, target_class_ids, pred_masks):
     target_class_ids:   [batch, num_rois]. Integer class IDs. Zero padded.
     pred_masks:         [batch, proposals, height, width, num_classes] float32 tensor with values from 0 to 1.
     """
-    if torch.sum(target_class_ids).data[0] != 0:
+    if torch.sum(target_class_ids).item() != 0:
         # # Only positive ROIs contribute to the loss. And only
         # # the class specific mask of each ROI.
         # in my ugly manner
         mask_sz = target_masks.size(2)
         ugly_ind = torch.nonzero(target_class_ids > 0).long()
-        y_true_sort = Variable(torch.zeros(ugly_ind.size(0), mask_sz, mask_sz).cuda(), requires_grad=False)
-        temp = Variable(torch.zeros(y_true_sort.size()).cuda(), requires_grad=True)
+        y_true_sort = Variable(to_device(torch.zeros(ugly_ind.size(0), mask_sz, mask_sz), target_masks.is_cuda),
+                               requires_grad=False)
+        temp = Variable(to_device(torch.zeros(y_true_sort.size()), target_masks.is_cuda), requires_grad=True)
         y_pred_sort = temp.clone()
 
         for i in range(ugly_ind.size(0)):
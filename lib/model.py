@@ -8,6 +8,7 @@ import torch
 from torch.autograd import Variable
 
 import tools.utils as utils
+from tools.profiler import PROFILER
 from lib.OT_module import OptTrans
 from tools.image_utils import parse_image_meta
 from tools.tsne.vtsne import VTSNE
@@ -46,6 +47,8 @@ class MaskRCNN(nn.Module):
             raise Exception("Image size must be dividable by 2 at least 6 times "
                             "to avoid fractions when downscaling and upscaling."
                             "For example, use 256, 320, 384, 448, 512, ... etc. ")
+        # uint8 -> float, minus mean pixel (only used if DATA.DEVICE_NORMALIZE)
+        self.mold_input = MoldInput(config.DATA.MEAN_PIXEL)
         # Build the shared convolutional layers.
         # Bottom-up Layers
         # Returns a list of the last layers of each stage, 5 in total.
@@ -55,11 +58,8 @@ class MaskRCNN(nn.Module):
         # Top-down Layers
         self.fpn = FPN(config, C1, C2, C3, C4, C5, out_channels=256)
 
-        # Generate Anchors (Tensor; do not assign cuda() here)
-        self.priors = torch.from_numpy(
-            generate_pyramid_priors(config.RPN.ANCHOR_SCALES, config.RPN.ANCHOR_RATIOS,
-                                    config.MODEL.BACKBONE_SHAPES, config.MODEL.BACKBONE_STRIDES,
-                                    config.RPN.ANCHOR_STRIDE)).float()
+        # Anchors are generated lazily per input shape (see layers.PriorCache) inside
+        # proposal_layer() and prepare_rpn_target()
         # RPN
         self.rpn = RPN(len(config.RPN.ANCHOR_RATIOS), config.RPN.ANCHOR_STRIDE, input_ch=256)
         # RoI
@@ -73,6 +73,12 @@ class MaskRCNN(nn.Module):
                        pool_size=config.MRCNN.POOL_SIZE, config=config)
         # FPN Mask
         self.mask = Mask(depth=256, num_classes=config.DATASET.NUM_CLASSES)
+        self.set_grad_checkpoint(config.MODEL.GRAD_CHECKPOINT)
+        # see optimize_for_inference()
+        self.inference_optimized = False
+        if not config.TRAIN.BN_LEARN:
+            # fixed bn statistics in all phases; replaces the per-step set_bn_eval traversal
+            convert_frozen_bn(self)
 
         # Update (May 3): comment the following
         # if not config.TRAIN.BN_LEARN:
@@ -97,7 +103,7 @@ class MaskRCNN(nn.Module):
                 nn.init.xavier_normal(m.weight)
                 if m.bias is not None:
                     m.bias.data.zero_()
-            elif isinstance(m, nn.BatchNorm2d) or isinstance(m, nn.BatchNorm1d):
+            elif isinstance(m, (nn.BatchNorm2d, nn.BatchNorm1d, FrozenBatchNorm2d)):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
             elif isinstance(m, nn.Linear):
@@ -108,14 +114,77 @@ class MaskRCNN(nn.Module):
         """ called in 'utils.py' """
         if self.config.DEV.INIT_BUFFER_WEIGHT == 'scratch':
             utils.print_log('init buffer from scratch ...', log_file)
-            self.buffer = torch.zeros(self.config.DEV.BUFFER_SIZE, 1024, self.config.DATASET.NUM_CLASSES).cuda()
-            self.buffer_cnt = torch.zeros(self.config.DEV.BUFFER_SIZE, 1, self.config.DATASET.NUM_CLASSES).cuda()
+            cuda = self.config.MISC.GPU_COUNT >= 1
+            self.buffer = to_device(
+                torch.zeros(self.config.DEV.BUFFER_SIZE, 1024, self.config.DATASET.NUM_CLASSES), cuda)
+            self.buffer_cnt = to_device(
+                torch.zeros(self.config.DEV.BUFFER_SIZE, 1, self.config.DATASET.NUM_CLASSES), cuda)
 
         elif self.config.DEV.INIT_BUFFER_WEIGHT == 'coco_pretrain':
             # TODO: init buffer
             utils.print_log('init buffer from pretrain model ...', log_file)
             NotImplementedError()
 
+    def set_grad_checkpoint(self, stages):
+        """stages: subset of ['C2', 'C3', 'C4', 'C5', 'FPN', 'MASK'] (MODEL.GRAD_CHECKPOINT)"""
+        unknown = set(stages) - {'C2', 'C3', 'C4', 'C5', 'FPN', 'MASK'}
+        if unknown:
+            raise Exception('unknown MODEL.GRAD_CHECKPOINT entries: {}'.format(sorted(unknown)))
+        self.fpn.grad_checkpoint = list(stages)
+        self.mask.grad_checkpoint = 'MASK' in stages
+
+    def detect(self, mrcnn_feature_maps, proposals, image_metas, image_shape, amp=False, head_outputs=False):
+        """inference branch of forward(): classifier, detection layer and mask head on
+        [p2, p3, p4, p5] and the rpn proposals. Also used by lib/export.py.
+        head_outputs: also return proposals, mrcnn_class and mrcnn_bbox (TEST.CACHE_HEAD_OUTPUTS)"""
+        h, w = image_shape
+        scale = to_device(Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False),
+                          self.config.MISC.GPU_COUNT >= 1)
+
+        assert proposals.sum().item() != 0
+
+        _pooled_cls, _, _feat_out_test = self.dev_roi(mrcnn_feature_maps, proposals, image_shape=image_shape)
+
+        if self.config.DEV.STRUCTURE == 'beta':
+            small_output_all, small_gt_all = _feat_out_test
+        else:
+            small_output_all, small_gt_all = None, None
+
+        _, mrcnn_class, mrcnn_bbox = \
+            self._run_head(self.classifier, amp, _pooled_cls, small_output_all, small_gt_all)
+
+        # Detections
+        # image_metas: (bs, 90), Variable
+        _, _, windows, _, _ = parse_image_meta(image_metas)
+        # output is [batch, num_detections (say 100), (y1, x1, y2, x2, class_id, score)] in image coordinates
+        detections, _ = detection_layer(proposals, mrcnn_class, mrcnn_bbox, windows, self.config,
+                                        image_shape=image_shape)
+
+        # assert detections.sum().data[0] != 0   # update: allow zero detection
+        # Convert boxes to normalized coordinates
+        normalize_boxes = detections[:, :, :4] / scale
+        # Create masks for detections
+        _, _pooled_mask, _ = self.dev_roi(mrcnn_feature_maps, normalize_boxes, image_shape=image_shape)
+        mrcnn_mask = self._run_head(self.mask, amp, _pooled_mask)
+
+        # shape: batch, num_detections, 81, 28, 28
+        mrcnn_mask = mrcnn_mask.view(
+            proposals.size(0), -1, mrcnn_mask.size(1), mrcnn_mask.size(2), mrcnn_mask.size(3))
+
+        if head_outputs:
+            return [detections, mrcnn_mask, proposals, mrcnn_class, mrcnn_bbox]
+        return [detections, mrcnn_mask]
+
+    def optimize_for_inference(self):
+        """Fold BN into the preceding conv (resnet, classifier and mask heads) and let the
+        stride-1 3x3 convs pad themselves instead of SamePad2d (resnet, fpn, mask head).
+        Inference only, irreversible (bn layers are gone from the state_dict); called after
+        the weights are loaded (TEST.OPTIMIZE_FOR_INFERENCE). Dev/OptTrans are untouched."""
+        self.fpn.optimize_for_inference()
+        self.classifier.optimize_for_inference()
+        self.mask.optimize_for_inference()
+        self.inference_optimized = True
+
     def set_trainable(self, layer_regex, log_file):
         """called in 'workflow.py'
         Sets model layers as trainable if their names match the given regular expression.
@@ -142,47 +211,57 @@ class MaskRCNN(nn.Module):
             utils.print_log('\tlayer name: {}\t\treguires_grad: {}'.format(name, param.requires_grad),
                       log_file, quiet_termi=True)
 
-    def meta_loss(self, feat_input):
-        """the loss is computed in GPU 0; called in workflow.py *only*."""
+    def meta_loss(self, feat_input, update=None):
+        """the loss is computed in GPU 0 (in each process if MISC.DISTRIBUTED); called in workflow.py *only*.
+        update: 0-dim bool tensor on the device; the buffer is left unchanged where it is False
+        (no small feature in the batch), without a host sync. None: always update."""
         # the direct outcome (feat_out) from 'forward() of Dev class in sub_module.py'
         [big_feat, big_cnt, small_feat, small_cnt, small_output_all, small_gt_all] = feat_input
+        cuda = self.config.MISC.GPU_COUNT >= 1
 
         # update buffer (buffer_size x 1024 x 81)
         # self.buffer/buffer_cnt is Tensor
         buffer_size = self.buffer.size(0)
-        _big_feat, _big_cnt = self._merge_feat_vec(big_feat, big_cnt)
+        # distributed: the per-class sums are all-reduced so that the buffer is the same in all processes
+        _big_feat, _big_cnt = self._merge_feat_vec(big_feat, big_cnt, reduce=self.config.MISC.DISTRIBUTED)
         _big_feat_tensor, _big_cnt_tensor = _big_feat.data, _big_cnt.data
         if buffer_size == 1:
             # use all historic data
             feat_sum = self.buffer * self.buffer_cnt + _big_feat_tensor.unsqueeze(0) * _big_cnt_tensor.unsqueeze(0)
-            self.buffer_cnt += _big_cnt_tensor.unsqueeze(0)
-            self.buffer = feat_sum / (self.buffer_cnt + EPS)
+            buffer_cnt = self.buffer_cnt + _big_cnt_tensor.unsqueeze(0)
+            buffer = feat_sum / (buffer_cnt + EPS)
+        else:
+            # drop the oldest entry
+            buffer = torch.cat([self.buffer[1:], _big_feat_tensor.unsqueeze(0)])
+            buffer_cnt = torch.cat([self.buffer_cnt[1:], _big_cnt_tensor.unsqueeze(0)])
+        if update is not None:
+            buffer = torch.where(update, buffer, self.buffer)
+            buffer_cnt = torch.where(update, buffer_cnt, self.buffer_cnt)
+        self.buffer, self.buffer_cnt = buffer, buffer_cnt
+        if buffer_size == 1:
             final_big_feat = self.buffer.squeeze()  # shape: 1024 x 81
         else:
-            # in-place opt. on Tensor (cannot be done on Variable)
-            self.buffer[:-1] = self.buffer[1:]
-            self.buffer[-1, :, :] = _big_feat_tensor
-            self.buffer_cnt[:-1] = self.buffer_cnt[1:]
-            self.buffer_cnt[-1, :, :] = _big_cnt_tensor
             final_big_feat = \
                 torch.sum(self.buffer * self.buffer_cnt, dim=0) / (torch.sum(self.buffer_cnt, dim=0) + EPS)
 
         if self.config.DEV.INST_LOSS:
             # _idx_tmp/_idx indexes the instances of small objects
             # small_gt_all shape: 1200
-            _idx_tmp = torch.nonzero(small_gt_all).squeeze().data
+            _idx_tmp = torch.nonzero(small_gt_all).view(-1).data
             buff_cls_idx = torch.nonzero(torch.sum(self.buffer_cnt, dim=0).squeeze() > 0).squeeze()
             _idx = [ind for ind in _idx_tmp if small_gt_all[ind].data.cpu().numpy() in buff_cls_idx]
-            _idx = torch.from_numpy(np.array(_idx)).cuda()
+            _idx = to_device(torch.from_numpy(np.array(_idx)), cuda)
         else:
             # final_small_feat, 1024 x 81; final_small_cnt, 1 x 81
             final_small_feat, final_small_cnt = self._merge_feat_vec(small_feat, small_cnt)
             final_small_cnt.data[0][0] = 0  # Variable; do not include background cls when computing meta_loss
             # _idx indexes the 81 classes
             _check = (final_small_cnt.squeeze() > 0) + (Variable(self.buffer_cnt.squeeze()) > 0)
-            _idx = torch.nonzero(_check == 2).squeeze().data
+            _idx = torch.nonzero(_check == 2).view(-1).data
 
-        if _idx.size():
+        # the buffer update above is collective (MISC.DISTRIBUTED) and must run in every process;
+        # the loss is zero in a process with nothing to compare (not nan from empty SMALL/BIG)
+        if _idx.numel() > 0:
             if self.config.DEV.INST_LOSS:
                 SMALL = small_output_all[_idx, :]
                 BIG = self._assign_from_buffer(final_big_feat, small_gt_all[_idx])
@@ -208,7 +287,7 @@ class MaskRCNN(nn.Module):
             elif self.config.DEV.LOSS_CHOICE == 'ot':
                 loss = self.ot_loss(SMALL.unsqueeze(dim=-1), BIG.unsqueeze(dim=-1).contiguous())
         else:
-            loss = Variable(torch.zeros(1).cuda())
+            loss = Variable(to_device(torch.zeros(1), cuda))
         return loss
 
     @staticmethod
@@ -217,36 +296,36 @@ class MaskRCNN(nn.Module):
         return Variable(out)
 
     @staticmethod
-    def _merge_feat_vec(box_feat, box_cnt):
-        """merge [gpu_num, scale_num] into 1"""
+    def _merge_feat_vec(box_feat, box_cnt, reduce=False):
+        """merge [gpu_num, scale_num] into 1; also over processes if reduce (no gradient across them)"""
         feat_avg_sum = box_feat * box_cnt
         feat_avg_sum = torch.sum(torch.sum(feat_avg_sum, dim=0), dim=0)  # 1024 x 81
         cnt_sum = torch.sum(torch.sum(box_cnt, dim=0), dim=0)  # 1 x 81
+        if reduce:
+            utils.all_reduce_sum(feat_avg_sum.data)
+            utils.all_reduce_sum(cnt_sum.data)
         feat_avg_sum /= (cnt_sum + EPS)
         return feat_avg_sum, cnt_sum
 
     @staticmethod
-    def adjust_input_gt(*args):
-        """zero-padding different number of GTs for each image within the batch"""
-        gt_cls_ids = args[0]
-        gt_boxes = args[1]
-        gt_masks = args[2]
-        gt_num = [x.shape[0] for x in gt_cls_ids]
-        max_gt_num = max(gt_num)
-        bs = len(gt_cls_ids)
-        mask_shape = gt_masks[0].shape[1]
-
-        GT_CLS_IDS = torch.zeros(bs, max_gt_num)
-        GT_BOXES = torch.zeros(bs, max_gt_num, 4)
-        GT_MASKS = torch.zeros(bs, max_gt_num, mask_shape, mask_shape)
-        for i in range(bs):
-            GT_CLS_IDS[i, :gt_num[i]] = torch.from_numpy(gt_cls_ids[i])
-            GT_BOXES[i, :gt_num[i], :] = torch.from_numpy(gt_boxes[i]).float()
-            GT_MASKS[i, :gt_num[i], :, :] = torch.from_numpy(gt_masks[i]).float()
-
-        GT_CLS_IDS = Variable(GT_CLS_IDS.cuda(), requires_grad=False)
-        GT_BOXES = Variable(GT_BOXES.cuda(), requires_grad=False)
-        GT_MASKS = Variable(GT_MASKS.cuda(), requires_grad=False)
+    def _run_head(head, amp, *inputs):
+        """run a head under autocast if amp; outputs back to fp32"""
+        with amp_autocast(amp):
+            outputs = head(*inputs)
+        return to_float(outputs) if amp else outputs
+
+    def adjust_input_gt(self, *args):
+        """move the GTs (already zero-padded in detection_collate) to gpu (unless MISC.GPU_COUNT < 1)
+        and cast to float"""
+        gt_cls_ids, gt_boxes, gt_masks, gt_num = args
+
+        if self.config.MISC.GPU_COUNT >= 1:
+            gt_cls_ids = gt_cls_ids.cuda(non_blocking=True)
+            gt_boxes = gt_boxes.cuda(non_blocking=True)
+            gt_masks = gt_masks.cuda(non_blocking=True)
+        GT_CLS_IDS = Variable(gt_cls_ids.float(), requires_grad=False)
+        GT_BOXES = Variable(gt_boxes, requires_grad=False)
+        GT_MASKS = Variable(gt_masks.float(), requires_grad=False)
 
         return GT_CLS_IDS, GT_BOXES, GT_MASKS, gt_num
 
@@ -259,10 +338,15 @@ class MaskRCNN(nn.Module):
         """
         molded_images = input[0]
         sample_per_gpu = molded_images.size(0)  # aka, actual batch size
+        # [h, w] of the batch; not always DATA.IMAGE_SHAPE (see DATA.IMAGE_PADDING)
+        image_shape = molded_images.size()[2:]
+        cuda = self.config.MISC.GPU_COUNT >= 1
         # for debug only
-        curr_gpu_id = torch.cuda.current_device()
+        curr_gpu_id = torch.cuda.current_device() if cuda else -1
         curr_coco_im_id = input[-1][:, -1]
 
+        if mode == 'train' and self.inference_optimized:
+            raise Exception('cannot train after optimize_for_inference()')
         # set model state
         if mode == 'inference' or 'visualize':
             _proposal_cnt = self.config.RPN.POST_NMS_ROIS_INFERENCE
@@ -270,28 +354,36 @@ class MaskRCNN(nn.Module):
         elif mode == 'train':
             _proposal_cnt = self.config.RPN.POST_NMS_ROIS_TRAINING
             self.train()
-            if not self.config.TRAIN.BN_LEARN:
-                # Set BN layer always in eval mode during training
-                def set_bn_eval(m):
-                    classname = m.__class__.__name__
-                    if classname.find('BatchNorm') != -1:
-                        m.eval()
-                self.apply(set_bn_eval)
         else:
             raise Exception('unknown phase')
 
-        # Feature extraction
-        [p2_out, p3_out, p4_out, p5_out, p6_out, fpn_ot_loss] = self.fpn(molded_images, mode=mode)
+        if self.config.DATA.DEVICE_NORMALIZE:
+            molded_images = self.mold_input(molded_images)
+
+        # mixed precision (TRAIN.AMP/TEST.AMP) for the backbone, rpn and the classifier/mask heads;
+        # roi pooling (cuda extensions), targets and losses stay in fp32
+        amp = self.config.TRAIN.AMP if mode == 'train' else self.config.TEST.AMP
+
+        with amp_autocast(amp):
+            # Feature extraction
+            PROFILER.push('backbone')
+            [p2_out, p3_out, p4_out, p5_out, p6_out, fpn_ot_loss] = self.fpn(molded_images, mode=mode)
+            PROFILER.pop()
+
+            # Loop through pyramid layers
+            PROFILER.push('rpn')
+            layer_outputs = []  # list of lists
+            for p in [p2_out, p3_out, p4_out, p5_out, p6_out]:
+                layer_outputs.append(self.rpn(p))
+            PROFILER.pop()
+        if amp:
+            [p2_out, p3_out, p4_out, p5_out, p6_out, fpn_ot_loss] = \
+                to_float([p2_out, p3_out, p4_out, p5_out, p6_out, fpn_ot_loss])
+            layer_outputs = [to_float(o) for o in layer_outputs]
 
         # Note that P6 is used in RPN, but not in the classifier heads.
-        _rpn_feature_maps = [p2_out, p3_out, p4_out, p5_out, p6_out]
         _mrcnn_feature_maps = [p2_out, p3_out, p4_out, p5_out]
 
-        # Loop through pyramid layers
-        layer_outputs = []  # list of lists
-        for p in _rpn_feature_maps:
-            layer_outputs.append(self.rpn(p))
-
         # Concatenate rpn layer outputs
         # Convert from list of lists of level outputs to list of lists
         # of outputs across levels.
@@ -302,69 +394,41 @@ class MaskRCNN(nn.Module):
 
         # Generate proposals
         # Proposals are [batch, N (say 2000), (y1, x1, y2, x2)] in normalized coordinates and zero padded.
+        PROFILER.push('proposal_layer')
         _proposals = proposal_layer([_rpn_class_score, rpn_pred_bbox],
                                     proposal_count=_proposal_cnt,
                                     nms_threshold=self.config.RPN.NMS_THRESHOLD,
-                                    priors=self.priors, config=self.config)
+                                    config=self.config, image_shape=image_shape)
+        PROFILER.pop()
         # Normalize coordinates
-        h, w = self.config.DATA.IMAGE_SHAPE[:2]
-        scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False).cuda()
-
-        if self.config.CTRL.PROFILE_ANALYSIS and mode == 'train':
-            print('\t[gpu {:d}] curr_coco_im_ids: {}'.format(curr_gpu_id, curr_coco_im_id.data.cpu().numpy()))
-            print('\t[gpu {:d}] pass feature extraction'.format(curr_gpu_id))
+        h, w = image_shape
+        scale = to_device(Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False), cuda)
 
         if mode == 'inference':
 
-            assert _proposals.sum().data[0] != 0
-
-            _pooled_cls, _, _feat_out_test = self.dev_roi(_mrcnn_feature_maps, _proposals)
-
-            if self.config.DEV.STRUCTURE == 'beta':
-                small_output_all, small_gt_all = _feat_out_test
-            else:
-                small_output_all, small_gt_all = None, None
-
-            _, mrcnn_class, mrcnn_bbox = self.classifier(_pooled_cls, small_output_all, small_gt_all)
-
-            # Detections
-            # input[1], image_metas, (3, 90), Variable
-            _, _, windows, _, _ = parse_image_meta(input[1])
-            # output is [batch, num_detections (say 100), (y1, x1, y2, x2, class_id, score)] in image coordinates
-            detections = detection_layer(_proposals, mrcnn_class, mrcnn_bbox, windows, self.config)
-
-            # assert detections.sum().data[0] != 0   # update: allow zero detection
-            # Convert boxes to normalized coordinates
-            normalize_boxes = detections[:, :, :4] / scale
-            # Create masks for detections
-            _, _pooled_mask, _ = self.dev_roi(_mrcnn_feature_maps, normalize_boxes)
-            mrcnn_mask = self.mask(_pooled_mask)
-
-            # shape: batch, num_detections, 81, 28, 28
-            mrcnn_mask = mrcnn_mask.view(
-                sample_per_gpu, -1, mrcnn_mask.size(1), mrcnn_mask.size(2), mrcnn_mask.size(3))
-
-            return [detections, mrcnn_mask]
+            return self.detect(_mrcnn_feature_maps, _proposals, input[1], image_shape, amp,
+                               head_outputs=self.config.TEST.CACHE_HEAD_OUTPUTS)
 
         elif mode == 'visualize':
 
-            assert _proposals.sum().data[0] != 0
+            assert _proposals.sum().item() != 0
 
-            _pooled_cls, _, _feat_out_test = self.dev_roi(_mrcnn_feature_maps, _proposals)
+            _pooled_cls, _, _feat_out_test = self.dev_roi(_mrcnn_feature_maps, _proposals, image_shape=image_shape)
 
             if self.config.DEV.STRUCTURE == 'beta':
                 small_output_all, small_gt_all = _feat_out_test
             else:
                 small_output_all, small_gt_all = None, None
 
-            feature, mrcnn_class, mrcnn_bbox = self.classifier(_pooled_cls, small_output_all, small_gt_all)
+            feature, mrcnn_class, mrcnn_bbox = \
+                self._run_head(self.classifier, amp, _pooled_cls, small_output_all, small_gt_all)
 
             # Detections
             # input[1], image_metas, (3, 90), Variable
             _, _, windows, _, _ = parse_image_meta(input[1])
             # output is [batch, num_detections (say 100), (y1, x1, y2, x2, class_id, score)] in image coordinates
             detections, out_feat = detection_layer(_proposals, mrcnn_class, mrcnn_bbox, windows, self.config,
-                                                   feature, small_gt_all)
+                                                   feature, small_gt_all, image_shape=image_shape)
             # NO MASK BRANCH
             return [detections, out_feat]
 
@@ -374,51 +438,52 @@ class MaskRCNN(nn.Module):
 
             # 1. compute RPN targets
             # try:
+            PROFILER.push('rpn_targets')
             target_rpn_match, target_rpn_bbox = \
-                prepare_rpn_target(self.priors, gt_class_ids, gt_boxes, self.config, curr_coco_im_id)
+                prepare_rpn_target(gt_class_ids, gt_boxes, self.config, image_shape, curr_coco_im_id)
+            PROFILER.pop()
             # except RuntimeError:
             #     import pdb
             #     pdb.set_trace()
             #     a = 1
  
-            if self.config.CTRL.PROFILE_ANALYSIS:
-                print('\t[gpu {:d}] pass rpn_target generation'.format(curr_gpu_id))
-
             # 2. compute DET targets
             # _rois shape: bs x TRAIN_ROIS_PER_IMAGE (say 200) x 4; zero padded
             # target_class_ids: bs, 200
             # TODO: roi-pool below
+            PROFILER.push('det_targets')
             _rois, target_class_ids, target_deltas, target_mask = \
                 prepare_det_target(_proposals.detach(), gt_class_ids, gt_boxes / scale, gt_masks, self.config)
-            if self.config.CTRL.PROFILE_ANALYSIS:
-                print('\t[gpu {:d}] pass pass det_target generation'.format(curr_gpu_id))
+            PROFILER.pop()
 
             # 3.0 preview: initialize output
             # big_feat/small_feat shape: gpu_num, scale_num, feat_dim, cls_num; used for meta-loss
             scale_num = 2 if self.config.DEV.STRUCTURE == 'alpha' else 3
             if self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE:
                 scale_num = 4
-            big_feat = Variable(torch.zeros(1, scale_num, 1024, self.config.DATASET.NUM_CLASSES).cuda())
-            big_cnt = Variable(torch.zeros(1, scale_num, 1, self.config.DATASET.NUM_CLASSES).cuda())
-            small_feat = Variable(torch.zeros(1, scale_num, 1024, self.config.DATASET.NUM_CLASSES).cuda())
-            small_cnt = Variable(torch.zeros(1, scale_num, 1, self.config.DATASET.NUM_CLASSES).cuda())
-            big_loss = Variable(torch.zeros(1, scale_num, 1).cuda())
+            big_feat = Variable(to_device(torch.zeros(1, scale_num, 1024, self.config.DATASET.NUM_CLASSES), cuda))
+            big_cnt = Variable(to_device(torch.zeros(1, scale_num, 1, self.config.DATASET.NUM_CLASSES), cuda))
+            small_feat = Variable(to_device(torch.zeros(1, scale_num, 1024, self.config.DATASET.NUM_CLASSES), cuda))
+            small_cnt = Variable(to_device(torch.zeros(1, scale_num, 1, self.config.DATASET.NUM_CLASSES), cuda))
+            big_loss = Variable(to_device(torch.zeros(1, scale_num, 1), cuda))
 
-            small_output_all = Variable(torch.zeros(1, 1024).cuda())
-            small_gt_all = Variable(torch.zeros(1).cuda())
+            small_output_all = Variable(to_device(torch.zeros(1, 1024), cuda))
+            small_gt_all = Variable(to_device(torch.zeros(1), cuda))
 
             num_rois, mask_sz, num_cls = \
                 self.config.ROIS.TRAIN_ROIS_PER_IMAGE, self.config.MRCNN.MASK_SHAPE[0], self.config.DATASET.NUM_CLASSES
-            mrcnn_class_logits = Variable(torch.zeros(sample_per_gpu, num_rois, num_cls).cuda())
-            mrcnn_bbox = Variable(torch.zeros(sample_per_gpu, num_rois, num_cls, 4).cuda())
-            mrcnn_mask = Variable(torch.zeros(sample_per_gpu, num_rois, num_cls, mask_sz, mask_sz).cuda())
+            mrcnn_class_logits = Variable(to_device(torch.zeros(sample_per_gpu, num_rois, num_cls), cuda))
+            mrcnn_bbox = Variable(to_device(torch.zeros(sample_per_gpu, num_rois, num_cls, 4), cuda))
+            mrcnn_mask = Variable(to_device(torch.zeros(sample_per_gpu, num_rois, num_cls, mask_sz, mask_sz), cuda))
 
             # 3. mask and cls generation
-            if torch.sum(_rois).data[0] != 0:
+            if torch.sum(_rois).item() != 0:
                 # COMPUTE META_OUTPUTS HERE
                 # _pooled_cls: 600 (bsx200), 256, 7, 7
+                PROFILER.push('dev_roi')
                 _pooled_cls, _pooled_mask, _feat_out = \
-                    self.dev_roi(_mrcnn_feature_maps, _rois, target_class_ids)
+                    self.dev_roi(_mrcnn_feature_maps, _rois, target_class_ids, image_shape=image_shape)
+                PROFILER.pop()
 
                 if self.config.DEV.SWITCH and not self.config.DEV.BASELINE:
                     if self.config.DEV.STRUCTURE == 'beta':
@@ -435,14 +500,16 @@ class MaskRCNN(nn.Module):
                     #     print('pooled_cls mean: {:.4f}'.format(_pooled_cls.mean().data.cpu()[0]))
                     #     print('pooled_mask mean: {:.4f}'.format(_pooled_mask.mean().data.cpu()[0]))
                 # classifier
+                PROFILER.push('heads')
                 mrcnn_class_logits, _, mrcnn_bbox = \
-                    self.classifier(_pooled_cls, small_output_all, small_gt_all)
+                    self._run_head(self.classifier, amp, _pooled_cls, small_output_all, small_gt_all)
                 # if self.config.CTRL.DEBUG:
                 #     a, b = torch.max(mrcnn_cls_logits, dim=-1)
                 #     print('train classifier, ROIs pred_cls sum: {}'.format(b.sum().data[0]))
 
                 # mask
-                mrcnn_mask = self.mask(_pooled_mask)
+                mrcnn_mask = self._run_head(self.mask, amp, _pooled_mask)
+                PROFILER.pop()
 
                 # reshape output
                 mrcnn_class_logits = mrcnn_class_logits.view(sample_per_gpu, -1, mrcnn_class_logits.size(1))
@@ -450,10 +517,8 @@ class MaskRCNN(nn.Module):
                 mrcnn_mask = mrcnn_mask.view(
                     sample_per_gpu, -1, mrcnn_mask.size(1), mrcnn_mask.size(2), mrcnn_mask.size(3))
 
-            if self.config.CTRL.PROFILE_ANALYSIS:
-                print('\t[gpu {:d}] pass mask and cls generation'.format(curr_gpu_id))
-
             # 4. compute loss
+            PROFILER.push('losses')
             rpn_class_loss = compute_rpn_class_loss(target_rpn_match, rpn_pred_cls_logits)
             rpn_bbox_loss = compute_rpn_bbox_loss(target_rpn_bbox, target_rpn_match, rpn_pred_bbox)
             mrcnn_class_loss = compute_mrcnn_class_loss(target_class_ids, mrcnn_class_logits)
@@ -462,8 +527,7 @@ class MaskRCNN(nn.Module):
 
             loss_merge = torch.stack(
                 (rpn_class_loss, rpn_bbox_loss, mrcnn_class_loss, mrcnn_bbox_loss, mrcnn_mask_loss), dim=1)
-            if self.config.CTRL.PROFILE_ANALYSIS:
-                print('\t[gpu {:d}] pass loss compute!'.format(curr_gpu_id))
+            PROFILER.pop()
 
             # must be Variables
             return loss_merge, \
@@ -7,12 +7,23 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
-from lib.nms.pth_nms import pth_nms
 import numpy as np
+try:
+    from lib.nms.pth_nms import pth_nms
+except ImportError:
+    # extension not built (sh setup.sh); torchvision.ops.nms is used instead
+    pth_nms = None
+
+
+def tv_nms(dets, thresh):
+    """pth_nms with torchvision.ops.nms, on the device of dets [N, (y1, x1, y2, x2, score)];
+    areas without the +1 of pth_nms"""
+    from torchvision.ops import nms as _nms
+    return _nms(dets[:, [1, 0, 3, 2]].contiguous(), dets[:, 4].contiguous(), thresh)
 
 
 def nms(dets, thresh):
-    """Dispatch to either CPU or GPU NMS implementations.
+    """Dispatch to either CPU or GPU NMS implementations (torchvision's without the extension).
     used in both inference (keep_out is 1D) and 'proposal_layer' (keep_out is 2D)
     Args:
         dets:       [bs, N, 4]
@@ -24,7 +35,7 @@ def nms(dets, thresh):
     keep = []
     min_keep_num = 1e10
     for i in range(bs):
-        curr_sample_keep = pth_nms(dets[i, :], thresh)
+        curr_sample_keep = pth_nms(dets[i, :], thresh) if pth_nms is not None else tv_nms(dets[i, :], thresh)
         keep.append(curr_sample_keep)
         if len(curr_sample_keep) < min_keep_num:
             min_keep_num = len(curr_sample_keep)
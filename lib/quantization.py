@@ -0,0 +1,138 @@
+"""Post-training static int8 quantization (eager mode, CPU) of the resnet backbone
+and the FPN lateral/output convs. Heads, RPN and roi layers stay fp32.
+
+    fpn = build_quant_fpn(model)                  # model loaded, on cpu or gpu
+    calibrate(fpn, model, dataset, image_ids)     # observers on minival images
+    fpn = convert(fpn)                            # int8; torch.save(fpn.state_dict(), ...)
+
+see tools/quantize_backbone.py for the calibration / latency / mAP report.
+"""
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.intrinsic import ConvReLU2d
+from torch.quantization import QuantStub, DeQuantStub
+from torch.nn.quantized import FloatFunctional
+from tools.utils import *
+
+
+class QuantBottleneck(nn.Module):
+    """Bottleneck after optimize_for_inference() (bn folded, conv2 pads itself);
+    conv+relu pairs fused and the residual add done by FloatFunctional."""
+    def __init__(self, block):
+        super(QuantBottleneck, self).__init__()
+        self.conv1 = ConvReLU2d(block.conv1, nn.ReLU())
+        self.conv2 = ConvReLU2d(block.conv2, nn.ReLU())
+        self.conv3 = block.conv3
+        self.downsample = block.downsample[0] if block.downsample is not None else None
+        self.skip_add_relu = FloatFunctional()
+
+    def forward(self, x):
+        out = self.conv3(self.conv2(self.conv1(x)))
+        residual = self.downsample(x) if self.downsample is not None else x
+        return self.skip_add_relu.add_relu(out, residual)
+
+
+class QuantFPN(nn.Module):
+    """Same computation as FPN.forward(mode='inference') (no ot loss) on float
+    input [bs, 3, h, w] (mean pixel subtracted); returns [p2, p3, p4, p5, p6] in float."""
+    def __init__(self, fpn):
+        super(QuantFPN, self).__init__()
+        # the SamePad2d before C1's max pool is asymmetric; run it in float
+        self.quant = QuantStub()
+        self.C1_conv = ConvReLU2d(fpn.C1[0], nn.ReLU())
+        self.C1_dequant = DeQuantStub()
+        self.C1_pad = fpn.C1[3]
+        self.C1_quant = QuantStub()
+        self.C1_pool = fpn.C1[4]
+        self.C2 = nn.Sequential(*[QuantBottleneck(block) for block in fpn.C2])
+        self.C3 = nn.Sequential(*[QuantBottleneck(block) for block in fpn.C3])
+        self.C4 = nn.Sequential(*[QuantBottleneck(block) for block in fpn.C4])
+        self.C5 = nn.Sequential(*[QuantBottleneck(block) for block in fpn.C5])
+        self.P5_conv1, self.P5_conv2 = fpn.P5_conv1, fpn.P5_conv2[1]
+        self.P4_conv1, self.P4_conv2 = fpn.P4_conv1, fpn.P4_conv2[1]
+        self.P3_conv1, self.P3_conv2 = fpn.P3_conv1, fpn.P3_conv2[1]
+        self.P2_conv1, self.P2_conv2 = fpn.P2_conv1, fpn.P2_conv2[1]
+        self.P6 = fpn.P6
+        self.P4_add, self.P3_add, self.P2_add = FloatFunctional(), FloatFunctional(), FloatFunctional()
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        x = self.C1_conv(self.quant(x))
+        x = self.C1_pool(self.C1_quant(self.C1_pad(self.C1_dequant(x))))
+        c2_out = self.C2(x)
+        c3_out = self.C3(c2_out)
+        c4_out = self.C4(c3_out)
+        p5_out = self.P5_conv1(self.C5(c4_out))
+        p4_out = self.P4_add.add(self.P4_conv1(c4_out), F.interpolate(p5_out, scale_factor=2, mode='nearest'))
+        p3_out = self.P3_add.add(self.P3_conv1(c3_out), F.interpolate(p4_out, scale_factor=2, mode='nearest'))
+        p2_out = self.P2_add.add(self.P2_conv1(c2_out), F.interpolate(p3_out, scale_factor=2, mode='nearest'))
+        p2_out, p3_out = self.P2_conv2(p2_out), self.P3_conv2(p3_out)
+        p4_out, p5_out = self.P4_conv2(p4_out), self.P5_conv2(p5_out)
+        p6_out = self.P6(p5_out)
+        return [self.dequant(p) for p in [p2_out, p3_out, p4_out, p5_out, p6_out]]
+
+
+class QuantFPNWrapper(nn.Module):
+    """Drop-in for MaskRCNN.fpn at inference: runs the (int8) QuantFPN on cpu and
+    moves the features back to the device of the input."""
+    def __init__(self, quant_fpn):
+        super(QuantFPNWrapper, self).__init__()
+        self.quant_fpn = quant_fpn
+
+    def forward(self, x, mode):
+        assert mode != 'train', 'the quantized backbone is for inference only'
+        device_x = x.data if isinstance(x, Variable) else x
+        feats = self.quant_fpn(device_x.float().cpu())
+        feats = [Variable(f.type_as(device_x), requires_grad=False) for f in feats]
+        ot_loss = Variable(device_x.new(x.size(0), 3).zero_().float())
+        return feats + [ot_loss]
+
+
+def build_quant_fpn(model, backend='fbgemm'):
+    """Float QuantFPN (with observers) from a copy of model.fpn; model is untouched."""
+    if model.config.TRAIN.FPN_OT_LOSS:
+        print_log('[quantization] TRAIN.FPN_OT_LOSS: the ot branch is train-only and dropped',
+                  model.config.MISC.LOG_FILE)
+    fpn = copy.deepcopy(model.fpn).cpu().eval()
+    fpn.optimize_for_inference()
+    quant_fpn = QuantFPN(fpn).eval()
+    torch.backends.quantized.engine = backend
+    quant_fpn.qconfig = torch.quantization.get_default_qconfig(backend)
+    return quant_fpn
+
+
+def prepare(quant_fpn):
+    return torch.quantization.prepare(quant_fpn)
+
+
+def calibrate(quant_fpn, model, dataset, image_ids, batch_size=1):
+    """Run the minival images image_ids (molded by workflow._mold_inputs) through the
+    prepared quant_fpn so that the observers record activation ranges."""
+    from lib.workflow import _mold_inputs
+    with torch.no_grad():
+        for i in range(0, len(image_ids), batch_size):
+            molded_images, _, _, _ = _mold_inputs(model, image_ids[i:i + batch_size], dataset)
+            quant_fpn(mold_cpu_input(model, molded_images))
+    return quant_fpn
+
+
+def convert(quant_fpn):
+    return torch.quantization.convert(quant_fpn.eval())
+
+
+def mold_cpu_input(model, molded_images):
+    """output of _mold_inputs -> float cpu tensor with the mean pixel subtracted"""
+    x = molded_images.data if isinstance(molded_images, Variable) else molded_images
+    x = x.cpu()
+    if model.config.DATA.DEVICE_NORMALIZE:
+        x = model.mold_input.cpu()(x)
+    return x.float()
+
+
+def load_quant_fpn(model, path, backend='fbgemm'):
+    """Rebuild the int8 QuantFPN for model and load a checkpoint saved from convert()."""
+    quant_fpn = convert(prepare(build_quant_fpn(model, backend)))
+    quant_fpn.load_state_dict(torch.load(path))
+    return quant_fpn
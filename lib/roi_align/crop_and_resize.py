@@ -1,6 +1,10 @@
 from torch.autograd import Function
-from ._ext import crop_and_resize as _backend
 import torch
+try:
+    from ._ext import crop_and_resize as _backend
+except ImportError:
+    # extension not built (sh setup.sh); TVCropAndResize is used instead
+    _backend = None
 
 
 # From Mask R-CNN paper: "We sample four regular locations, so
@@ -54,6 +58,35 @@ class CropAndResizeFunction(Function):
         return grad_image, None, None
 
 
+class TVCropAndResize(object):
+    """CropAndResizeFunction with torchvision.ops.roi_align, on the device of the input (autograd
+    through torchvision). The roi of each box is set so that its bin centers are the crop_and_resize
+    sample points: box [y1, x1, y2, x2] normalized, crop row i at y1 * (H - 1) + i * (y2 - y1) *
+    (H - 1) / (crop_height - 1). Samples less than a pixel outside the image are clamped to the border
+    (not extrapolation_value)."""
+    def __init__(self, crop_height, crop_width, extrapolation_value=0):
+        self.crop_height = crop_height
+        self.crop_width = crop_width
+
+    def __call__(self, image, boxes, box_ind):
+        from torchvision.ops import roi_align
+        height, width = image.size(2) - 1, image.size(3) - 1
+        y1, x1, y2, x2 = boxes[:, 0] * height, boxes[:, 1] * width, boxes[:, 2] * height, boxes[:, 3] * width
+        bin_h = (y2 - y1) / max(self.crop_height - 1, 1)
+        bin_w = (x2 - x1) / max(self.crop_width - 1, 1)
+        # aligned=True shifts the roi by -0.5 pixel
+        rois = torch.stack([box_ind.type_as(boxes),
+                            x1 - bin_w / 2 + 0.5, y1 - bin_h / 2 + 0.5,
+                            x1 + bin_w * (self.crop_width - 0.5) + 0.5,
+                            y1 + bin_h * (self.crop_height - 0.5) + 0.5], dim=1)
+        return roi_align(image, rois.detach(), (self.crop_height, self.crop_width),
+                         spatial_scale=1., sampling_ratio=1, aligned=True)
+
+
+if _backend is None:
+    CropAndResizeFunction = TVCropAndResize
+
+
 # class CropAndResize(nn.Module):
 #     """
 #     Crop and resize ported from tensorflow
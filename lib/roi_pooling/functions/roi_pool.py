@@ -1,6 +1,10 @@
 import torch
 from torch.autograd import Function
-from .._ext import roi_pooling
+try:
+    from .._ext import roi_pooling
+except ImportError:
+    # extension not built (sh setup.sh); TVRoIPool is used instead
+    roi_pooling = None
 import pdb
 
 class RoIPoolFunction(Function):
@@ -36,3 +40,20 @@ class RoIPoolFunction(Function):
                                               grad_output, ctx.rois, grad_input, ctx.argmax)
 
         return grad_input, None
+
+
+class TVRoIPool(object):
+    """RoIPoolFunction with torchvision.ops.roi_pool (same rois: [batch_index, x1, y1, x2, y2] in image
+    pixels), on the device of the input"""
+    def __init__(self, pooled_height, pooled_width, spatial_scale):
+        self.pooled_height = pooled_height
+        self.pooled_width = pooled_width
+        self.spatial_scale = spatial_scale
+
+    def __call__(self, features, rois):
+        from torchvision.ops import roi_pool
+        return roi_pool(features, rois, (self.pooled_height, self.pooled_width), self.spatial_scale)
+
+
+if roi_pooling is None:
+    RoIPoolFunction = TVRoIPool
@@ -2,6 +2,7 @@ from lib.layers import pyramid_roi_align
 from lib.roi_align.crop_and_resize import CropAndResizeFunction
 from lib.roi_pooling.functions.roi_pool import RoIPoolFunction
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint, checkpoint_sequential
 from tools.utils import *
 from .OT_module import OptTrans
 
@@ -32,6 +33,117 @@ class SamePad2d(nn.Module):
         return self.__class__.__name__
 
 
+class MoldInput(nn.Module):
+    """Cast uint8 images [bs, 3, h, w] to float and subtract the mean pixel
+    on device (see DATA.DEVICE_NORMALIZE). No parameters/buffers."""
+    def __init__(self, mean_pixel):
+        super(MoldInput, self).__init__()
+        self.mean_pixel = [float(x) for x in mean_pixel]
+
+    def forward(self, input):
+        input = input.float()
+        mean = Variable(input.data.new(self.mean_pixel).view(1, -1, 1, 1), requires_grad=False)
+        return input - mean
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+
+class FrozenBatchNorm2d(nn.Module):
+    """BatchNorm2d with fixed statistics: y = x * scale + shift, where
+    scale = weight / sqrt(running_var + eps) and shift = bias - running_mean * scale.
+    Used in place of nn.BatchNorm2d when TRAIN.BN_LEARN is False (see convert_frozen_bn).
+
+    Same state_dict keys as nn.BatchNorm2d (weight, bias, running_mean, running_var);
+    weight/bias stay Parameters so set_trainable() decides whether they are learned, the
+    statistics are never updated. scale/shift are non-persistent buffers computed at
+    conversion and at every load (_load_from_state_dict); they are recomputed in forward
+    only while weight/bias are trained. Call update_scale_shift() after writing the
+    parameters or statistics in place by other means."""
+    def __init__(self, num_features, eps=1e-5):
+        super(FrozenBatchNorm2d, self).__init__()
+        self.num_features = num_features
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(num_features))
+        self.bias = nn.Parameter(torch.zeros(num_features))
+        self.register_buffer('running_mean', torch.zeros(num_features))
+        self.register_buffer('running_var', torch.ones(num_features))
+        self.register_buffer('scale', torch.ones(num_features), persistent=False)
+        self.register_buffer('shift', torch.zeros(num_features), persistent=False)
+
+    def scale_shift(self):
+        scale = self.weight * torch.rsqrt(Variable(self.running_var) + self.eps)
+        shift = self.bias - Variable(self.running_mean) * scale
+        return scale, shift
+
+    def update_scale_shift(self):
+        with torch.no_grad():
+            scale, shift = self.scale_shift()
+            self.scale.copy_(scale)
+            self.shift.copy_(shift)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super(FrozenBatchNorm2d, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self.update_scale_shift()
+
+    def forward(self, x):
+        if self.weight.requires_grad or self.bias.requires_grad:
+            scale, shift = self.scale_shift()
+        else:
+            scale, shift = self.scale, self.shift
+        return x * scale.view(1, -1, 1, 1).type_as(x) + shift.view(1, -1, 1, 1).type_as(x)
+
+    def __repr__(self):
+        return '{}({}, eps={})'.format(self.__class__.__name__, self.num_features, self.eps)
+
+
+def convert_frozen_bn(module):
+    """Replace every nn.BatchNorm2d in module (recursively) by a FrozenBatchNorm2d
+    carrying over its affine weights and running statistics."""
+    if isinstance(module, nn.BatchNorm2d):
+        frozen = FrozenBatchNorm2d(module.num_features, eps=module.eps)
+        if module.affine:
+            frozen.weight.data.copy_(module.weight.data)
+            frozen.bias.data.copy_(module.bias.data)
+        frozen.running_mean.copy_(module.running_mean)
+        frozen.running_var.copy_(module.running_var)
+        frozen.update_scale_shift()
+        return frozen
+    for name, child in module.named_children():
+        new_child = convert_frozen_bn(child)
+        if new_child is not child:
+            setattr(module, name, new_child)
+    return module
+
+
+def fold_conv_bn(conv, bn):
+    """Fold an (eval-mode or frozen) bn that directly follows conv into conv's
+    weight and bias, in place. Returns the nn.Identity() to put in place of bn."""
+    if isinstance(bn, FrozenBatchNorm2d):
+        scale, shift = [t.data for t in bn.scale_shift()]
+    else:
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            scale = bn.weight.data * scale
+            shift = bn.bias.data + bn.weight.data * shift
+    if conv.bias is None:
+        conv.bias = nn.Parameter(conv.weight.data.new(conv.out_channels).zero_())
+    conv.weight.data.mul_(scale.view(-1, 1, 1, 1))
+    conv.bias.data.mul_(scale).add_(shift)
+    return nn.Identity()
+
+
+def merge_same_pad(conv):
+    """SamePad2d in front of a stride-1 conv with odd kernel pads symmetrically by
+    (k - 1) / 2 on each side; let conv pad instead. Returns the nn.Identity() to put
+    in place of the SamePad2d."""
+    assert conv.stride == (1, 1) and all(k % 2 == 1 for k in conv.kernel_size), \
+        'SamePad2d is only symmetric for stride 1 and odd kernels'
+    conv.padding = tuple((k - 1) // 2 for k in conv.kernel_size)
+    return nn.Identity()
+
+
 ############################################################
 #  Resnet Graph
 ############################################################
@@ -74,6 +186,14 @@ class Bottleneck(nn.Module):
 
         return out
 
+    def optimize_for_inference(self):
+        self.bn1 = fold_conv_bn(self.conv1, self.bn1)
+        self.bn2 = fold_conv_bn(self.conv2, self.bn2)
+        self.bn3 = fold_conv_bn(self.conv3, self.bn3)
+        self.padding2 = merge_same_pad(self.conv2)
+        if self.downsample is not None:
+            self.downsample[1] = fold_conv_bn(self.downsample[0], self.downsample[1])
+
 
 class ResNet(nn.Module):
 
@@ -176,27 +296,31 @@ class FPN(nn.Module):
             nn.Conv2d(self.out_channels, self.out_channels, kernel_size=3, stride=1),
         )
 
+        # see MODEL.GRAD_CHECKPOINT; set by MaskRCNN.set_grad_checkpoint()
+        self.grad_checkpoint = []
+
         if self.config.TRAIN.FPN_OT_LOSS:
             self.ot = True
-            base_size = int(self.config.DATA.IMAGE_SHAPE[0] / 4)
-            self.p2_ot = OptTrans(config, ch_x=256, spatial_x=base_size/2, spatial_y=base_size)
-            self.p3_ot = OptTrans(config, ch_x=256, spatial_x=base_size/4, spatial_y=base_size/2)
-            self.p4_ot = OptTrans(config, ch_x=256, spatial_x=base_size/8, spatial_y=base_size/4)
-            # self.p5_ot = OptTrans(config, ch_x=256, spatial_x=base_size/16, spatial_y=base_size/8)
+            # relative sizes (x is the coarser level, half of y); OptTrans takes the actual output
+            # size from the feature maps in forward(), which follow the input shape (DATA.IMAGE_PADDING)
+            self.p2_ot = OptTrans(config, ch_x=256, spatial_x=2, spatial_y=4)
+            self.p3_ot = OptTrans(config, ch_x=256, spatial_x=2, spatial_y=4)
+            self.p4_ot = OptTrans(config, ch_x=256, spatial_x=2, spatial_y=4)
+            # self.p5_ot = OptTrans(config, ch_x=256, spatial_x=2, spatial_y=4)
         else:
             self.ot = False
 
     def forward(self, x, mode):
         bs = x.size(0)
-        ot_loss = Variable(torch.zeros(bs, 3).cuda())
+        ot_loss = Variable(to_device(torch.zeros(bs, 3), x.is_cuda))
         x = self.C1(x)
-        x = self.C2(x)
+        x = self._run_stage(self.C2, x, 'C2', mode)
         c2_out = x
-        x = self.C3(x)
+        x = self._run_stage(self.C3, x, 'C3', mode)
         c3_out = x
-        x = self.C4(x)
+        x = self._run_stage(self.C4, x, 'C4', mode)
         c4_out = x
-        x = self.C5(x)
+        x = self._run_stage(self.C5, x, 'C5', mode)
         p5_out = self.P5_conv1(x)
 
         if self.ot and mode == 'train':
@@ -211,15 +335,15 @@ class FPN(nn.Module):
             tmp = self.P2_conv1(c2_out)
             ot_loss[:, 2] = self.p2_ot(p3_out, tmp)
             p2_out = tmp + F.upsample(p3_out, scale_factor=2)
-        else:
-            p4_out = self.P4_conv1(c4_out) + F.upsample(p5_out, scale_factor=2)
-            p3_out = self.P3_conv1(c3_out) + F.upsample(p4_out, scale_factor=2)
-            p2_out = self.P2_conv1(c2_out) + F.upsample(p3_out, scale_factor=2)
 
-        p5_out = self.P5_conv2(p5_out)
-        p4_out = self.P4_conv2(p4_out)
-        p3_out = self.P3_conv2(p3_out)
-        p2_out = self.P2_conv2(p2_out)
+            p5_out = self.P5_conv2(p5_out)
+            p4_out = self.P4_conv2(p4_out)
+            p3_out = self.P3_conv2(p3_out)
+            p2_out = self.P2_conv2(p2_out)
+        elif mode == 'train' and 'FPN' in self.grad_checkpoint and p5_out.requires_grad:
+            p2_out, p3_out, p4_out, p5_out = checkpoint(self._top_down, c2_out, c3_out, c4_out, p5_out)
+        else:
+            p2_out, p3_out, p4_out, p5_out = self._top_down(c2_out, c3_out, c4_out, p5_out)
 
         # P6 is used for the 5th anchor scale in RPN. Generated by
         # subsampling from P5 with stride of 2.
@@ -227,6 +351,33 @@ class FPN(nn.Module):
 
         return [p2_out, p3_out, p4_out, p5_out, p6_out, ot_loss]
 
+    def optimize_for_inference(self):
+        """see MaskRCNN.optimize_for_inference(). The SamePad2d before C1's max pool
+        (stride 2) is kept: its padding is not symmetric."""
+        self.C1[1] = fold_conv_bn(self.C1[0], self.C1[1])
+        for stage in [self.C2, self.C3, self.C4, self.C5]:
+            for block in stage:
+                block.optimize_for_inference()
+        for conv2 in [self.P2_conv2, self.P3_conv2, self.P4_conv2, self.P5_conv2]:
+            conv2[0] = merge_same_pad(conv2[1])
+
+    def _top_down(self, c2_out, c3_out, c4_out, p5_out):
+        p4_out = self.P4_conv1(c4_out) + F.upsample(p5_out, scale_factor=2)
+        p3_out = self.P3_conv1(c3_out) + F.upsample(p4_out, scale_factor=2)
+        p2_out = self.P2_conv1(c2_out) + F.upsample(p3_out, scale_factor=2)
+        return self.P2_conv2(p2_out), self.P3_conv2(p3_out), self.P4_conv2(p4_out), self.P5_conv2(p5_out)
+
+    def _run_stage(self, stage, x, name, mode):
+        """resnet stage; checkpointed in sqrt(#blocks) segments if in grad_checkpoint.
+        BN layers run twice in that case (fine when frozen, i.e. TRAIN.BN_LEARN=False)."""
+        if mode != 'train' or name not in self.grad_checkpoint \
+                or not any(p.requires_grad for p in stage.parameters()):
+            return stage(x)
+        if not x.requires_grad:
+            # frozen stages below: checkpoint only back-propagates into the stage if its input requires grad
+            x = x.detach().requires_grad_()
+        return checkpoint_sequential(stage, int(math.ceil(math.sqrt(len(stage)))), x)
+
 
 ############################################################
 #  Region Proposal Network
@@ -379,16 +530,19 @@ class Dev(nn.Module):
             big_ix = (roi_level == -1)
         return big_ix
 
-    def forward(self, x, rois, roi_cls_gt=None):
+    def forward(self, x, rois, roi_cls_gt=None, image_shape=None):
         # x is a multi-scale List containing Variable (feature maps)
         # rois: [bs, 200, 4], normalized, y1, x1, y2, x2
+        # image_shape: [h, w] of the (padded) input batch; DATA.IMAGE_SHAPE if not provided
         base = self.config.ROIS.ASSIGN_ANCHOR_BASE
+        image_shape = self.image_shape if image_shape is None else image_shape
+        cuda = rois.is_cuda
 
         # fixme: roi-pool not below
         if not self.use_dev:
             # in 'layers.py'
-            pooled_out = pyramid_roi_align([rois] + x, self.pool_size, self.image_shape, base=base)
-            mask_out = pyramid_roi_align([rois] + x, self.mask_pool_size, self.image_shape, base=base)
+            pooled_out = pyramid_roi_align([rois] + x, self.pool_size, image_shape, base=base)
+            mask_out = pyramid_roi_align([rois] + x, self.mask_pool_size, image_shape, base=base)
             feat_out = None
 
         # fixme: roi-pool not below
@@ -404,14 +558,14 @@ class Dev(nn.Module):
             # use **either** 'roi_level' or 'accu_small_idx' to assign anchors
             if not self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE:
                 # original plan
-                _image_area = Variable(torch.FloatTensor(
-                    [float(self.image_shape[0]*self.image_shape[1])]), requires_grad=False).cuda()
+                _image_area = to_device(Variable(torch.FloatTensor(
+                    [float(image_shape[0]*image_shape[1])]), requires_grad=False), cuda)
                 roi_level = 4 + log2(torch.sqrt(area)/(base/torch.sqrt(_image_area)))
                 roi_level = roi_level.round().int()
                 # in case batch size =1, we keep that dim
                 roi_level = roi_level.clamp(2, 5).squeeze(dim=-1)   # size: [bs, num_roi], say [3, 200]
             else:
-                accu_small_idx = Variable(torch.ByteTensor(rois.size(0), rois.size(1)).cuda())
+                accu_small_idx = Variable(to_device(torch.ByteTensor(rois.size(0), rois.size(1)), cuda))
                 accu_small_idx[:] = False
 
             # if self.config.CTRL.DEBUG:
@@ -458,11 +612,12 @@ class Dev(nn.Module):
                     #           .format(level, _thres))
                     # if there are no "small" boxes, we won't compute stats of *both* small and big on this scale
                     if _use_upsample and train_phase and not self.config.DEV.BASELINE:
-                        small_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                        small_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                        big_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                        big_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                        big_loss.append(Variable(torch.zeros(1).cuda()))
+                        small_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), cuda)))
+                        small_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs), cuda),
+                                                  requires_grad=False))
+                        big_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), cuda)))
+                        big_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs), cuda), requires_grad=False))
+                        big_loss.append(Variable(to_device(torch.zeros(1), cuda)))
                     continue
 
                 # Decide "big_ix"; deal with 'big' boxes during train
@@ -475,9 +630,10 @@ class Dev(nn.Module):
                     if not big_ix.any():
                         if _use_upsample:
                             # there is no "big" boxes; never mind, we use historic data
-                            big_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                            big_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                            big_loss.append(Variable(torch.zeros(1).cuda()))
+                            big_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), cuda)))
+                            big_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs), cuda),
+                                                    requires_grad=False))
+                            big_loss.append(Variable(to_device(torch.zeros(1), cuda)))
                         big_num = 0
                     else:
                         # process big-small-supervise (big part)
@@ -508,7 +664,7 @@ class Dev(nn.Module):
                             curr_big_loss = F.cross_entropy(big_feat_cls_digits, big_box_gt.long())
                             big_loss.append(curr_big_loss)
                         else:
-                            big_loss.append(Variable(torch.zeros(1).cuda()))
+                            big_loss.append(Variable(to_device(torch.zeros(1), cuda)))
 
                 # "SMALL" boxes (or simply boxes on scale 4,5) exist
                 # small_index: say, 2670 (actual boxes found in this level) x 2
@@ -527,7 +683,7 @@ class Dev(nn.Module):
                 else:
                     _feat_maps = curr_feat_maps
 
-                assert small_boxes.max().data[0] <= 1.0
+                assert small_boxes.max().item() <= 1.0
                 # shape: say 473, 256, 7, 7
                 pooled_features = CropAndResizeFunction(
                     self.pool_size, self.pool_size)(_feat_maps, small_boxes, box_ind)
@@ -582,28 +738,28 @@ class Dev(nn.Module):
             # use **either** 'roi_level' or 'accu_small_idx' to assign anchors
             if not self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE:
                 # original plan
-                _image_area = Variable(torch.FloatTensor(
-                    [float(self.image_shape[0]*self.image_shape[1])]), requires_grad=False).cuda()
+                _image_area = to_device(Variable(torch.FloatTensor(
+                    [float(image_shape[0]*image_shape[1])]), requires_grad=False), cuda)
                 roi_level = 4 + log2(torch.sqrt(area)/(base/torch.sqrt(_image_area)))
                 roi_level = roi_level.round().int()
                 # in case batch size =1, we keep that dim
                 roi_level = roi_level.clamp(2, 5).squeeze(dim=-1)   # size: [bs, num_roi], say [3, 200]
             else:
-                accu_small_idx = Variable(torch.ByteTensor(rois.size(0), rois.size(1)).cuda())
+                accu_small_idx = Variable(to_device(torch.ByteTensor(rois.size(0), rois.size(1)), cuda))
                 accu_small_idx[:] = False
 
             if SHOW_STAT:
                 print('\tassign ROIs (total num: {:d}) in {:d} scales.'
                       'max box area: {:.4f}, min box area: {:.4f}'.format(
-                        total_box, 4, area.max().data[0], area.min().data[0]))
+                        total_box, 4, area.max().item(), area.min().item()))
 
             # Step 2. LOOP through levels and apply ROI pooling to each.
             # P2 to P5, with 2 being the most coarse map
             pooled, mask, box_to_level = [], [], []
             big_feat, big_cnt, small_feat, small_cnt = [], [], [], []   # to generate feat_out
             big_loss = []
-            small_output_all = Variable(torch.zeros(total_box, 1024).cuda())
-            small_gt_all = Variable(torch.zeros(total_box).cuda())
+            small_output_all = Variable(to_device(torch.zeros(total_box, 1024), cuda))
+            small_gt_all = Variable(to_device(torch.zeros(total_box), cuda))
             small_out_cnt = 0
 
             for i, level in enumerate(range(2, 6)):
@@ -639,11 +795,12 @@ class Dev(nn.Module):
                               .format(level, _thres))
                     # if there are no "small" boxes, we won't compute stats of *both* small and big on this scale
                     if _use_meta and train_phase and not self.config.DEV.BASELINE:
-                        small_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                        small_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                        big_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                        big_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                        big_loss.append(Variable(torch.zeros(1).cuda()))
+                        small_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), cuda)))
+                        small_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs), cuda),
+                                                  requires_grad=False))
+                        big_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), cuda)))
+                        big_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs), cuda), requires_grad=False))
+                        big_loss.append(Variable(to_device(torch.zeros(1), cuda)))
                     continue
                 #import pdb 
                 #pdb.set_trace()
@@ -658,9 +815,10 @@ class Dev(nn.Module):
                     if not big_ix.any():
                         if _use_meta:
                             # there is no "big" boxes; never mind, we use historic data
-                            big_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                            big_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                            big_loss.append(Variable(torch.zeros(1).cuda()))
+                            big_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), cuda)))
+                            big_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs), cuda),
+                                                    requires_grad=False))
+                            big_loss.append(Variable(to_device(torch.zeros(1), cuda)))
                         big_num = 0
                         big_no_need = 0
                         big_need = 0
@@ -681,7 +839,7 @@ class Dev(nn.Module):
                             big_feat_pooled = CropAndResizeFunction(
                                 self.feat_pool_size, self.feat_pool_size)(_feat_maps, big_boxes, big_box_ind)
                         elif self.roi_type == 'roi_pool':
-                            new_input = self._make_roi_pool_box_input(big_boxes, big_box_ind)
+                            new_input = self._make_roi_pool_box_input(big_boxes, big_box_ind, image_shape)
                             big_feat_pooled = RoIPoolFunction(
                                 self.feat_pool_size, self.feat_pool_size, self.roi_spatial_scale[i]
                             )(_feat_maps, new_input)
@@ -714,7 +872,7 @@ class Dev(nn.Module):
                             curr_big_loss = F.cross_entropy(big_feat_cls_digits, big_box_gt.long())
                             big_loss.append(curr_big_loss)
                         else:
-                            big_loss.append(Variable(torch.zeros(1).cuda()))
+                            big_loss.append(Variable(to_device(torch.zeros(1), cuda)))
 
                 # "SMALL" boxes (or simply boxes on scale 4,5) exist
                 # small_index: say, 2670 (actual boxes found in this level) x 2
@@ -729,14 +887,14 @@ class Dev(nn.Module):
                 _idx = i if self.config.DEV.MULTI_UPSAMPLER else 0
                 _feat_maps = self.upsample[_idx](curr_feat_maps)
                 # _feat_maps = curr_feat_maps
-                assert small_boxes.max().data[0] <= 1.0
+                assert small_boxes.max().item() <= 1.0
 
                 # pooled_features shape: say 473, 256, 7, 7
                 if self.roi_type == 'roi_align':
                     pooled_features = CropAndResizeFunction(
                         self.pool_size, self.pool_size)(_feat_maps, small_boxes, box_ind)
                 elif self.roi_type == 'roi_pool':
-                    _input = self._make_roi_pool_box_input(small_boxes, box_ind)
+                    _input = self._make_roi_pool_box_input(small_boxes, box_ind, image_shape)
                     pooled_features = RoIPoolFunction(
                         self.pool_size, self.pool_size, self.roi_spatial_scale[i]
                     )(_feat_maps, _input)
@@ -829,14 +987,14 @@ class Dev(nn.Module):
         box_to_level = torch.cat(box_to_level, dim=0)
 
         # Rearrange pooled features to match the order of the original boxes
-        pooled_out = Variable(torch.zeros(
-            rois_size[0], rois_size[1], pooled.size(1), pooled.size(2), pooled.size(3)).cuda())
+        pooled_out = Variable(to_device(torch.zeros(
+            rois_size[0], rois_size[1], pooled.size(1), pooled.size(2), pooled.size(3)), pooled.is_cuda))
         pooled_out[box_to_level[:, 0], box_to_level[:, 1], :, :, :] = pooled
         # 3, 1000, 256, 7, 7 -> 3000, 256, 7, 7
         pooled_out = pooled_out.view(-1, pooled_out.size(2), pooled_out.size(3), pooled_out.size(4))
 
-        mask_out = Variable(torch.zeros(
-            rois_size[0], rois_size[1], mask.size(1), mask.size(2), mask.size(3)).cuda())
+        mask_out = Variable(to_device(torch.zeros(
+            rois_size[0], rois_size[1], mask.size(1), mask.size(2), mask.size(3)), mask.is_cuda))
         mask_out[box_to_level[:, 0], box_to_level[:, 1], :, :, :] = mask
         mask_out = mask_out.view(-1, mask_out.size(2), mask_out.size(3), mask_out.size(4))
 
@@ -851,8 +1009,8 @@ class Dev(nn.Module):
         box_gt, input_feat = input[0], input[1]
         assert box_gt.size(0) == input_feat.size(0)
 
-        feat = Variable(torch.zeros(1024, self.num_classs).cuda())
-        cnt = Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False)
+        feat = Variable(to_device(torch.zeros(1024, self.num_classs), input_feat.is_cuda))
+        cnt = Variable(to_device(torch.zeros(1, self.num_classs), input_feat.is_cuda), requires_grad=False)
 
         for cls_ind in unique1d(box_gt).data:
             if cls_ind == 0:
@@ -864,12 +1022,14 @@ class Dev(nn.Module):
                 feat[:, cls_ind] = torch.mean(input_feat[_idx, :], dim=0)
         return feat, cnt
 
-    def _make_roi_pool_box_input(self, boxes, box_ind):
+    @staticmethod
+    def _make_roi_pool_box_input(boxes, box_ind, image_shape):
         # For each ROI R = [batch_index x1 y1 x2 y2]: max pool over R
-        boxes_new = boxes * float(self.image_shape[0])
-        # boxes *= float(self.image_shape[0])
-        _y1, _x1, _y2, _x2 = boxes_new.chunk(4, dim=1)
-        new_input = torch.stack([box_ind.float().unsqueeze(1), _x1, _y1, _x2, _y2], dim=1).squeeze(dim=-1)
+        # the input is not necessarily square (DATA.IMAGE_PADDING=False)
+        height, width = float(image_shape[0]), float(image_shape[1])
+        _y1, _x1, _y2, _x2 = boxes.chunk(4, dim=1)
+        new_input = torch.stack([box_ind.float().unsqueeze(1),
+                                 _x1 * width, _y1 * height, _x2 * width, _y2 * height], dim=1).squeeze(dim=-1)
         return new_input
 
 
@@ -928,6 +1088,10 @@ class Classifier(nn.Module):
             # for train and inference
             return [mrcnn_class_logits, mrcnn_probs, mrcnn_bbox]
 
+    def optimize_for_inference(self):
+        self.bn1 = fold_conv_bn(self.conv1, self.bn1)
+        self.bn2 = fold_conv_bn(self.conv2, self.bn2)
+
 
 class Mask(nn.Module):
     def __init__(self, depth, num_classes):
@@ -948,8 +1112,15 @@ class Mask(nn.Module):
         self.conv5 = nn.Conv2d(256, num_classes, kernel_size=1, stride=1)
         self.sigmoid = nn.Sigmoid()
         self.relu = nn.ReLU(inplace=True)
+        # see MODEL.GRAD_CHECKPOINT; set by MaskRCNN.set_grad_checkpoint()
+        self.grad_checkpoint = False
 
     def forward(self, x):
+        if self.grad_checkpoint and torch.is_grad_enabled() and x.requires_grad:
+            return checkpoint(self._forward, x)
+        return self._forward(x)
+
+    def _forward(self, x):
         x = self.conv1(self.padding(x))
         x = self.bn1(x)
         x = self.relu(x)
@@ -968,3 +1139,11 @@ class Mask(nn.Module):
         x = self.sigmoid(x)
         # output is 28 x 28; matches the mask_shape
         return x
+
+    def optimize_for_inference(self):
+        # self.padding is shared by conv1-4
+        self.padding = nn.Identity()
+        for i in range(1, 5):
+            conv = getattr(self, 'conv{}'.format(i))
+            merge_same_pad(conv)
+            setattr(self, 'bn{}'.format(i), fold_conv_bn(conv, getattr(self, 'bn{}'.format(i))))
@@ -4,6 +4,9 @@ from datasets.eval.PythonAPI.pycocotools.cocoeval import COCOeval
 from tools.visualize import display_instances
 from tools.image_utils import *
 from tools.utils import *
+from tools.profiler import PROFILER
+from lib.head_cache import pack_head_outputs
+from lib.async_validation import get_async_validator, close_async_validator
 import torch.nn as nn
 from lib.config import LAYER_REGEX, TEMP, CLASS_NAMES
 from tools.tsne.vtsne import VTSNE
@@ -24,7 +27,7 @@ EXAMPLE_COCO_IND = 287305
 def train_model(input_model, train_generator, valset, optimizer, layers, vis=None, coco_api=None):
     """
     Args:
-        input_model:        nn.DataParallel
+        input_model:        nn.DataParallel or nn.parallel.DistributedDataParallel
         train_generator:    Dataloader
         valset:             Dataset
         optimizer:          The learning rate to train with
@@ -42,18 +45,20 @@ def train_model(input_model, train_generator, valset, optimizer, layers, vis=Non
         coco_api:            validation api
     """
     stage_name = layers.upper()
-    if isinstance(input_model, nn.DataParallel):
+    if isinstance(input_model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
         model = input_model.module
     else:
         # single-gpu
         model = input_model
 
     num_train_im = train_generator.dataset.dataset.num_images
-    iter_per_epoch = math.floor(num_train_im/model.config.TRAIN.BATCH_SIZE)
+    # in optimizer steps
+    iter_per_epoch = math.floor(num_train_im/(model.config.TRAIN.BATCH_SIZE*model.config.TRAIN.ACCUM_STEPS))
     total_ep_till_now = sum(model.config.TRAIN.SCHEDULE[:TEMP[layers]])
 
     # check details
-    if (num_train_im % model.config.TRAIN.BATCH_SIZE) % model.config.MISC.GPU_COUNT != 0:
+    # GPU_COUNT = 0: cpu (gloo) run, one model replica
+    if (num_train_im % model.config.TRAIN.BATCH_SIZE) % max(model.config.MISC.GPU_COUNT, 1) != 0:
         print_log('WARNING [TRAIN]: last mini-batch in an epoch is not divisible by gpu number.\n'
                   'total train im: {:d}, batch size: {:d}, gpu num {:d}\n'
                   'last mini-batch size: {:d}\n'.format(
@@ -80,17 +85,24 @@ def train_model(input_model, train_generator, valset, optimizer, layers, vis=Non
         else:
             raise Exception('unknown layer choice')
 
+    # loss scaling for TRAIN.AMP; one scaler per stage
+    scaler = GradScaler() if model.config.TRAIN.AMP else None
+    # resumed checkpoint: optimizer, scaler, rng and sampler position
+    resume_train_state(model, optimizer, scaler, train_generator)
+
     # EPOCH LOOP
     for ep in range(model.epoch, total_ep_till_now+1):
 
         epoch_str = "[Ep {:03d}/{}]".format(ep, total_ep_till_now)
         print_log(epoch_str, model.config.MISC.LOG_FILE)
+        # ResumableBatchSampler/GroupedBatchSampler: reshuffle per epoch
+        train_generator.batch_sampler.set_epoch(ep)
         # Training
         # try:
         loss_data = train_epoch(input_model, train_generator, optimizer,
                                 stage_name=stage_name, epoch_str=epoch_str,
                                 epoch=ep, start_iter=model.iter, total_iter=iter_per_epoch,
-                                valset=valset, coco_api=coco_api, vis=vis)
+                                valset=valset, coco_api=coco_api, vis=vis, scaler=scaler)
         # except Exception:
         #     info_pass = {
         #         'type': 'Keyboard Interrupt',
@@ -108,9 +120,15 @@ def train_model(input_model, train_generator, valset, optimizer, layers, vis=Non
         info_pass = {
             'epoch':        ep,                 # or model.epoch
             'iter':         iter_per_epoch,     # or model.iter
-            'loss_data':    loss_data
+            'loss_data':    loss_data,
+            'optimizer':    optimizer,
+            'scaler':       scaler,
         }
-        save_model(model, **info_pass)
+        model_file = save_model(model, **info_pass)
+        validator = get_async_validator(model.config)
+        if validator is not None and ep < total_ep_till_now and not validator.busy():
+            # the last one is validated at the end of the stage
+            _submit_checkpoint(validator, model.config, ep, iter_per_epoch, model_file, block=False)
 
         # one epoch ends; update iterator
         model.iter = 1
@@ -118,11 +136,33 @@ def train_model(input_model, train_generator, valset, optimizer, layers, vis=Non
 
     # Current stage ends; do validation if possible
     model.epoch += 1
-    # TODO(low): delete redundant model files to save hard-drive space
-    if model.config.TRAIN.DO_VALIDATION:
+    if PROFILER.enabled and PROFILER.step_ind > PROFILER.warmup:
+        # CTRL.PROFILE_STEPS = -1 (or not reached): profile of the stage so far
+        export_profile(model.config)
+    # old checkpoints are pruned by the writer (TRAIN.CKPT_KEEP_LAST etc.)
+    if is_main_process():
+        get_checkpoint_writer(model.config).flush()
+    if model.config.TRAIN.DO_VALIDATION and model.config.TRAIN.ASYNC_VALIDATION:
+        # TRAIN.ASYNC_VALIDATION: reported by train_epoch (or finish_validation) when done
+        validator = get_async_validator(model.config)
+        if validator is not None:
+            print_log('\nSubmit validation of stage [{:s}] (model ep {:d} iter {:d}) to the async worker ...'.
+                      format(stage_name.upper(), total_ep_till_now, iter_per_epoch), model.config.MISC.LOG_FILE)
+            _submit_checkpoint(validator, model.config, ep, iter_per_epoch,
+                               checkpoint_file(model.config, ep, iter_per_epoch))
+    elif model.config.TRAIN.DO_VALIDATION:
         print_log('\nDo validation at end of current stage [{:s}] (model ep {:d} iter {:d}) ...'.
                   format(stage_name.upper(), total_ep_till_now, iter_per_epoch), model.config.MISC.LOG_FILE)
-        test_model(input_model, valset, coco_api, during_train=True, epoch=ep, iter=iter_per_epoch, vis=vis)
+        if model.config.MISC.DISTRIBUTED:
+            # rank 0 alone, without the DDP wrapper (no collective calls in forward)
+            mAP = None
+            if is_main_process():
+                mAP = test_model(model, valset, coco_api, during_train=True, epoch=ep, iter=iter_per_epoch, vis=vis)
+            synchronize()
+        else:
+            mAP = test_model(input_model, valset, coco_api, during_train=True, epoch=ep, iter=iter_per_epoch, vis=vis)
+        if is_main_process():
+            get_checkpoint_writer(model.config).update_best(checkpoint_file(model.config, ep, iter_per_epoch), mAP)
 
 
 def train_epoch(input_model, data_loader, optimizer, **args):
@@ -132,17 +172,21 @@ def train_epoch(input_model, data_loader, optimizer, **args):
         data_loader
         optimizer
     """
-    if isinstance(input_model, nn.DataParallel):
+    if isinstance(input_model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
         model = input_model.module
     else:
         # single-gpu
         model = input_model
     config = model.config
     vis = args['vis']
+    scaler = args.get('scaler', None)
+    validator = get_async_validator(config)
 
     start_iter, total_iter, curr_ep = args['start_iter'], args['total_iter'], args['epoch']
     actual_total_iter = total_iter - start_iter + 1
-    save_iter_base = math.floor(total_iter / config.TRAIN.SAVE_FREQ_WITHIN_EPOCH)
+    # TRAIN.SAVE_FREQ_WITHIN_EPOCH <= 0: no checkpoint here
+    save_iter_base = math.floor(total_iter / config.TRAIN.SAVE_FREQ_WITHIN_EPOCH) \
+        if config.TRAIN.SAVE_FREQ_WITHIN_EPOCH > 0 else None
 
     # create iterator (deprecated)
     # data_iterator = iter(data_loader)
@@ -153,9 +197,25 @@ def train_epoch(input_model, data_loader, optimizer, **args):
         do_meta_after_iter = -1
         SHOW_META_LOSS = False
 
+    # losses are summed on the device and fetched once per CTRL.SHOW_INTERVAL; shown one step
+    # later (the copy overlaps the next step), averaged over the interval
+    metrics = MetricsAccumulator(metric_names(config))
+    loss_data = vis.loss_data if config.MISC.USE_VISDOM else []
+
+    # TRAIN.ACCUM_STEPS micro-batches per optimizer step; iter_ind counts optimizer steps
+    # (lr schedule, show and save frequency); the meta-loss buffer is updated per micro-batch
+    accum_steps = config.TRAIN.ACCUM_STEPS
+
     # ITERATION LOOP
     # for iter_ind in range(start_iter, total_iter+1):
-    for iter_ind, inputs in zip(range(start_iter, total_iter+1), data_loader):
+    t_fetch = time.perf_counter()
+    for micro_ind, inputs in zip(range(actual_total_iter * accum_steps), data_loader):
+        # CTRL.PROFILE_ANALYSIS: time spent waiting for the data loader
+        PROFILER.record('data', t_fetch, time.perf_counter())
+
+        iter_ind = start_iter + micro_ind // accum_steps
+        first_micro = micro_ind % accum_steps == 0
+        last_micro = micro_ind % accum_steps == accum_steps - 1
 
         if config.DEV.SWITCH and not config.DEV.BASELINE:
             if iter_ind > do_meta_after_iter:
@@ -166,14 +226,19 @@ def train_epoch(input_model, data_loader, optimizer, **args):
             else:
                 do_meta = False
 
-        curr_iter_time_start = time.time()
-        lr = adjust_lr(optimizer, curr_ep, iter_ind, config.TRAIN)   # return lr to show in console
+        if first_micro:
+            curr_iter_time_start = time.time()
+            lr = adjust_lr(optimizer, curr_ep, iter_ind, config.TRAIN)   # return lr to show in console
+            optimizer.zero_grad()
 
         # takes super long time!!!
         # (when bs is large, like 32, use iterator costs 27s while use zip takes 0.0x seconds)
         # inputs = next(data_iterator)
-        images = Variable(inputs[0].cuda())
-        image_metas = Variable(inputs[-1].cuda())
+        if config.MISC.GPU_COUNT >= 1:
+            images = Variable(inputs[0].cuda(non_blocking=True))
+            image_metas = Variable(inputs[-1].cuda(non_blocking=True))
+        else:
+            images, image_metas = Variable(inputs[0]), Variable(inputs[-1])
         # print('fetch data time: {:.4f}'.format(time.time() - curr_iter_time_start))
 
         if SEE_ONE_EXAMPLE:
@@ -182,24 +247,22 @@ def train_epoch(input_model, data_loader, optimizer, **args):
             # bs = image_metas.size(0)
             # _list = [image_metas[i][-1].data.cpu()[0] for i in range(bs)]
             # assert EXAMPLE_COCO_IND == image_metas[0][-1].data.cpu()[0]
-            gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(inputs[1], inputs[2], inputs[3])
+            gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(*inputs[1:5])
             merged_loss, big_feat, big_cnt, small_feat, small_cnt, _ = \
                 input_model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')  # DEBUG HERE
         else:
             # pad with zeros
-            gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(inputs[1], inputs[2], inputs[3])
+            gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(*inputs[1:5])
 
-            if config.CTRL.PROFILE_ANALYSIS:
-                print('\ncurr_iter: ', iter_ind)
-                print('fetch data time: {:.4f}'.format(time.time() - curr_iter_time_start))
-                t = time.time()
             try:
                 # FORWARD PASS
                 # the loss shape: gpu_num x 5; meta_loss *NOT* included
+                PROFILER.push('forward')
                 merged_loss, \
                 big_feat, big_cnt, small_feat, small_cnt, big_loss, \
                 small_output_all, small_gt_all, fpn_ot_loss = \
                     input_model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')
+                PROFILER.pop()
             except Exception:
                 info_pass = {
                     'type': 'Runtime Error',
@@ -220,25 +283,29 @@ def train_epoch(input_model, data_loader, optimizer, **args):
                 detailed_loss.data[4] = 0  # mask
 
             # big_feat/small_feat: gpu_num x scale_num x 1024 x 81; also update the buffer
-            if small_feat.sum().data[0] != 0:
-                meta_loss = model.meta_loss([big_feat, big_cnt, small_feat, small_cnt,
-                                             small_output_all, small_gt_all])
-            else:
-                meta_loss = Variable(torch.zeros(1).cuda())
-
-            _meta_loss_value = meta_loss.data.cpu()[0]
-            if _meta_loss_value < 0:
-                # TODO: seriously consider (meta loss < 0) case in KL option
-                print_log('\n** meta_loss: {:.4f}, at iter {:d} epoch {:d}; set to 0 in this case **\n'.format(
-                    _meta_loss_value, iter_ind, curr_ep), config.MISC.LOG_FILE)
-                meta_loss = Variable(torch.zeros(1).cuda())
+            PROFILER.push('meta_loss')
+            # small features in the batch (in any process if MISC.DISTRIBUTED), kept on the device:
+            # meta_loss() runs every step (its buffer update is collective under DDP), leaves the
+            # buffer unchanged and gives a zero loss without them
+            has_small = (small_feat.detach().sum() != 0).float().view(1)
+            if config.MISC.DISTRIBUTED:
+                has_small = all_reduce_sum(has_small)
+            has_small = has_small[0] > 0
+            meta_loss = model.meta_loss([big_feat, big_cnt, small_feat, small_cnt,
+                                         small_output_all, small_gt_all], update=has_small)
+            meta_loss = meta_loss * has_small.float()
+
+            # TODO: seriously consider (meta loss < 0) case in KL option
+            # negative meta_loss is set to 0 (no gradient) on the device; no host sync
+            meta_loss = torch.clamp(meta_loss, min=0)
 
             if do_meta:
                 meta_loss *= config.DEV.LOSS_FAC
             else:
                 # for the very first few iter, we don't compute meta-loss
                 # but rather accumulate the buffer pool
-                meta_loss = Variable(torch.zeros(1).cuda())
+                meta_loss = Variable(to_device(torch.zeros(1), config.MISC.GPU_COUNT >= 1))
+            PROFILER.pop()
         else:
             meta_loss = 0
 
@@ -253,53 +320,90 @@ def train_epoch(input_model, data_loader, optimizer, **args):
         # final loss
         fpn_ot_loss_avg = config.TRAIN.FPN_OT_LOSS_FAC * torch.mean(fpn_ot_loss)
         loss = torch.sum(detailed_loss) + meta_loss + big_loss + fpn_ot_loss_avg
-        if config.CTRL.PROFILE_ANALYSIS:
-            print('forward time: {:.4f}'.format(time.time() - t))
-            t = time.time()
 
-        optimizer.zero_grad()
-        loss.backward()
-        if config.TRAIN.CLIP_GRAD:
-            torch.nn.utils.clip_grad_norm(input_model.parameters(), config.TRAIN.MAX_GRAD_NORM)
-        optimizer.step()
-
-        if config.CTRL.PROFILE_ANALYSIS:
-            print('backward time: {:.4f}'.format(time.time() - t))
-            t = time.time()
+        # gradients of the micro-batches are summed; average them
+        step_loss = loss / accum_steps if accum_steps > 1 else loss
+        PROFILER.push('backward')
+        if scaler is not None:
+            # TRAIN.AMP; gradients are unscaled before clipping; the step is skipped on inf/nan
+            scaler.scale(step_loss).backward()
+        else:
+            step_loss.backward()
+        PROFILER.pop()
+
+        # progress and checkpoints once per optimizer step (losses shown are of the last micro-batch)
+        if not last_micro:
+            t_fetch = time.perf_counter()
+            continue
+
+        PROFILER.push('optimizer')
+        if scaler is not None:
+            if config.TRAIN.CLIP_GRAD:
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(input_model.parameters(), config.TRAIN.MAX_GRAD_NORM)
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            if config.TRAIN.CLIP_GRAD:
+                torch.nn.utils.clip_grad_norm_(input_model.parameters(), config.TRAIN.MAX_GRAD_NORM)
+            optimizer.step()
+        PROFILER.pop()
+        if PROFILER.enabled:
+            # synchronizes; only with CTRL.PROFILE_ANALYSIS
+            PROFILER.step()
+            if PROFILER.finished():
+                export_profile(config)
 
         # Progress
+        # the interval flushed at the previous step is on the host by now
+        ready = metrics.collect()
+        if ready is not None:
+            loss_data = _show_progress(config, vis, *ready)
+
+        values = [loss, detailed_loss]
+        if config.DEV.SWITCH and not config.DEV.BASELINE:
+            values.append(meta_loss)
+        if config.DEV.SWITCH and config.DEV.BIG_SUPERVISE:
+            values.append(big_loss)
+        if config.TRAIN.FPN_OT_LOSS:
+            values.append(fpn_ot_loss_avg)
+        metrics.add(values)
         if iter_ind % config.CTRL.SHOW_INTERVAL == 0 \
                 or iter_ind == args['start_iter'] or iter_ind == total_iter:
             info_pass = {
                 'type': 'Regular',
-                'curr_iter_time_start': curr_iter_time_start,
+                'iter_time': time.time() - curr_iter_time_start,
                 'curr_ep': curr_ep,
                 'iter_ind': iter_ind,
                 'total_iter': total_iter,
-                'meta_loss': meta_loss,
-                'big_loss': big_loss,
-                'loss': loss,
-                'fpn_ot_loss': fpn_ot_loss_avg,
                 'lr': lr,
-                'detailed_loss': detailed_loss,
                 'stage_name': args['stage_name'],
                 'epoch_str': args['epoch_str'],
             }
-            show_loss_terminal(config, **info_pass)
-            if config.MISC.USE_VISDOM:
-                loss_data = vis.plot_loss(**info_pass)
-                vis.show_dynamic_info(**info_pass)
+            metrics.flush(info_pass)
 
         # save model
-        if iter_ind % save_iter_base == 0:
-            if not config.MISC.USE_VISDOM:
-                loss_data = []
+        if save_iter_base is not None and iter_ind % save_iter_base == 0:
             info_pass = {
                 'epoch':        curr_ep,        # or model.epoch
                 'iter':         iter_ind,       # or model.iter
-                'loss_data':    loss_data
+                'loss_data':    loss_data,
+                'optimizer':    optimizer,
+                'scaler':       scaler,
             }
-            save_model(model, **info_pass)
+            model_file = save_model(model, **info_pass)
+        else:
+            model_file = None
+
+        # TRAIN.ASYNC_VALIDATION: report finished jobs; give the worker the fresh checkpoint or,
+        # every ASYNC_VAL_EVERY iterations, the current weights (subset); skipped while it is busy
+        if validator is not None:
+            _report_validation(config, vis, validator.poll())
+            if not validator.busy():
+                if model_file is not None:
+                    _submit_checkpoint(validator, config, curr_ep, iter_ind, model_file, block=False)
+                elif config.TRAIN.ASYNC_VAL_EVERY > 0 and iter_ind % config.TRAIN.ASYNC_VAL_EVERY == 0:
+                    validator.submit(curr_ep, iter_ind, state_dict=model.state_dict(), block=False)
 
         # # for debug; test the model
         # if config.CTRL.DEBUG and iter_ind == (start_iter+2):
@@ -307,10 +411,72 @@ def train_epoch(input_model, data_loader, optimizer, **args):
         #               format(args['stage_name'].upper(), args['epoch'], iter_ind), config.MISC.LOG_FILE)
         #     test_model(input_model, args['valset'], args['coco_api'],
         #                during_train=True, epoch=args['epoch'], iter=iter_ind, vis=vis)
+        t_fetch = time.perf_counter()
 
+    ready = metrics.collect()
+    if ready is not None:
+        loss_data = _show_progress(config, vis, *ready)
     return loss_data
 
 
+def export_profile(config):
+    """write the CTRL.PROFILE_ANALYSIS scopes (percentiles csv, chrome trace) next to the
+    train log and stop profiling"""
+    PROFILER.disable()
+    if not is_main_process():
+        return
+    prefix = os.path.splitext(config.MISC.LOG_FILE)[0].replace('train_log', 'profile')
+    PROFILER.export(prefix + '.csv', prefix + '_trace.json')
+    print_log('\n[profile] {:d} steps after {:d} warm-up\n{:s}\nsaved to {:s}.csv, {:s}_trace.json\n'.format(
+        PROFILER.step_ind - PROFILER.warmup, PROFILER.warmup, PROFILER.format_summary(), prefix, prefix),
+        config.MISC.LOG_FILE)
+
+
+def _submit_checkpoint(validator, config, epoch, iter_ind, model_file, block=True):
+    """TRAIN.ASYNC_VALIDATION on a checkpoint; the writer keeps the file until its result is reported"""
+    writer = get_checkpoint_writer(config)
+    writer.pin(model_file)
+    if not validator.submit(epoch, iter_ind, model_file=model_file, block=block):
+        writer.unpin(model_file)
+
+
+def _report_validation(config, vis, done):
+    """log (and visdom) the finished TRAIN.ASYNC_VALIDATION jobs; full-minival ones count for the best checkpoint"""
+    for result in done:
+        if 'error' in result:
+            print_log('[async validation] {:s} failed: {:s}'.format(result['name'], result['error']),
+                      config.MISC.LOG_FILE)
+            if not result['subset']:
+                get_checkpoint_writer(config).unpin(checkpoint_file(config, result['epoch'], result['iter']))
+            continue
+        print_log('[async validation] {:s}: mAP {:.4f} ({:d} images{:s}, {:.1f}s)'.format(
+            result['name'], result['mAP'], result['images'], ', subset' if result['subset'] else '',
+            result['seconds']), config.MISC.LOG_FILE)
+        if config.MISC.USE_VISDOM:
+            vis.show_mAP(model_file=result['name'], mAP=result['mAP'])
+        if not result['subset']:
+            get_checkpoint_writer(config).update_best(
+                checkpoint_file(config, result['epoch'], result['iter']), result['mAP'])
+
+
+def finish_validation(config, vis=None):
+    """TRAIN.ASYNC_VALIDATION: wait for the pending jobs, report them and stop the worker"""
+    _report_validation(config, vis, close_async_validator())
+
+
+def _show_progress(config, vis, info_pass, metric_values):
+    """terminal/log and visdom progress of train_epoch(); returns the visdom loss_data"""
+    info_pass['metrics'] = metric_values
+    # iter_time was measured when the interval was flushed
+    info_pass['curr_iter_time_start'] = time.time() - info_pass.pop('iter_time')
+    show_loss_terminal(config, **info_pass)
+    if config.MISC.USE_VISDOM:
+        loss_data = vis.plot_loss(**info_pass)
+        vis.show_dynamic_info(**info_pass)
+        return loss_data
+    return []
+
+
 def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
     """
         Test the trained model
@@ -320,8 +486,10 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
             coco_api:       api
             limit:          the number of images to use for evaluation
             image_ids:      a certain image
+        Returns:
+            mAP (bbox) or None if evaluation is skipped
     """
-    if isinstance(input_model, nn.DataParallel):
+    if isinstance(input_model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
         model = input_model.module
     else:
         # single-gpu
@@ -339,7 +507,9 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
         if not os.path.exists(_val_folder):
             os.makedirs(_val_folder)
         det_res_file = os.path.join(_val_folder, 'det_result_{:s}.pth'.format(_model_suffix))
+        head_cache_file = os.path.join(_val_folder, 'head_cache_{:s}.pth'.format(_model_suffix))
         train_log_file = model.config.MISC.LOG_FILE
+        vis_file_name = None
         save_im_folder = os.path.join(_val_folder, _model_suffix)
         if model.config.TEST.SAVE_IM:
             if not os.path.exists(save_im_folder):
@@ -353,12 +523,17 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
 
         log_file = model.config.MISC.LOG_FILE
         det_res_file = model.config.MISC.DET_RESULT_FILE
-
-        vis_res_folder = model.config.MISC.VIS_RESULT_FOLDER
-        _name = 'features_afew.pth' if model.config.TSNE.A_FEW else 'features.pth'
-        # results/meta_105_quick_1_roipool/visualize/vis_result_ep_0013_iter_000619/features.pth
-        vis_file_name = os.path.join(vis_res_folder, _name)
-        vis_res_figure = model.config.TSNE.VIS_RES_FIGURE
+        head_cache_file = os.path.join(model.config.MISC.RESULT_FOLDER, 'head_cache_{:s}.pth'.format(
+            os.path.splitext(model_file_name)[0].replace('mask_rcnn_', '')))
+
+        if mode == 'visualize':
+            vis_res_folder = model.config.MISC.VIS_RESULT_FOLDER
+            _name = 'features_afew.pth' if model.config.TSNE.A_FEW else 'features.pth'
+            # results/meta_105_quick_1_roipool/visualize/vis_result_ep_0013_iter_000619/features.pth
+            vis_file_name = os.path.join(vis_res_folder, _name)
+            vis_res_figure = model.config.TSNE.VIS_RES_FIGURE
+        else:
+            vis_file_name = None
 
         train_log_file = None
         save_im_folder = model.config.MISC.SAVE_IMAGE_DIR if model.config.TEST.SAVE_IM else None
@@ -393,16 +568,19 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
     # inference: extract features, do detections
     if not skip:
         print_log("Running COCO evaluation on {} images.".format(num_test_im), log_file, additional_file=train_log_file)
-        assert (num_test_im % test_bs) % model.config.MISC.GPU_COUNT == 0, \
+        assert (num_test_im % test_bs) % max(model.config.MISC.GPU_COUNT, 1) == 0, \
             '[INFERENCE/VISUALIZE] last mini-batch in an epoch is not divisible by gpu number.'
 
         results, cnt = [], 0
+        # TEST.CACHE_HEAD_OUTPUTS: per-image pre-NMS head outputs (lib/head_cache.py)
+        cache_head = mode == 'inference' and model.config.TEST.CACHE_HEAD_OUTPUTS
+        head_cache = []
         total_iter = math.ceil(num_test_im / test_bs)
         if mode == 'visualize' and model.config.TSNE.A_FEW:
             total_iter = 20
             num_test_im = total_iter * test_bs
 
-        show_test_progress_base = math.floor(total_iter / (model.config.CTRL.SHOW_INTERVAL/2))
+        show_test_progress_base = max(math.floor(total_iter / (model.config.CTRL.SHOW_INTERVAL/2)), 1)
         # note that GPU efficiency is low when SAVE_IM=True
         for iter_ind in range(total_iter):
 
@@ -418,7 +596,19 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
             # FORWARD PASS
             if mode == 'inference':
                 # detections: 8,100,6; mrcnn_mask: 8,100,81,28,28
-                detections, mrcnn_mask = input_model([molded_images, image_metas], mode=mode)
+                outputs = input_model([molded_images, image_metas], mode=mode)
+                detections, mrcnn_mask = outputs[:2]
+                if cache_head:
+                    # proposals: 8,1000,4; mrcnn_class: 8000,81; mrcnn_bbox: 8000,81,4
+                    proposals, mrcnn_class, mrcnn_bbox = outputs[2:]
+                    num_rois = proposals.size(1)
+                    for i in range(len(curr_image_ids)):
+                        entry = pack_head_outputs(proposals[i], mrcnn_class[i*num_rois:(i+1)*num_rois],
+                                                  mrcnn_bbox[i*num_rois:(i+1)*num_rois],
+                                                  model.config.TEST.CACHE_TOPK)
+                        entry.update({'coco_id': coco_image_ids[curr_start_id + i], 'image_shape': images[i].shape,
+                                      'window': windows[i], 'batch_shape': tuple(molded_images.size()[2:])})
+                        head_cache.append(entry)
             elif mode == 'visualize':
                 # out_feat: 8,100,1024
                 detections, out_feat = input_model([molded_images, image_metas], mode=mode)
@@ -432,7 +622,7 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
             # LOOP for each image within this batch
             for i, image in enumerate(images):
 
-                curr_coco_id = coco_image_ids[curr_image_ids[i]]
+                curr_coco_id = coco_image_ids[curr_start_id + i]
                 input_value = mrcnn_mask[i] if mode == 'inference' else out_feat[i]
 
                 final_rois, final_class_ids, final_scores, output_value = _unmold_detections(
@@ -484,26 +674,33 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
         print_log("Prediction time (inference or visualize): {:.4f}. Average {:.4f} sec/image".format(
             t_prediction, t_prediction / num_test_im), log_file, additional_file=train_log_file)
 
-        if mode == 'inference':
+        if mode == 'inference' and det_res_file is not None:
             print_log('Saving results to {:s}'.format(det_res_file), log_file, additional_file=train_log_file)
             torch.save({'det_result': results}, det_res_file)
         elif mode == 'visualize':
             print_log('Saving results to {:s}'.format(vis_file_name), log_file, additional_file=train_log_file)
             torch.save({'feat_result': results}, vis_file_name)
 
+        if cache_head:
+            print_log('Saving head outputs to {:s}'.format(head_cache_file), log_file, additional_file=train_log_file)
+            torch.save({'post_nms_rois': model.config.RPN.POST_NMS_ROIS_INFERENCE,
+                        'topk': model.config.TEST.CACHE_TOPK, 'images': head_cache}, head_cache_file)
+
     # evaluate on COCO
+    mAP = None
     if not model.config.TSNE.SKIP_INFERENCE:
         # Evaluate
         print('\nBegin to evaluate ...')
-        # Load results. This modifies results with additional attributes.
-        coco_results = coco_api.loadRes(results)
-        eval_type = "bbox"
-        coco_eval = COCOeval(coco_api, coco_results, eval_type)
-        coco_eval.params.imgIds = coco_image_ids
-        coco_eval.evaluate()
-        coco_eval.accumulate()
-        coco_eval.summarize(log_file)
-        mAP = coco_eval.stats[0]
+        t_eval = time.time()
+        mAP = evaluate_coco(coco_api, results, coco_image_ids, log_file)
+        print_log('bbox evaluation time: {:.2f}s'.format(time.time() - t_eval), log_file,
+                  additional_file=train_log_file)
+        if mode == 'inference' and model.config.TEST.EVAL_SEGM:
+            # same results; the masks are already RLE-encoded
+            t_eval = time.time()
+            segm_mAP = evaluate_coco(coco_api, results, coco_image_ids, log_file, eval_type="segm")
+            print_log('segm mAP is {:.4f}; segm evaluation time: {:.2f}s'.format(segm_mAP, time.time() - t_eval),
+                      log_file, additional_file=train_log_file)
 
         print_log('Total time: {:.4f}'.format(time.time() - t_start), log_file, additional_file=train_log_file)
         print_log('Config_name [{:s}], model file [{:s}], mAP is {:.4f}\n\n'.
@@ -608,12 +805,15 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
 
         print_log('Done with training tsne; check the folder: {}!'.format(vis_res_figure), log_file)
 
+    return mAP
+
 
-def _mold_inputs(model, image_ids, dataset):
+def _mold_inputs(model, image_ids, dataset, cuda=True):
     """
         FOR EVALUATION ONLY.
         Takes a list of images and modifies them to the format expected as an input to the neural network.
         images: List of image matrices [height,width,depth]. Images can have different sizes.
+        cuda: False to keep molded_images and image_metas as cpu tensors (see tools/eval_checkpoints.py)
 
         Returns 3 Numpy matrices:
             molded_images: [N, h, w, 3]. Images resized and normalized.
@@ -632,8 +832,6 @@ def _mold_inputs(model, image_ids, dataset):
         molded_image, window, scale, padding = resize_image(
             image, min_dim=model.config.DATA.IMAGE_MIN_DIM,
             max_dim=model.config.DATA.IMAGE_MAX_DIM, padding=model.config.DATA.IMAGE_PADDING)
-        molded_image = molded_image.astype(np.float32) - model.config.DATA.MEAN_PIXEL
-
         # Build image_meta
         image_meta = compose_image_meta(0, image.shape, window,
                                         np.zeros([model.config.DATASET.NUM_CLASSES], dtype=np.int32), 0)
@@ -643,19 +841,73 @@ def _mold_inputs(model, image_ids, dataset):
         image_metas.append(image_meta)
         images.append(image)
 
+    if not model.config.DATA.IMAGE_PADDING:
+        # pad the batch to its own max size (bottom and right)
+        h, w = pad_batch_size([x.shape for x in molded_images])
+        molded_images = [np.pad(x, [(0, h - x.shape[0]), (0, w - x.shape[1]), (0, 0)],
+                                mode='constant', constant_values=0) for x in molded_images]
+
     # Pack into arrays
     molded_images = np.stack(molded_images)
+    if not model.config.DATA.DEVICE_NORMALIZE:
+        molded_images = molded_images.astype(np.float32) - model.config.DATA.MEAN_PIXEL
     image_metas = np.stack(image_metas)
     windows = np.stack(windows)
 
     # Convert images to torch tensor
-    molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float()
-    molded_images = Variable(molded_images.cuda(), volatile=True)
-    image_metas = Variable(torch.from_numpy(image_metas).cuda(), volatile=True)
+    molded_images = torch.from_numpy(np.ascontiguousarray(molded_images.transpose(0, 3, 1, 2)))
+    if not model.config.DATA.DEVICE_NORMALIZE:
+        molded_images = molded_images.float()
+    if not cuda:
+        return molded_images, torch.from_numpy(image_metas), windows, images
+    molded_images = Variable(to_device(molded_images, model.config.MISC.GPU_COUNT >= 1), volatile=True)
+    image_metas = Variable(to_device(torch.from_numpy(image_metas), model.config.MISC.GPU_COUNT >= 1), volatile=True)
 
     return molded_images, image_metas, windows, images
 
 
+def evaluate_coco(coco_api, results, coco_image_ids, log_file=None, eval_type="bbox"):
+    """bbox (or segm) mAP of results (COCO format) on coco_image_ids; summary in log_file"""
+    coco_eval = run_cocoeval(coco_api, results, coco_image_ids, log_file, eval_type)
+    return 0. if coco_eval is None else coco_eval.stats[0]
+
+
+def run_cocoeval(coco_api, results, coco_image_ids, log_file=None, eval_type="bbox"):
+    """the COCOeval of results after summarize() (evalImgs kept, see lib/eval_subset.py);
+    None if there is no result"""
+    if len(results) == 0:
+        # loadRes fails on an empty list
+        return None
+    if eval_type == "segm":
+        # without "bbox", loadRes takes area and box from the mask (not from the detection box)
+        results = [{k: res[k] for k in ["image_id", "category_id", "score", "segmentation"]} for res in results]
+    # Load results. This modifies results with additional attributes.
+    coco_results = coco_api.loadRes(results)
+    coco_eval = COCOeval(coco_api, coco_results, eval_type)
+    coco_eval.params.imgIds = coco_image_ids
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize(log_file)
+    return coco_eval
+
+
+def _bbox_results(detections, image_shape, window, coco_id, dataset):
+    """bbox results (COCO format, no segmentation) of the detections [100, 6] of one image"""
+    # no masks: a placeholder "feature" of width zero
+    rois, class_ids, scores, _ = _unmold_detections(
+        detections, np.zeros([detections.shape[0], 0]), image_shape, window, inference=False)
+    results = []
+    for det_id in range(rois.shape[0]):
+        bbox = np.around(rois[det_id], 1)
+        results.append({
+            "image_id":     coco_id,
+            "category_id":  dataset.get_source_class_id(class_ids[det_id], "coco"),
+            "bbox":         [bbox[1], bbox[0], bbox[3] - bbox[1], bbox[2] - bbox[0]],
+            "score":        scores[det_id],
+        })
+    return results
+
+
 def _unmold_detections(detections, input_value, image_shape, window, inference=True):
     """
         FOR EVALUATION ONLY.
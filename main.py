@@ -1,10 +1,12 @@
 import argparse
 from lib.config import CocoConfig
-from lib.workflow import train_model, test_model
+from lib.workflow import train_model, test_model, finish_validation
+from lib.async_validation import async_val_device
 from datasets.dataset_coco import get_data
 from tools.visualize import Visualizer
 from lib.model import MaskRCNN
 from tools.utils import *
+from tools.profiler import PROFILER
 
 if __name__ == '__main__':
 
@@ -38,6 +40,10 @@ if __name__ == '__main__':
     parser.add_argument('--device_id',
                         default='1', type=str)
 
+    # set by torch.distributed.launch (MISC.DISTRIBUTED=True)
+    parser.add_argument('--local_rank',
+                        default=0, type=int)
+
     parser.add_argument('opts',
                         help='See lib/config.py for all options',
                         default=None,
@@ -48,22 +54,29 @@ if __name__ == '__main__':
 
     # Configuration
     config = CocoConfig(args)
-    # Get data
-    train_data, val_data, val_api = get_data(config)
-
+    if config.MISC.DISTRIBUTED:
+        assert args.phase == 'train', 'MISC.DISTRIBUTED is for training only'
+        config = init_distributed(config)
+    if args.phase == 'train' and config.TRAIN.ASYNC_VALIDATION:
+        # fail before building anything if the worker has no gpu of its own
+        async_val_device(config)
     # Create model
     print('building network ...\n')
     model = MaskRCNN(config)
+    if args.phase == 'train' and config.TRAIN.AUTO_BATCH_SIZE:
+        # before get_data(): the loaders use TRAIN.BATCH_SIZE
+        config = find_max_batch_size(model, config)
+
+    # Get data
+    train_data, val_data, val_api = get_data(config)
 
-    # if args.phase == 'train':
-    #     if config.CTRL.DEBUG:
     optimizer = set_optimizer(model, config.TRAIN)
-    # else:
-    #     optimizer, model = check_max_mem(model, train_data, MaskRCNN)
 
     # Select weights file to load (MUST be put at the end)
     # update start epoch and iter if resume
     config, model = update_config_and_load_model(config, model, train_data)
+    if args.phase != 'train' and config.TEST.OPTIMIZE_FOR_INFERENCE:
+        model.optimize_for_inference()
 
     # Visualizer
     vis = Visualizer(config, model, val_data)
@@ -71,7 +84,9 @@ if __name__ == '__main__':
     print_log('print network structure in log file [NOT shown in terminal] ...', config.MISC.LOG_FILE)
     print_log(model, config.MISC.LOG_FILE, quiet_termi=True)
 
-    model = set_model(config.MISC.GPU_COUNT, model)
+    model = set_model(config.MISC.GPU_COUNT, model, distributed=config.MISC.DISTRIBUTED)
+    if args.phase == 'train' and config.CTRL.PROFILE_ANALYSIS:
+        PROFILER.enable(warmup=config.CTRL.PROFILE_WARMUP, num_steps=config.CTRL.PROFILE_STEPS)
     # Train or inference
     if args.phase == 'train':
 
@@ -91,6 +106,8 @@ if __name__ == '__main__':
         print("\nFine tune all layers")
         train_model(model, train_data, val_data,
                     optimizer=optimizer, layers='all', coco_api=val_api, vis=vis)
+        # TRAIN.ASYNC_VALIDATION: the last stage-end validation may still be running
+        finish_validation(config, vis)
 
     elif args.phase == 'inference' or args.phase == 'visualize':
 
@@ -0,0 +1,55 @@
+"""Shared fixtures. Run from the repo root: python -m pytest tests
+(skipped without torch and the repo's requirements)"""
+import copy
+from types import SimpleNamespace
+import pytest
+
+
+@pytest.fixture
+def config(tmp_path):
+    """a Config of its own (the sections are class attributes, shared by all instances)"""
+    pytest.importorskip('torch')
+    from lib.config import Config
+    from tools.collections import AttrDict
+    config = Config()
+    for name in dir(config):
+        if name.isupper() and isinstance(getattr(config, name), AttrDict):
+            setattr(config, name, copy.deepcopy(getattr(config, name)))
+    config.CTRL.PHASE = 'inference'
+    config.CTRL.CONFIG_NAME = 'tests'
+    config.MODEL.INIT_MODEL = 'mask_rcnn_ep_0001_iter_000010.pth'
+    config.MISC.RESULT_FOLDER = str(tmp_path)
+    config.MISC.LOG_FILE = str(tmp_path / 'log.txt')
+    config.MISC.DET_RESULT_FILE = None
+    config.MISC.GPU_COUNT = 0
+    config.MISC.USE_VISDOM = False
+    config.TEST.BATCH_SIZE = 3
+    config.TEST.SAVE_IM = False
+    config.TEST.EVAL_SEGM = False
+    config.TEST.CACHE_HEAD_OUTPUTS = False
+    config.TEST.CACHE_TOPK = 1
+    config.TSNE.SKIP_INFERENCE = False
+    return config
+
+
+@pytest.fixture
+def fake_eval(monkeypatch):
+    """patches lib.workflow for FakeModel; returns the (results, coco_image_ids) passed to evaluate_coco"""
+    workflow = pytest.importorskip('lib.workflow')
+    import fakes
+    calls = []
+
+    def _evaluate_coco(coco_api, results, coco_image_ids, log_file=None, eval_type='bbox'):
+        calls.append((results, coco_image_ids))
+        return 0.5
+
+    monkeypatch.setattr(workflow, '_mold_inputs', fakes.mold_inputs)
+    monkeypatch.setattr(workflow, '_unmold_detections', fakes.unmold_detections)
+    monkeypatch.setattr(workflow, 'evaluate_coco', _evaluate_coco)
+    return calls
+
+
+@pytest.fixture
+def valset():
+    from fakes import FakeDataset
+    return SimpleNamespace(dataset=FakeDataset())
@@ -0,0 +1,63 @@
+"""a small fake minival and network for test_model: the network, the image molding/unmolding
+(and, in conftest.fake_eval, COCOeval) are replaced, so the tests check the bookkeeping
+(image ids, results, caches) on the cpu, without weights or the COCO data
+"""
+import numpy as np
+import torch
+
+NUM_IMAGES = 8
+
+
+class FakeDataset(object):
+    """dataset index i is COCO image 1000 + 7 * i (so an index is never a coco id)"""
+    def __init__(self, num_images=NUM_IMAGES):
+        self.image_ids = np.arange(num_images)
+        self.image_info = [{'id': 1000 + 7 * i, 'width': 32, 'height': 32} for i in range(num_images)]
+
+    def load_image(self, image_id):
+        return np.zeros((32, 32, 3), dtype=np.uint8)
+
+    @staticmethod
+    def get_source_class_id(class_id, source):
+        return int(class_id)
+
+
+class FakeModel(object):
+    """one detection per image, at the image's dataset index as score; records the forward passes"""
+    def __init__(self, config):
+        self.config = config
+        self.batches = []
+        self.state_dict = None
+
+    def load_state_dict(self, state_dict, strict=True):
+        self.state_dict = state_dict
+
+    def __call__(self, input, mode):
+        molded_images, image_metas = input
+        bs = molded_images.size(0)
+        self.batches.append(image_metas[:, 0].tolist())
+        detections = torch.zeros(bs, 1, 6)
+        detections[:, 0, 2:4] = 16
+        detections[:, 0, 4] = 1
+        detections[:, 0, 5] = image_metas[:, 0]
+        mrcnn_mask = torch.zeros(bs, 1, 2, 28, 28)
+        outputs = [detections, mrcnn_mask]
+        if self.config.TEST.CACHE_HEAD_OUTPUTS:
+            num_rois = 4
+            outputs += [torch.zeros(bs, num_rois, 4), torch.rand(bs * num_rois, 2), torch.zeros(bs * num_rois, 2, 4)]
+        return outputs
+
+
+def mold_inputs(model, image_ids, dataset, cuda=True):
+    images = [dataset.load_image(curr_id) for curr_id in image_ids]
+    molded_images = torch.zeros(len(image_ids), 3, 32, 32)
+    # the dataset index in place of the image meta
+    image_metas = torch.FloatTensor([[float(curr_id)] for curr_id in image_ids])
+    windows = np.array([[0, 0, 32, 32]] * len(image_ids))
+    return molded_images, image_metas, windows, images
+
+
+def unmold_detections(detections, input_value, image_shape, window, inference=True):
+    rois = detections[:, :4]
+    masks = np.zeros(image_shape[:2] + (detections.shape[0],), dtype=np.uint8)
+    return rois, detections[:, 4].astype(np.int32), detections[:, 5], masks
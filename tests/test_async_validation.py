@@ -0,0 +1,46 @@
+"""the jobs of the TRAIN.ASYNC_VALIDATION worker (run in the test process, no worker or gpu)"""
+import pytest
+torch = pytest.importorskip('torch')
+async_validation = pytest.importorskip('lib.async_validation')
+from fakes import FakeModel
+
+SUBSET = [1, 3, 4, 6, 7]
+
+
+def _job(model_file=None, state_dict=None):
+    subset = model_file is None
+    return {'name': 'mask_rcnn_ep_0002_iter_000040{:s}.pth'.format('_subset' if subset else ''),
+            'epoch': 2, 'iter': 40, 'subset': subset, 'model_file': model_file, 'state_dict': state_dict}
+
+
+def test_subset_job(config, fake_eval, valset):
+    model = FakeModel(config)
+    state_dict = {'weight': torch.ones(2)}
+    result = async_validation._run_job(model, valset, None, SUBSET, _job(state_dict=state_dict))
+
+    assert 'error' not in result
+    assert isinstance(result['mAP'], float) and result['mAP'] == 0.5
+    assert result['images'] == len(SUBSET)
+    assert model.state_dict is state_dict
+    (_, coco_image_ids), = fake_eval
+    assert coco_image_ids == [valset.dataset.image_info[ind]['id'] for ind in SUBSET]
+
+
+def test_checkpoint_job(config, fake_eval, valset, tmp_path):
+    model_file = str(tmp_path / 'mask_rcnn_ep_0002_iter_000040.pth')
+    torch.save({'state_dict': {'weight': torch.ones(2)}}, model_file)
+    result = async_validation._run_job(FakeModel(config), valset, None, SUBSET, _job(model_file=model_file))
+
+    assert 'error' not in result
+    assert result['mAP'] == 0.5
+    assert result['images'] == len(valset.dataset.image_ids)
+
+
+def test_no_mAP_is_an_error(config, fake_eval, valset):
+    config.TSNE.SKIP_INFERENCE = True
+    result = async_validation._run_job(FakeModel(config), valset, None, SUBSET, _job(state_dict={}))
+
+    assert 'mAP' not in result
+    assert 'no mAP' in result['error']
+    with open(config.MISC.LOG_FILE) as f:
+        assert 'Traceback' in f.read()
@@ -0,0 +1,42 @@
+"""test_model on a subset of minival that is not a prefix of dataset.image_ids"""
+import pytest
+torch = pytest.importorskip('torch')
+workflow = pytest.importorskip('lib.workflow')
+from fakes import FakeModel
+
+SUBSET = [1, 3, 4, 6, 7]
+
+
+def _coco_ids(dataset, image_ids):
+    return [dataset.image_info[ind]['id'] for ind in image_ids]
+
+
+def test_subset_coco_ids(config, fake_eval, valset):
+    model = FakeModel(config)
+    mAP = workflow.test_model(model, valset, None, image_ids=SUBSET, during_train=False, vis=None)
+
+    assert mAP == 0.5
+    assert model.batches == [[1., 3., 4.], [6., 7.]]
+    (results, coco_image_ids), = fake_eval
+    expected = _coco_ids(valset.dataset, SUBSET)
+    assert coco_image_ids == expected
+    # one detection per image, its score is the dataset index
+    assert [r['image_id'] for r in results] == expected
+    assert [int(r['score']) for r in results] == SUBSET
+
+
+def test_subset_head_cache(config, fake_eval, valset, tmp_path):
+    config.TEST.CACHE_HEAD_OUTPUTS = True
+    workflow.test_model(FakeModel(config), valset, None, image_ids=SUBSET, during_train=False, vis=None)
+
+    head_cache = torch.load(str(tmp_path / 'head_cache_ep_0001_iter_000010.pth'))
+    assert [entry['coco_id'] for entry in head_cache['images']] == _coco_ids(valset.dataset, SUBSET)
+
+
+def test_full_minival(config, fake_eval, valset):
+    mAP = workflow.test_model(FakeModel(config), valset, None, during_train=False, vis=None)
+
+    assert mAP == 0.5
+    (results, coco_image_ids), = fake_eval
+    assert coco_image_ids == _coco_ids(valset.dataset, valset.dataset.image_ids)
+    assert len(results) == len(valset.dataset.image_ids)
@@ -0,0 +1,81 @@
+"""fp32 vs. AMP (TRAIN.AMP / TEST.AMP) on the same checkpoint: peak gpu memory and
+time per train step over a few iterations, and minival mAP at inference.
+
+Weights (and the meta-loss buffer) are restored before each run. The mAP reported
+is of the loaded checkpoint; for the final mAP of a full schedule train with
+main.py and TRAIN.AMP True. Run from the repo root:
+
+    python -m tools.amp_compare --config_file configs/105/meta_105_quick_1.yaml --iters 50 --limit 500
+"""
+import argparse
+import copy
+import time
+import torch
+from lib.workflow import train_epoch, test_model
+from datasets.dataset_coco import get_data
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='fp32 vs. AMP')
+parser.add_argument('--config_file', default='configs/105/meta_105_quick_1.yaml')
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--iters', default=50, type=int, help='train iterations per setting')
+parser.add_argument('--limit', default=500, type=int, help='images used for mAP; -1 for all of minival')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'train', 'amp_compare')
+
+
+def _restore():
+    model.load_state_dict(init_state)
+    if has_buffer:
+        model.buffer, model.buffer_cnt = init_buffer.clone(), init_buffer_cnt.clone()
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    # one checkpoint at the end of each short run
+    config.TRAIN.SAVE_FREQ_WITHIN_EPOCH = 1
+    train_data, val_data, val_api = get_data(config)
+
+    model = MaskRCNN(config)
+    config, model = update_config_and_load_model(config, model, train_data)
+    init_state = copy.deepcopy(model.state_dict())
+    has_buffer = config.DEV.SWITCH and not config.DEV.BASELINE
+    if has_buffer:
+        init_buffer, init_buffer_cnt = model.buffer.clone(), model.buffer_cnt.clone()
+    input_model = set_model(config.MISC.GPU_COUNT, model)
+
+    table = []
+    for amp in [False, True]:
+        config.TRAIN.AMP, config.TEST.AMP = amp, amp
+        name = 'amp' if amp else 'fp32'
+
+        # train steps
+        _restore()
+        optimizer = set_optimizer(model, config.TRAIN)
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+        t = time.time()
+        train_epoch(input_model, train_data, optimizer, stage_name=name.upper(), epoch_str=name,
+                    epoch=model.start_epoch, start_iter=1, total_iter=args.iters,
+                    valset=val_data, coco_api=val_api, vis=None, scaler=GradScaler() if amp else None)
+        torch.cuda.synchronize()
+        step_time = (time.time() - t) / args.iters
+        train_mem = torch.cuda.max_memory_allocated() / 1024.**3
+
+        # inference on the loaded checkpoint
+        _restore()
+        config.CTRL.PHASE, config.MISC.DET_RESULT_FILE = 'inference', None
+        torch.cuda.reset_max_memory_allocated()
+        mAP = test_model(input_model, val_data, val_api, limit=args.limit, during_train=False, vis=None)
+        test_mem = torch.cuda.max_memory_allocated() / 1024.**3
+        config.CTRL.PHASE = 'train'
+
+        table.append((name, train_mem, step_time, test_mem, mAP))
+
+    print_log('\n{:>6s} {:>16s} {:>14s} {:>15s} {:>8s}'.format(
+        '', 'train mem (GB)', 's/iter', 'test mem (GB)', 'mAP'), config.MISC.LOG_FILE)
+    for name, train_mem, step_time, test_mem, mAP in table:
+        print_log('{:>6s} {:16.2f} {:14.3f} {:15.2f} {:8.4f}'.format(
+            name, train_mem, step_time, test_mem, mAP), config.MISC.LOG_FILE)
@@ -0,0 +1,410 @@
+"""Micro-benchmarks of the detection layers on synthetic inputs (no dataset or checkpoint).
+
+Each case builds realistic inputs once (image size, anchors, proposal/roi counts from the
+config; COCO-like gt boxes) and times repeated calls after a warm-up. The layers of the
+model (overlaps, targets, proposals, roi align, detection layer) run on --device: cuda
+(default with a gpu) or cpu (MISC.GPU_COUNT = 0; nms/roi_align fall back to torchvision if
+the extensions are not built). Anchors, image/mask resizing, unmold_mask and COCOeval run on cpu.
+
+Results go to a json file (timings in ms, git commit, versions). With --compare, cases
+whose median is slower than the baseline json by more than --threshold are flagged and
+the exit code is 1. Run from the repo root:
+
+    python -m tools.benchmark --out results/benchmark/base.json
+    python -m tools.benchmark --compare results/benchmark/base.json --threshold 0.1
+    python -m tools.benchmark --filter cocoeval,bbox_overlaps --repeat 10 DATA.IMAGE_MAX_DIM 800
+    python -m tools.benchmark --device cpu --filter proposal_layer,detection_layer
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Micro-benchmarks of the detection layers')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', choices=['cuda', 'cpu'],
+                    help='device of the model layer cases')
+parser.add_argument('--filter', default='', help='comma separated substrings of case names to run')
+parser.add_argument('--list', action='store_true', help='list the cases and exit')
+parser.add_argument('--bs', default=2, type=int, help='batch size of the synthetic inputs')
+parser.add_argument('--num_gt', default=15, type=int, help='gt instances per image')
+parser.add_argument('--eval_images', default=100, type=int, help='images in the synthetic COCOeval set')
+parser.add_argument('--repeat', default=20, type=int)
+parser.add_argument('--warmup', default=3, type=int)
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--out', default=None, help='result json; default under MISC.RESULT_FOLDER')
+parser.add_argument('--compare', default=None, help='baseline json to compare against')
+parser.add_argument('--threshold', default=0.1, type=float, help='relative slow-down flagged as a regression')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference', 'benchmark')
+
+# name -> (setup, on --device (else cpu), repeat or None); setup(config, rng) returns the callable to time
+BENCHMARKS = OrderedDict()
+
+
+def register(name, on_device=False, repeat=None):
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, on_device, repeat)
+        return setup
+    return decorator
+
+
+def random_boxes(rng, n, height, width, min_size=8., max_size=None):
+    """[n, (y1, x1, y2, x2)] in pixels; log-uniform sizes as in COCO (many small, few large)"""
+    max_size = max_size or 0.6 * min(height, width)
+    h = np.exp(rng.uniform(np.log(min_size), np.log(max_size), n))
+    w = h * np.exp(rng.uniform(np.log(0.5), np.log(2.), n))
+    w = np.minimum(w, width - 1)
+    y1 = rng.uniform(0, height - h)
+    x1 = rng.uniform(0, width - w)
+    return np.stack([y1, x1, y1 + h, x1 + w], axis=1).astype(np.float32)
+
+
+def jitter_boxes(rng, boxes, n, scale=0.1):
+    """n boxes around randomly picked boxes (for proposals/detections that overlap the gt)"""
+    boxes = boxes[rng.randint(0, boxes.shape[0], n)]
+    hw = np.concatenate([boxes[:, 2:] - boxes[:, :2]] * 2, axis=1)
+    return (boxes + rng.normal(0, scale, boxes.shape) * hw).astype(np.float32)
+
+
+def synthetic_gt(config, rng, bs, num_gt):
+    """gt_class_ids [bs, num_gt], gt_boxes [bs, num_gt, 4] (pixels), gt_masks (mini masks if
+    MRCNN.USE_MINI_MASK) as given to MaskRCNN.forward by adjust_input_gt; Variables on --device"""
+    height, width = config.DATA.IMAGE_SHAPE[:2]
+    mask_shape = tuple(config.MRCNN.MINI_MASK_SHAPE) if config.MRCNN.USE_MINI_MASK else (height, width)
+    class_ids = rng.randint(1, config.DATASET.NUM_CLASSES, (bs, num_gt)).astype(np.float32)
+    boxes = np.stack([random_boxes(rng, num_gt, height, width) for _ in range(bs)])
+    masks = (rng.rand(bs, num_gt, *mask_shape) > 0.3).astype(np.float32)
+    return [_var(x) for x in [class_ids, boxes, masks]]
+
+
+def _var(x):
+    return Variable(to_device(torch.from_numpy(np.ascontiguousarray(x)).float(), args.device == 'cuda'),
+                    requires_grad=False)
+
+
+@register('generate_pyramid_priors')
+def bench_priors(config, rng):
+    from lib.layers import generate_pyramid_priors
+    return lambda: generate_pyramid_priors(
+        config.RPN.ANCHOR_SCALES, config.RPN.ANCHOR_RATIOS, config.MODEL.BACKBONE_SHAPES,
+        config.MODEL.BACKBONE_STRIDES, config.RPN.ANCHOR_STRIDE)
+
+
+@register('bbox_overlaps', on_device=True)
+def bench_bbox_overlaps(config, rng):
+    # anchors vs. the gt of one image, as in generate_target
+    from lib.layers import get_priors
+    from tools.box_utils import bbox_overlaps
+    anchors = Variable(get_priors(config, config.DATA.IMAGE_SHAPE), requires_grad=False)
+    gt_boxes = _var(random_boxes(rng, args.num_gt, *config.DATA.IMAGE_SHAPE[:2]))
+    return lambda: bbox_overlaps(anchors, gt_boxes)
+
+
+@register('prepare_rpn_target', on_device=True)
+def bench_rpn_target(config, rng):
+    from lib.layers import prepare_rpn_target
+    gt_class_ids, gt_boxes, _ = synthetic_gt(config, rng, args.bs, args.num_gt)
+    coco_im_id = Variable(torch.arange(args.bs).float())
+    return lambda: prepare_rpn_target(gt_class_ids, gt_boxes, config, curr_coco_im_id=coco_im_id)
+
+
+@register('proposal_layer', on_device=True)
+def bench_proposal_layer(config, rng):
+    from lib.layers import proposal_layer, get_priors
+    num_anchors = get_priors(config, config.DATA.IMAGE_SHAPE).size(0)
+    logits = rng.normal(0, 2, (args.bs, num_anchors, 2))
+    probs = np.exp(logits) / np.exp(logits).sum(axis=2, keepdims=True)
+    rpn_probs, rpn_bbox = _var(probs), _var(rng.normal(0, 0.5, (args.bs, num_anchors, 4)))
+    return lambda: proposal_layer([rpn_probs, rpn_bbox], proposal_count=config.RPN.POST_NMS_ROIS_TRAINING,
+                                  nms_threshold=config.RPN.NMS_THRESHOLD, config=config)
+
+
+@register('prepare_det_target', on_device=True)
+def bench_det_target(config, rng):
+    from lib.layers import prepare_det_target
+    height, width = config.DATA.IMAGE_SHAPE[:2]
+    gt_class_ids, gt_boxes, gt_masks = synthetic_gt(config, rng, args.bs, args.num_gt)
+    # half of the proposals around the gt (positives), half anywhere
+    num = config.RPN.POST_NMS_ROIS_TRAINING
+    boxes = gt_boxes.data.cpu().numpy()
+    proposals = np.stack([np.concatenate([jitter_boxes(rng, boxes[i], num // 2),
+                                          random_boxes(rng, num - num // 2, height, width)])
+                          for i in range(args.bs)])
+    scale = np.array([height, width, height, width], dtype=np.float32)
+    proposals = _var(np.clip(proposals, 0, height) / scale)
+    gt_boxes = gt_boxes / _var(scale)
+    return lambda: prepare_det_target(proposals, gt_class_ids, gt_boxes, gt_masks, config)
+
+
+@register('pyramid_roi_align', on_device=True)
+def bench_roi_align(config, rng):
+    from lib.layers import pyramid_roi_align
+    height, width = config.DATA.IMAGE_SHAPE[:2]
+    feature_maps = [_var(rng.normal(0, 1, (args.bs, 256, int(h), int(w))))
+                    for h, w in config.MODEL.BACKBONE_SHAPES[:4]]
+    scale = np.array([height, width, height, width], dtype=np.float32)
+    rois = np.stack([random_boxes(rng, config.RPN.POST_NMS_ROIS_INFERENCE, height, width) / scale
+                     for _ in range(args.bs)])
+    rois = _var(rois)
+    return lambda: pyramid_roi_align([rois] + feature_maps, config.MRCNN.POOL_SIZE, config.DATA.IMAGE_SHAPE)
+
+
+@register('detection_layer', on_device=True)
+def bench_detection_layer(config, rng):
+    from lib.layers import detection_layer
+    height, width = config.DATA.IMAGE_SHAPE[:2]
+    num, num_cls = config.RPN.POST_NMS_ROIS_INFERENCE, config.DATASET.NUM_CLASSES
+    scale = np.array([height, width, height, width], dtype=np.float32)
+    rois = np.stack([random_boxes(rng, num, height, width) / scale for _ in range(args.bs)])
+    # peaked class scores so that a realistic share passes TEST.DET_MIN_CONFIDENCE
+    logits = rng.normal(0, 1, (args.bs * num, num_cls))
+    logits[np.arange(args.bs * num), rng.randint(0, num_cls, args.bs * num)] += rng.uniform(0, 8, args.bs * num)
+    probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    deltas = rng.normal(0, 0.5, (args.bs * num, num_cls, 4))
+    windows = np.tile(np.array([[0, 0, height, width]], dtype=np.float32), (args.bs, 1))
+    rois, probs, deltas, windows = [_var(x) for x in [rois, probs, deltas, windows]]
+    return lambda: detection_layer(rois, probs, deltas, windows, config)
+
+
+@register('unmold_mask')
+def bench_unmold_mask(config, rng):
+    # the mask head output of all detections of one image
+    from tools.image_utils import unmold_mask
+    height, width = 480, 640
+    masks = rng.rand(config.TEST.DET_MAX_INSTANCES, *config.MRCNN.MASK_SHAPE).astype(np.float32)
+    boxes = np.round(random_boxes(rng, config.TEST.DET_MAX_INSTANCES, height, width)).astype(np.int32)
+    return lambda: [unmold_mask(m, b, (height, width)) for m, b in zip(masks, boxes)]
+
+
+@register('resize_image')
+def bench_resize_image(config, rng):
+    from tools.image_utils import resize_image
+    image = rng.randint(0, 255, (480, 640, 3)).astype(np.uint8)
+    return lambda: resize_image(image, min_dim=config.DATA.IMAGE_MIN_DIM, max_dim=config.DATA.IMAGE_MAX_DIM,
+                                padding=config.DATA.IMAGE_PADDING)
+
+
+@register('resize_mask')
+def bench_resize_mask(config, rng):
+    from tools.image_utils import resize_image, resize_mask
+    image = rng.randint(0, 255, (480, 640, 3)).astype(np.uint8)
+    mask = (rng.rand(480, 640, args.num_gt) > 0.5).astype(np.uint8)
+    _, _, scale, padding = resize_image(image, min_dim=config.DATA.IMAGE_MIN_DIM,
+                                        max_dim=config.DATA.IMAGE_MAX_DIM, padding=config.DATA.IMAGE_PADDING)
+    return lambda: resize_mask(mask, scale, padding)
+
+
+def synthetic_coco(config, rng, num_images, iou_type):
+    """COCO api of num_images 480x640 images with args.num_gt instances each and a result
+    api with TEST.DET_MAX_INSTANCES detections per image (a third around the gt)"""
+    from datasets.eval.PythonAPI.pycocotools.coco import COCO
+    from datasets.eval.PythonAPI.pycocotools import mask as maskUtils
+    height, width = 480, 640
+
+    def _segm(box):
+        y1, x1, y2, x2 = [float(v) for v in box]
+        if iou_type == 'bbox':
+            return [[x1, y1, x1, y2, x2, y2, x2, y1]]
+        m = np.zeros((height, width, 1), dtype=np.uint8, order='F')
+        m[int(y1):int(np.ceil(y2)), int(x1):int(np.ceil(x2))] = 1
+        rle = maskUtils.encode(m)[0]
+        rle['counts'] = rle['counts'].decode('ascii')
+        return rle
+
+    def _bbox(box):
+        y1, x1, y2, x2 = [float(v) for v in box]
+        return [x1, y1, x2 - x1, y2 - y1]
+
+    images, anns, dets = [], [], []
+    for image_id in range(1, num_images + 1):
+        images.append({'id': image_id, 'height': height, 'width': width})
+        boxes = random_boxes(rng, args.num_gt, height, width)
+        for box in boxes:
+            anns.append({'id': len(anns) + 1, 'image_id': image_id, 'iscrowd': 0,
+                         'category_id': int(rng.randint(1, config.DATASET.NUM_CLASSES)),
+                         'bbox': _bbox(box), 'area': float((box[2] - box[0]) * (box[3] - box[1])),
+                         'segmentation': _segm(box)})
+        num = config.TEST.DET_MAX_INSTANCES
+        det_boxes = np.concatenate([jitter_boxes(rng, boxes, num // 3),
+                                    random_boxes(rng, num - num // 3, height, width)])
+        det_boxes[:, 0::2] = np.clip(det_boxes[:, 0::2], 0, height - 1)
+        det_boxes[:, 1::2] = np.clip(det_boxes[:, 1::2], 0, width - 1)
+        for box in det_boxes:
+            det = {'image_id': image_id, 'category_id': int(rng.randint(1, config.DATASET.NUM_CLASSES)),
+                   'bbox': _bbox(box), 'score': float(rng.rand())}
+            if iou_type == 'segm':
+                det['segmentation'] = _segm(box)
+            dets.append(det)
+
+    coco = COCO()
+    coco.dataset = {'images': images, 'annotations': anns,
+                    'categories': [{'id': i} for i in range(1, config.DATASET.NUM_CLASSES)]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco.createIndex()
+        coco_results = coco.loadRes(dets)
+    return coco, coco_results
+
+
+def _cocoeval(config, rng, iou_type, step):
+    from datasets.eval.PythonAPI.pycocotools.cocoeval import COCOeval
+    coco, coco_results = synthetic_coco(config, rng, args.eval_images, iou_type)
+    coco_eval = COCOeval(coco, coco_results, iou_type)
+
+    def evaluate():
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco_eval.evaluate()
+
+    def accumulate():
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco_eval.accumulate()
+
+    if step == 'evaluate':
+        return evaluate
+    evaluate()
+    return accumulate
+
+
+@register('cocoeval_bbox_evaluate', repeat=5)
+def bench_cocoeval_bbox_evaluate(config, rng):
+    return _cocoeval(config, rng, 'bbox', 'evaluate')
+
+
+@register('cocoeval_bbox_accumulate', repeat=5)
+def bench_cocoeval_bbox_accumulate(config, rng):
+    return _cocoeval(config, rng, 'bbox', 'accumulate')
+
+
+@register('cocoeval_segm_evaluate', repeat=5)
+def bench_cocoeval_segm_evaluate(config, rng):
+    return _cocoeval(config, rng, 'segm', 'evaluate')
+
+
+@register('cocoeval_segm_accumulate', repeat=5)
+def bench_cocoeval_segm_accumulate(config, rng):
+    return _cocoeval(config, rng, 'segm', 'accumulate')
+
+
+def time_case(fn, repeat, warmup, cuda):
+    """durations (ms) of repeat calls of fn after warmup calls"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        if cuda:
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        fn()
+        if cuda:
+            torch.cuda.synchronize()
+        times.append(1000. * (time.perf_counter() - t))
+    return times
+
+
+def run(config, names):
+    results, skipped = OrderedDict(), OrderedDict()
+    for name in names:
+        setup, on_device, repeat = BENCHMARKS[name]
+        device = args.device if on_device else 'cpu'
+        if device == 'cuda' and not torch.cuda.is_available():
+            skipped[name] = 'needs a gpu (or --device cpu)'
+            continue
+        rng = np.random.RandomState(args.seed)
+        try:
+            fn = setup(config, rng)
+        except ImportError as e:
+            # e.g. neither the nms/roi_align extensions nor torchvision
+            skipped[name] = 'import error: {}'.format(e)
+            continue
+        times = np.array(time_case(fn, repeat or args.repeat, args.warmup, device == 'cuda'))
+        results[name] = {'median_ms': float(np.median(times)), 'mean_ms': float(times.mean()),
+                         'min_ms': float(times.min()), 'max_ms': float(times.max()),
+                         'repeat': len(times), 'device': device}
+        print_log('{:<28s} {:10.3f} ms (median of {:d}, min {:.3f}; {:s})'.format(
+            name, results[name]['median_ms'], len(times), results[name]['min_ms'], device), config.MISC.LOG_FILE)
+    for name, reason in skipped.items():
+        print_log('{:<28s} skipped ({:s})'.format(name, reason), config.MISC.LOG_FILE)
+    return results, skipped
+
+
+def meta_info(config):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'git': commit,
+            'torch': torch.__version__, 'numpy': np.__version__,
+            'gpu': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+            'device': args.device, 'image_shape': [int(x) for x in config.DATA.IMAGE_SHAPE], 'bs': args.bs,
+            'num_gt': args.num_gt, 'eval_images': args.eval_images, 'opts': args.opts}
+
+
+def compare(results, baseline_file, threshold, log_file):
+    """print current vs. baseline medians; return the names slower by more than threshold"""
+    with open(baseline_file) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    print_log('\ncompared to {:s} (threshold {:.0f}%)'.format(baseline_file, 100 * threshold), log_file)
+    print_log('{:<28s} {:>12s} {:>12s} {:>8s}'.format('case', 'base ms', 'curr ms', 'ratio'), log_file)
+    for name, res in results.items():
+        if name not in baseline or baseline[name].get('device', res['device']) != res['device']:
+            # not in the baseline, or timed on another device
+            print_log('{:<28s} {:>12s} {:12.3f}'.format(name, '-', res['median_ms']), log_file)
+            continue
+        base = baseline[name]['median_ms']
+        ratio = res['median_ms'] / max(base, 1e-9)
+        flag = ''
+        if ratio > 1. + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1. / (1. + threshold):
+            flag = '  faster'
+        print_log('{:<28s} {:12.3f} {:12.3f} {:8.2f}{:s}'.format(name, base, res['median_ms'], ratio, flag),
+                  log_file)
+    return regressions
+
+
+if __name__ == '__main__':
+    if args.list:
+        for name, (_, on_device, _) in BENCHMARKS.items():
+            print('{:<28s} {:s}'.format(name, args.device if on_device else 'cpu'))
+        sys.exit(0)
+
+    config = tool_config(args)
+    if args.device == 'cpu':
+        # the layers allocate on the cpu
+        config.MISC.GPU_COUNT = 0
+    config.MISC.LOG_FILE = os.path.join(config.MISC.RESULT_FOLDER, 'benchmark_log.txt')
+    patterns = [p for p in args.filter.split(',') if p]
+    names = [name for name in BENCHMARKS if not patterns or any(p in name for p in patterns)]
+    if len(names) == 0:
+        raise Exception('no benchmark matches --filter {:s}'.format(args.filter))
+
+    print_log('\n[benchmark] {:d} cases, image shape {}, bs {:d}, device {:s}\n'.format(
+        len(names), config.DATA.IMAGE_SHAPE[:2], args.bs, args.device), config.MISC.LOG_FILE)
+    results, skipped = run(config, names)
+
+    out_file = args.out or os.path.join(config.MISC.RESULT_FOLDER,
+                                        'benchmark_{:s}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    mkdir_if_missing(os.path.dirname(os.path.abspath(out_file)))
+    with open(out_file, 'w') as f:
+        json.dump({'meta': meta_info(config), 'results': results, 'skipped': skipped}, f, indent=2)
+    print_log('\n[benchmark] results saved to {:s}'.format(out_file), config.MISC.LOG_FILE)
+
+    if args.compare is not None:
+        regressions = compare(results, args.compare, args.threshold, config.MISC.LOG_FILE)
+        if len(regressions) > 0:
+            print_log('\n{:d} regression(s): {:s}'.format(len(regressions), ', '.join(regressions)),
+                      config.MISC.LOG_FILE)
+            sys.exit(1)
@@ -1,9 +1,11 @@
 import numpy as np
 import torch
 from torch.autograd import Variable
+from tools.utils import fp32_op
 EPS = 10e-20
 
 
+@fp32_op
 def apply_box_deltas(boxes, deltas):
     """Applies the given deltas to the given boxes.
     Args:
@@ -38,22 +40,24 @@ def clip_boxes(boxes, window):
     if window.dim() == 1:
         # for training
         boxes_out = torch.stack([
-            boxes[:, :, 0].clamp(window[0].data[0], window[2].data[0]),
-            boxes[:, :, 1].clamp(window[1].data[0], window[3].data[0]),
-            boxes[:, :, 2].clamp(window[0].data[0], window[2].data[0]),
-            boxes[:, :, 3].clamp(window[1].data[0], window[3].data[0])
+            boxes[:, :, 0].clamp(window[0].item(), window[2].item()),
+            boxes[:, :, 1].clamp(window[1].item(), window[3].item()),
+            boxes[:, :, 2].clamp(window[0].item(), window[2].item()),
+            boxes[:, :, 3].clamp(window[1].item(), window[3].item())
         ], 2)
     elif window.dim() == 2:
         # for inference, batch size sensitive
         bs = window.size(0)
         boxes = boxes.view(bs, -1, 4)
-        boxes_out = Variable(torch.zeros(boxes.size()).cuda())
+        boxes_out = Variable(torch.zeros(boxes.size()))
+        if boxes.is_cuda:
+            boxes_out = boxes_out.cuda()
         for i in range(bs):
             boxes_out[i] = torch.stack([
-                boxes[i, :, 0].clamp(window[i, 0].data[0], window[i, 2].data[0]),
-                boxes[i, :, 1].clamp(window[i, 1].data[0], window[i, 3].data[0]),
-                boxes[i, :, 2].clamp(window[i, 0].data[0], window[i, 2].data[0]),
-                boxes[i, :, 3].clamp(window[i, 1].data[0], window[i, 3].data[0])
+                boxes[i, :, 0].clamp(window[i, 0].item(), window[i, 2].item()),
+                boxes[i, :, 1].clamp(window[i, 1].item(), window[i, 3].item()),
+                boxes[i, :, 2].clamp(window[i, 0].item(), window[i, 2].item()),
+                boxes[i, :, 3].clamp(window[i, 1].item(), window[i, 3].item())
             ], 1)
         boxes_out = boxes_out.view(-1, 4)
 
@@ -86,6 +90,7 @@ def extract_bboxes(mask):
     return boxes.astype(np.int32)
 
 
+@fp32_op
 def box_refinement(box, gt_box):
     """Compute refinement needed to transform box to gt_box.
     box and gt_box are [N, (y1, x1, y2, x2)]
@@ -110,6 +115,7 @@ def box_refinement(box, gt_box):
     return result
 
 
+@fp32_op
 def compute_iou(boxes1, boxes2):
     # 1. Tile boxes2 and repeat boxes1. This allows us to compare
     # every boxes1 against every boxes2 without loops.
@@ -186,8 +192,9 @@ def bbox_overlaps(boxes1, boxes2):
     assert boxes1.dim() == boxes2.dim()
     if boxes1.dim() == 3:
         # has bs dim
-        overlaps = Variable(torch.zeros(boxes1.size(0), boxes1.size(1), boxes2.size(1)).cuda(),
-                            requires_grad=False)
+        overlaps = Variable(torch.zeros(boxes1.size(0), boxes1.size(1), boxes2.size(1)), requires_grad=False)
+        if boxes1.is_cuda:
+            overlaps = overlaps.cuda()
         for i in range(boxes1.size(0)):
             overlaps[i] = compute_iou(boxes1[i], boxes2[i])
     else:
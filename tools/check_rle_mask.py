@@ -0,0 +1,70 @@
+"""Compare the RLE mini-mask path (MRCNN.RLE_MASK) against the original
+decode -> resize -> crop path on minival.
+
+Both mini-masks are pasted back into the resized image with their own boxes
+(utils.expand_mask) and compared by mask IoU. Run from the repo root:
+
+    python -m tools.check_rle_mask --num_images 500
+"""
+import argparse
+import time
+import numpy as np
+from datasets.dataset_coco import Dataset
+import tools.image_utils as utils
+from tools.utils import parse_tool_args, tool_config
+
+
+parser = argparse.ArgumentParser(description='Check RLE mini-mask path')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--num_images', default=200, type=int)
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference', 'check_rle_mask')
+args.device_id = '0'
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    config.MRCNN.USE_MINI_MASK = True
+
+    dataset = Dataset()
+    dataset.load_coco(config.DATASET.PATH, "minival", year=config.DATASET.YEAR)
+    dataset.prepare()
+
+    image_ids = dataset.image_ids[:args.num_images]
+    ious, box_offset = [], []
+    t_old, t_new = 0., 0.
+    for image_id in image_ids:
+
+        config.MRCNN.RLE_MASK = False
+        t = time.time()
+        image, _, class_old, bbox_old, mini_old = utils.load_image_and_gt(
+            dataset, config, image_id, augment=False, use_mini_mask=True)
+        t_old += time.time() - t
+
+        config.MRCNN.RLE_MASK = True
+        t = time.time()
+        _, _, class_new, bbox_new, mini_new = utils.load_image_and_gt(
+            dataset, config, image_id, augment=False, use_mini_mask=True)
+        t_new += time.time() - t
+
+        assert np.array_equal(class_old, class_new), 'instance mismatch on image {}'.format(image_id)
+        if len(class_old) == 0:
+            continue
+        box_offset.append(np.abs(bbox_old - bbox_new).max())
+
+        full_old = utils.expand_mask(bbox_old, mini_old, image.shape)
+        full_new = utils.expand_mask(bbox_new, mini_new, image.shape)
+        for i in range(full_old.shape[-1]):
+            union = np.logical_or(full_old[:, :, i], full_new[:, :, i]).sum()
+            if union == 0:
+                continue
+            inter = np.logical_and(full_old[:, :, i], full_new[:, :, i]).sum()
+            ious.append(inter / union)
+
+    ious = np.array(ious)
+    print('images: {:d}, instances: {:d}'.format(len(image_ids), len(ious)))
+    print('mask IoU (rle vs. full path): mean {:.4f}, median {:.4f}, min {:.4f}, <0.9: {:.2f}%'.format(
+        ious.mean(), np.median(ious), ious.min(), 100. * (ious < .9).mean()))
+    print('max box offset (pixels): {:d}'.format(int(max(box_offset))))
+    print('time per image: full path {:.4f}s, rle path {:.4f}s'.format(
+        t_old / len(image_ids), t_new / len(image_ids)))
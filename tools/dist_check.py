@@ -0,0 +1,82 @@
+"""CPU check of the distributed training pieces with the gloo backend:
+all_reduce_sum, the meta-loss buffer merge (MaskRCNN._merge_feat_vec), the
+GroupedBatchSampler split and the DDP gradient average. Run from the repo root:
+
+    python -m tools.dist_check --world_size 4
+"""
+import argparse
+from types import SimpleNamespace
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.autograd import Variable
+from lib.model import MaskRCNN
+from datasets.dataset_coco import GroupedBatchSampler
+from tools.utils import all_reduce_sum, get_rank, get_world_size, set_model
+
+
+parser = argparse.ArgumentParser(description='Check distributed helpers on cpu (gloo)')
+parser.add_argument('--world_size', default=2, type=int)
+parser.add_argument('--port', default=29501, type=int)
+args = parser.parse_args()
+
+
+class _FakeDataset(object):
+    """only what GroupedBatchSampler reads"""
+    def __init__(self, num_images, seed=0):
+        rng = np.random.RandomState(seed)
+        self.dataset = SimpleNamespace(image_info=[
+            {'width': int(w), 'height': int(h)} for w, h in rng.randint(200, 800, size=(num_images, 2))])
+
+
+def _check(rank, world_size, port):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{:d}'.format(port),
+                            rank=rank, world_size=world_size)
+    assert get_rank() == rank and get_world_size() == world_size
+
+    # 1. all_reduce_sum
+    x = all_reduce_sum(torch.FloatTensor([rank + 1.]))
+    assert x[0] == world_size * (world_size + 1) / 2, x
+
+    # 2. buffer merge: every process sees the merge over all processes
+    rng = np.random.RandomState(0)
+    feat = torch.from_numpy(rng.rand(world_size, 4, 1024, 81).astype(np.float32))
+    cnt = torch.from_numpy(rng.randint(0, 3, size=(world_size, 4, 1, 81)).astype(np.float32))
+    local_feat, local_cnt = MaskRCNN._merge_feat_vec(
+        Variable(feat[rank:rank+1]), Variable(cnt[rank:rank+1]), reduce=True)
+    ref_feat, ref_cnt = MaskRCNN._merge_feat_vec(Variable(feat), Variable(cnt))
+    assert torch.equal(local_cnt.data, ref_cnt.data)
+    assert (local_feat.data - ref_feat.data).abs().max() < 1e-4
+
+    # 3. GroupedBatchSampler: disjoint, same number of iterations per process
+    batch_size = 2
+    sampler = GroupedBatchSampler(_FakeDataset(101), batch_size, num_replicas=world_size, rank=rank)
+    sampler.set_epoch(3)
+    batches = list(sampler)
+    num = all_reduce_sum(torch.LongTensor([len(batches)]))[0]
+    assert num == world_size * len(batches), 'processes run a different number of iterations'
+    seen = torch.zeros(101).long()
+    for batch in batches:
+        seen[torch.LongTensor(batch)] += 1
+    all_reduce_sum(seen)
+    assert seen.max() == 1, 'an image is shared by two processes'
+
+    # 4. DDP: gradients are averaged over processes
+    torch.manual_seed(0)
+    model = set_model(0, nn.Linear(8, 2), distributed=True)
+    loss = model(Variable(torch.ones(4, 8) * (rank + 1))).sum()
+    loss.backward()
+    grad = model.module.weight.grad.data.clone()
+    ref = grad.clone()
+    dist.broadcast(ref, 0)
+    assert torch.equal(grad, ref), 'gradients differ across processes'
+
+    if rank == 0:
+        print('[world_size {:d}] all checks passed'.format(world_size))
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    mp.spawn(_check, args=(args.world_size, args.port), nprocs=args.world_size)
@@ -0,0 +1,148 @@
+"""End-to-end throughput (images/sec): get_data -> train_epoch -> test_model.
+
+Meant to be run on the synthetic tree of tools/make_synthetic_coco.py (DATASET.PATH), so
+no COCO download is needed. Stages:
+    data_train      the train DataLoader (load_image_and_gt, augmentation, collate, workers)
+    data_test       the host part of the minival input path (load_image + resize_image)
+    train           train_epoch over --train_iters steps (after --warmup steps)    [--device]
+    inference       test_model over --limit minival images, incl. COCOeval          [--device]
+The model runs on --device: cuda (default with a gpu) or cpu (MISC.GPU_COUNT = 0; nms/roi_align
+fall back to torchvision if the extensions are not built; no TRAIN.AMP). With --data_only only
+the two data stages run. Results are printed and saved as json. Run from the repo root:
+
+    python -m tools.make_synthetic_coco --root datasets/coco
+    python -m tools.e2e_benchmark --config_file configs/105/meta_105_quick_1.yaml --train_iters 20
+    python -m tools.e2e_benchmark --config_file configs/105/meta_105_quick_1.yaml --device cpu --train_iters 2
+The model is randomly initialized unless --weights is given; no checkpoint is written.
+"""
+import argparse
+import json
+import os
+import time
+import torch
+from collections import OrderedDict
+from lib.config import LAYER_REGEX
+from lib.workflow import train_epoch, test_model
+from datasets.dataset_coco import get_data
+from lib.model import MaskRCNN
+from tools.image_utils import resize_image
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='End-to-end throughput benchmark')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', choices=['cuda', 'cpu'],
+                    help='device of the train and inference stages')
+parser.add_argument('--train_iters', default=20, type=int, help='optimizer steps timed in train_epoch')
+parser.add_argument('--data_batches', default=50, type=int, help='batches timed from the train DataLoader')
+parser.add_argument('--warmup', default=3, type=int, help='steps/batches before timing')
+parser.add_argument('--limit', default=50, type=int, help='minival images for the inference stage')
+parser.add_argument('--layers', default='all', help='stage of LAYER_REGEX to train')
+parser.add_argument('--weights', default=None, help='checkpoint to start from; random init if not given')
+parser.add_argument('--data_only', action='store_true', help='skip the train and inference stages')
+parser.add_argument('--out', default=None, help='result json; default under MISC.RESULT_FOLDER')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'train', 'e2e_benchmark')
+
+
+def _sync():
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def _report(stats, name, num_im, seconds, log_file):
+    stats[name] = {'images': num_im, 'seconds': seconds, 'images_per_sec': num_im / max(seconds, 1e-9)}
+    print_log('[e2e] {:<12s} {:6d} images {:9.2f} s {:9.2f} images/s'.format(
+        name, num_im, seconds, stats[name]['images_per_sec']), log_file)
+
+
+def bench_data(config, train_data, dataset, stats):
+    # train DataLoader
+    num_im, t = 0, time.perf_counter()
+    for i, inputs in zip(range(args.warmup + args.data_batches), train_data):
+        if i == args.warmup:
+            t = time.perf_counter()
+        elif i > args.warmup:
+            num_im += inputs[0].size(0)
+    _report(stats, 'data_train', num_im, time.perf_counter() - t, config.MISC.LOG_FILE)
+
+    # minival input path on the host (the device copy of _mold_inputs excluded)
+    image_ids = dataset.image_ids[:args.limit]
+    t = time.perf_counter()
+    for curr_id in image_ids:
+        resize_image(dataset.load_image(curr_id), min_dim=config.DATA.IMAGE_MIN_DIM,
+                     max_dim=config.DATA.IMAGE_MAX_DIM, padding=config.DATA.IMAGE_PADDING)
+    _report(stats, 'data_test', len(image_ids), time.perf_counter() - t, config.MISC.LOG_FILE)
+
+
+def bench_model(config, train_data, val_data, val_api, stats):
+    # throughput does not depend on the weights: random init unless --weights
+    model = MaskRCNN(config)
+    if args.weights is not None:
+        checkpoints = torch.load(args.weights, map_location=lambda storage, loc: storage)
+        model.load_state_dict(checkpoints.get('state_dict', checkpoints), strict=False)
+    config.MODEL.INIT_MODEL = args.weights or 'random_init'
+    if config.DEV.SWITCH and not config.DEV.BASELINE:
+        model.initialize_buffer(config.MISC.LOG_FILE)
+    optimizer = set_optimizer(model, config.TRAIN)
+    model.set_trainable(LAYER_REGEX[args.layers], config.MISC.LOG_FILE)
+    model = set_model(config.MISC.GPU_COUNT, model)
+    scaler = GradScaler() if config.TRAIN.AMP else None
+    # no checkpoint is written
+    config.TRAIN.SAVE_FREQ_WITHIN_EPOCH = 0
+
+    def _train(iters):
+        # epoch > 1: the meta-loss (if any) is on from the first step, as in steady-state training
+        train_epoch(model, train_data, optimizer, stage_name='e2e', epoch_str='[e2e]', epoch=2,
+                    start_iter=1, total_iter=iters, valset=val_data, coco_api=val_api, vis=None, scaler=scaler)
+
+    if args.warmup > 0:
+        _train(args.warmup)
+    _sync()
+    t = time.perf_counter()
+    _train(args.train_iters)
+    _sync()
+    _report(stats, 'train', args.train_iters * config.TRAIN.BATCH_SIZE * config.TRAIN.ACCUM_STEPS,
+            time.perf_counter() - t, config.MISC.LOG_FILE)
+
+    # test_model takes its mode from CTRL.PHASE; no det_result caching
+    config.CTRL.PHASE = 'inference'
+    config.MISC.DET_RESULT_FILE = None
+    num_im = len(val_data.dataset.image_ids[:args.limit])
+    t = time.perf_counter()
+    mAP = test_model(model, val_data, val_api, limit=args.limit, during_train=False, vis=None)
+    _sync()
+    _report(stats, 'inference', num_im, time.perf_counter() - t, config.MISC.LOG_FILE)
+    stats['inference']['mAP'] = mAP
+
+
+if __name__ == '__main__':
+    if args.device == 'cuda' and not args.data_only and not torch.cuda.is_available():
+        raise Exception('no gpu; use --device cpu (or --data_only)')
+    config = tool_config(args)
+    if args.device == 'cpu':
+        # the model and the layers allocate on the cpu; autocast and GradScaler are cuda-only
+        config.MISC.GPU_COUNT = 0
+        config.TRAIN.AMP = False
+        config.TEST.AMP = False
+    # get_data() only loads the train subsets when not QUICK_VERIFY
+    config.CTRL.QUICK_VERIFY = False
+    config.MISC.LOG_FILE = os.path.join(config.MISC.RESULT_FOLDER, 'e2e_benchmark_log.txt')
+    train_data, val_data, val_api = get_data(config)
+    stats = OrderedDict()
+
+    bench_data(config, train_data, val_data.dataset, stats)
+    if not args.data_only:
+        bench_model(config, train_data, val_data, val_api, stats)
+    else:
+        print_log('[e2e] --data_only: train and inference stages skipped', config.MISC.LOG_FILE)
+
+    out_file = args.out or os.path.join(config.MISC.RESULT_FOLDER,
+                                        'e2e_benchmark_{:s}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    with open(out_file, 'w') as f:
+        json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__, 'device': args.device,
+                   'gpu': torch.cuda.get_device_name(0) if args.device == 'cuda' and not args.data_only else None,
+                   'image_shape': [int(x) for x in config.DATA.IMAGE_SHAPE],
+                   'batch_size': config.TRAIN.BATCH_SIZE, 'stages': stats}, f, indent=2)
+    print_log('[e2e] results saved to {:s}'.format(out_file), config.MISC.LOG_FILE)
@@ -0,0 +1,142 @@
+"""mAP (bbox) of many training checkpoints on minival in one process.
+
+The dataset, the COCO gt index and the molded minival inputs (first --limit images, kept
+in cpu memory) are built once; the model is built once and each checkpoint's weights are
+loaded into it in place. COCOeval of checkpoint N runs in a forked worker process while
+the gpu runs inference of checkpoint N+1. Output: a mAP-vs-iteration table (log + csv).
+
+By default all mask_rcnn_ep_*_iter_*.pth of the config's train folder are evaluated;
+--every keeps one checkpoint in k. Run from the repo root:
+
+    python -m tools.eval_checkpoints --config_file configs/105/meta_105_quick_1.yaml --limit 500
+    python -m tools.eval_checkpoints --config_file ... --ckpts results/x/train/mask_rcnn_ep_0010_*.pth
+"""
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import re
+import time
+import torch
+from lib.workflow import _mold_inputs, _bbox_results, evaluate_coco
+from datasets.dataset_coco import get_data
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Evaluate many checkpoints')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--ckpts', default=None, nargs='+', help='checkpoint files (globs); default: the train folder')
+parser.add_argument('--every', default=1, type=int, help='evaluate one checkpoint in every k')
+parser.add_argument('--limit', default=500, type=int, help='minival images; -1 for all (inputs are kept in memory)')
+parser.add_argument('--eval_workers', default=1, type=int, help='COCOeval processes')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference', 'eval_checkpoints')
+
+CKPT_PATTERN = re.compile(r'mask_rcnn_ep_(\d+)_iter_(\d+)\.pth$')
+
+# set in the parent before the pool is forked; shared (copy-on-write) by the workers
+_COCO_API = None
+
+
+def _evaluate(results, coco_image_ids):
+    """in a worker: bbox mAP and the time it took"""
+    t = time.time()
+    mAP = evaluate_coco(_COCO_API, results, coco_image_ids)
+    return mAP, time.time() - t
+
+
+def list_checkpoints(config):
+    if args.ckpts:
+        files = [f for pattern in args.ckpts for f in glob.glob(pattern)]
+    else:
+        files = glob.glob(os.path.join(_find_last(config)[0], 'mask_rcnn_ep_*_iter_*.pth'))
+    files = [f for f in files if CKPT_PATTERN.search(f)]
+    files = sorted(set(files), key=lambda f: tuple(int(x) for x in CKPT_PATTERN.search(f).groups()))
+    return files[::args.every]
+
+
+def load_weights(model, model_file):
+    """swap the weights of model in place"""
+    checkpoints = torch.load(model_file, map_location=lambda storage, loc: storage)
+    model.load_state_dict(checkpoints.get('state_dict', checkpoints), strict=False)
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    if config.TEST.OPTIMIZE_FOR_INFERENCE:
+        raise Exception('TEST.OPTIMIZE_FOR_INFERENCE removes the bn layers; weights cannot be swapped')
+    ckpt_files = list_checkpoints(config)
+    if len(ckpt_files) == 0:
+        raise Exception('no checkpoint found')
+    _, val_data, val_api = get_data(config)
+    dataset = val_data.dataset
+
+    # fork the COCOeval workers before cuda is initialized in this process
+    _COCO_API = val_api
+    pool = multiprocessing.get_context('fork').Pool(args.eval_workers)
+
+    model = MaskRCNN(config)
+    config.MODEL.INIT_FILE_CHOICE = ckpt_files[0]
+    config, model = update_config_and_load_model(config, model)
+    config.MISC.LOG_FILE = os.path.join(config.MISC.RESULT_FOLDER, 'eval_checkpoints_log.txt')
+    print_log('\n[eval checkpoints] {:d} checkpoints'.format(len(ckpt_files)), config.MISC.LOG_FILE, init=True)
+    input_model = set_model(config.MISC.GPU_COUNT, model)
+
+    # molded inputs, once: (molded_images, image_metas, windows, image shapes, coco ids)
+    image_ids = dataset.image_ids[:args.limit] if args.limit > 0 else dataset.image_ids
+    coco_image_ids = [dataset.image_info[ind]["id"] for ind in image_ids]
+    test_bs = config.TEST.BATCH_SIZE
+    batches = []
+    t = time.time()
+    for i in range(0, len(image_ids), test_bs):
+        curr_ids = image_ids[i:i + test_bs]
+        molded_images, image_metas, windows, images = _mold_inputs(model, curr_ids, dataset, cuda=False)
+        batches.append((molded_images.pin_memory(), image_metas.pin_memory(), windows,
+                        [image.shape for image in images], coco_image_ids[i:i + test_bs]))
+    print_log('[eval checkpoints] {:d} images molded in {:.1f}s ({:.2f} GB)'.format(
+        len(image_ids), time.time() - t,
+        sum(b[0].numel() * b[0].element_size() for b in batches) / 1024. ** 3), config.MISC.LOG_FILE)
+
+    pending = []
+    for model_file in ckpt_files:
+        load_weights(model, model_file)
+        t = time.time()
+        results = []
+        with torch.no_grad():
+            for molded_images, image_metas, windows, image_shapes, curr_coco_ids in batches:
+                inputs = [Variable(molded_images.cuda(non_blocking=True)),
+                          Variable(image_metas.cuda(non_blocking=True))]
+                detections = input_model(inputs, mode='inference')[0].data.cpu().numpy()
+                for i, coco_id in enumerate(curr_coco_ids):
+                    results.extend(_bbox_results(detections[i], image_shapes[i], windows[i], coco_id, dataset))
+        infer_time = time.time() - t
+        # evaluated in a worker while the next checkpoint runs
+        pending.append((model_file, infer_time, pool.apply_async(_evaluate, (results, coco_image_ids))))
+        print_log('[eval checkpoints] {:s}: inference {:.1f}s'.format(os.path.basename(model_file), infer_time),
+                  config.MISC.LOG_FILE)
+
+    table = []
+    for model_file, infer_time, job in pending:
+        mAP, eval_time = job.get()
+        ep, iter_ind = [int(x) for x in CKPT_PATTERN.search(model_file).groups()]
+        table.append((ep, iter_ind, mAP, infer_time, eval_time, model_file))
+    pool.close()
+    pool.join()
+
+    print_log('\n{:>6s} {:>8s} {:>8s} {:>10s} {:>10s}'.format('epoch', 'iter', 'mAP', 'infer (s)', 'eval (s)'),
+              config.MISC.LOG_FILE)
+    for ep, iter_ind, mAP, infer_time, eval_time, _ in table:
+        print_log('{:6d} {:8d} {:8.4f} {:10.1f} {:10.1f}'.format(ep, iter_ind, mAP, infer_time, eval_time),
+                  config.MISC.LOG_FILE)
+    best = max(table, key=lambda x: x[2])
+    print_log('best: {:s} (mAP {:.4f})'.format(best[-1], best[2]), config.MISC.LOG_FILE)
+
+    csv_file = os.path.join(config.MISC.RESULT_FOLDER, 'eval_checkpoints.csv')
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['epoch', 'iter', 'mAP', 'infer_seconds', 'eval_seconds', 'checkpoint'])
+        writer.writerows(table)
+    print_log('saved to {:s}'.format(csv_file), config.MISC.LOG_FILE)
@@ -0,0 +1,99 @@
+"""Export backbone + FPN + RPN head (lib/export.py) to TorchScript and ONNX, then check
+parity against the eager model and compare latency on minival (batch of one).
+
+Outputs go to MISC.RESULT_FOLDER/backbone_rpn.{pt,onnx}. Parity: max abs diff of the
+exported outputs (p2-p5, rpn class/bbox) and of the final detections of ExportedMaskRCNN
+vs. MaskRCNN.forward. The ONNX check needs onnxruntime. Run from the repo root:
+
+    python -m tools.export_model --config_file configs/105/meta_105_quick_1.yaml --num_images 20
+"""
+import argparse
+import os
+import time
+import torch
+from lib.workflow import _mold_inputs
+from lib.export import *
+from datasets.dataset_coco import get_data
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='TorchScript/ONNX export of backbone+FPN+RPN')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--num_images', default=20, type=int, help='images used for parity and timing')
+parser.add_argument('--no_optimize', action='store_true', help='skip optimize_for_inference() before export')
+parser.add_argument('--no_onnx', action='store_true')
+parser.add_argument('--opset', default=11, type=int)
+parser.add_argument('--tol', default=1e-4, type=float)
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference', 'export_model')
+
+
+def _max_diff(a, b):
+    return (a.data.float() - b.data.float()).abs().max()
+
+
+def _timed(fn, *inputs):
+    torch.cuda.synchronize()
+    t = time.time()
+    out = fn(*inputs)
+    torch.cuda.synchronize()
+    return out, time.time() - t
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    if not config.DATA.IMAGE_PADDING:
+        raise Exception('the export is for a fixed input shape; set DATA.IMAGE_PADDING True')
+    _, val_data, _ = get_data(config)
+    dataset = val_data.dataset
+    image_ids = dataset.image_ids[:args.num_images + 1]
+
+    model = MaskRCNN(config)
+    config, model = update_config_and_load_model(config, model)
+    model = model.cuda().eval()
+    if not args.no_optimize:
+        model.optimize_for_inference()
+
+    backbone = BackboneRPN(model)
+    example_images, _, _, _ = _mold_inputs(model, image_ids[:1], dataset)
+    ts_file = os.path.join(config.MISC.RESULT_FOLDER, 'backbone_rpn.pt')
+    traced = export_torchscript(backbone, example_images, ts_file)
+    print_log('\n[export] TorchScript saved to {:s}'.format(ts_file), config.MISC.LOG_FILE)
+    runners = [('torchscript', traced)]
+    if not args.no_onnx:
+        onnx_file = os.path.join(config.MISC.RESULT_FOLDER, 'backbone_rpn.onnx')
+        export_onnx(backbone, example_images, onnx_file, args.opset)
+        print_log('[export] ONNX saved to {:s}'.format(onnx_file), config.MISC.LOG_FILE)
+        try:
+            runners.append(('onnxruntime', OnnxBackboneRPN(onnx_file)))
+        except ImportError:
+            print_log('[export] onnxruntime not installed; ONNX parity/latency skipped', config.MISC.LOG_FILE)
+
+    # name -> [max diff of backbone outputs, of detections, total time]
+    stats = {name: [0., 0., 0.] for name, _ in [('eager', None)] + runners}
+    with torch.no_grad():
+        for i, curr_id in enumerate(image_ids):
+            molded_images, image_metas, _, _ = _mold_inputs(model, [curr_id], dataset)
+            ref_outputs = backbone(molded_images)
+            (ref_det, _), t = _timed(model, [molded_images, image_metas], 'inference')
+            if i > 0:
+                # first image is warm-up
+                stats['eager'][2] += t
+            for name, runner in runners:
+                outputs = runner(molded_images)
+                stats[name][0] = max(stats[name][0], max(_max_diff(a, b) for a, b in zip(ref_outputs, outputs)))
+                (det, _), t = _timed(ExportedMaskRCNN(model, runner), molded_images, image_metas)
+                stats[name][1] = max(stats[name][1], _max_diff(ref_det, det))
+                if i > 0:
+                    stats[name][2] += t
+
+    n_im = max(len(image_ids) - 1, 1)
+    print_log('\n{:>12s} {:>16s} {:>16s} {:>10s}'.format('', 'backbone diff', 'detection diff', 'ms/image'),
+              config.MISC.LOG_FILE)
+    for name in ['eager'] + [name for name, _ in runners]:
+        backbone_diff, det_diff, t = stats[name]
+        flag = '' if name == 'eager' or backbone_diff < args.tol else '  FAIL (tol {:g})'.format(args.tol)
+        print_log('{:>12s} {:16.3e} {:16.3e} {:10.2f}{:s}'.format(name, backbone_diff, det_diff,
+                                                                  1000. * t / n_im, flag), config.MISC.LOG_FILE)
@@ -0,0 +1,135 @@
+"""Fast mAP on a stratified subset of minival (lib/eval_subset.py), with bootstrap confidence intervals.
+
+Two modes. Run from the repo root:
+
+    # calibrate: the smallest subset whose CI stays within +-tolerance (mAP) of the full run;
+    # the full-run results are det_result_*.pth of test_model (run here first if missing)
+    python -m tools.fast_eval --config_file configs/105/meta_105_quick_1.yaml \
+        --sizes 250 500 1000 2000 3000 --tolerance 0.005
+    # evaluate the model (MODEL.INIT_FILE_CHOICE) on a subset: test_model(image_ids=subset)
+    python -m tools.fast_eval --config_file configs/105/meta_105_quick_1.yaml --size 1000
+
+Calibration needs no extra inference: the mAP of a subset and its bootstrap resamples are
+computed from the per-image evalImgs of the full run. The interval is the (1 - alpha)
+percentile bootstrap over the images of the subset (--num_samples resamples).
+"""
+import argparse
+import csv
+import os
+import numpy as np
+import torch
+from lib.workflow import test_model, run_cocoeval
+from lib.eval_subset import select_stratified_subset, ap_tables, weighted_map, bootstrap_map
+from datasets.dataset_coco import get_data
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Stratified fast evaluation with bootstrap CIs')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--size', default=0, type=int, help='evaluate the model on a subset of this size; 0: calibrate')
+parser.add_argument('--sizes', default=[250, 500, 1000, 2000, 3000], type=int, nargs='+',
+                    help='subset sizes to calibrate')
+parser.add_argument('--det_result', default=None, help='full-run det_result_*.pth (calibrate); no model needed')
+parser.add_argument('--tolerance', default=0.005, type=float, help='CI within full mAP +- tolerance (0.005: 0.5 mAP)')
+parser.add_argument('--alpha', default=0.05, type=float, help='1 - confidence level')
+parser.add_argument('--num_samples', default=200, type=int, help='bootstrap resamples')
+parser.add_argument('--seed', default=None, type=int, help='subset seed; default MISC.SEED (as TRAIN.ASYNC_VAL_EVERY)')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference', 'fast_eval')
+
+
+def coco_ids(dataset, image_ids):
+    return [dataset.image_info[ind]["id"] for ind in image_ids]
+
+
+def build_model(config):
+    model = MaskRCNN(config)
+    config, model = update_config_and_load_model(config, model)
+    return config, set_model(config.MISC.GPU_COUNT, model)
+
+
+def evaluate_subset(config, val_data, val_api, seed):
+    """test_model on the subset of --size images; results cached apart from the full run's"""
+    dataset = val_data.dataset
+    config, model = build_model(config)
+    config.MISC.LOG_FILE = os.path.join(config.MISC.RESULT_FOLDER, 'fast_eval_log.txt')
+    config.MISC.DET_RESULT_FILE = config.MISC.DET_RESULT_FILE.replace(
+        '.pth', '_subset_{:d}_seed_{:d}.pth'.format(args.size, seed))
+    subset = select_stratified_subset(val_api, dataset, args.size, seed=seed)
+    test_model(model, val_data, val_api, image_ids=subset, during_train=False, vis=None)
+
+    results = torch.load(config.MISC.DET_RESULT_FILE)['det_result']
+    coco_eval = run_cocoeval(val_api, results, coco_ids(dataset, subset))
+    if coco_eval is None:
+        raise Exception('no detection on the subset')
+    mAP, low, high = bootstrap_map(ap_tables(coco_eval), coco_eval.params.recThrs, range(len(subset)),
+                                   args.num_samples, args.alpha, seed)
+    print_log('\n[fast eval] {:s}, {:d} images (seed {:d}): mAP {:.2f} [{:.2f}, {:.2f}] ({:.0f}% CI)'.format(
+        os.path.basename(config.MODEL.INIT_MODEL), len(subset), seed, 100 * mAP, 100 * low, 100 * high,
+        100 * (1 - args.alpha)), config.MISC.LOG_FILE)
+
+
+def calibrate(config, val_data, val_api, seed):
+    dataset = val_data.dataset
+    det_result = args.det_result
+    if det_result is None:
+        # the full run of the model; test_model skips inference if the file exists
+        config, model = build_model(config)
+        det_result = config.MISC.DET_RESULT_FILE
+        if not os.path.exists(det_result):
+            test_model(model, val_data, val_api, during_train=False, vis=None)
+    config.MISC.LOG_FILE = os.path.join(os.path.dirname(det_result), 'fast_eval_log.txt')
+
+    results = torch.load(det_result)['det_result']
+    coco_eval = run_cocoeval(val_api, results, coco_ids(dataset, dataset.image_ids), config.MISC.LOG_FILE)
+    if coco_eval is None:
+        raise Exception('{:s} has no detection'.format(det_result))
+    full_map = coco_eval.stats[0]
+    tables, rec_thrs = ap_tables(coco_eval), coco_eval.params.recThrs
+    position = {coco_id: i for i, coco_id in enumerate(coco_eval.params.imgIds)}
+    print_log('\n[fast eval] full run {:s}: {:d} images, mAP {:.2f} (from evalImgs: {:.2f})'.format(
+        det_result, len(position), 100 * full_map, 100 * weighted_map(tables, np.ones(len(position)), rec_thrs)),
+        config.MISC.LOG_FILE)
+
+    table = []
+    for size in sorted(args.sizes):
+        subset = select_stratified_subset(val_api, dataset, size, seed=seed)
+        members = [position[coco_id] for coco_id in coco_ids(dataset, subset)]
+        mAP, low, high = bootstrap_map(tables, rec_thrs, members, args.num_samples, args.alpha, seed)
+        within = low >= full_map - args.tolerance and high <= full_map + args.tolerance
+        table.append((len(subset), mAP, low, high, mAP - full_map, within))
+        print_log('[fast eval] {:5d} images: mAP {:.2f} [{:.2f}, {:.2f}]'.format(
+            len(subset), 100 * mAP, 100 * low, 100 * high), config.MISC.LOG_FILE)
+
+    print_log('\n{:>6s} {:>7s} {:>7s} {:>7s} {:>7s} {:>7s} {:>7s}'.format(
+        'size', 'mAP', 'low', 'high', '+-', 'diff', 'within'), config.MISC.LOG_FILE)
+    for size, mAP, low, high, diff, within in table:
+        print_log('{:6d} {:7.2f} {:7.2f} {:7.2f} {:7.2f} {:7.2f} {:>7s}'.format(
+            size, 100 * mAP, 100 * low, 100 * high, 50 * (high - low), 100 * diff, 'yes' if within else 'no'),
+            config.MISC.LOG_FILE)
+    fits = [row[0] for row in table if row[-1]]
+    if len(fits) > 0:
+        print_log('smallest subset within +-{:.2f} mAP of the full run: {:d} images (TRAIN.ASYNC_VAL_SUBSET)'.format(
+            100 * args.tolerance, fits[0]), config.MISC.LOG_FILE)
+    else:
+        print_log('no size within +-{:.2f} mAP of the full run; try larger --sizes'.format(100 * args.tolerance),
+                  config.MISC.LOG_FILE)
+
+    csv_file = os.path.splitext(det_result)[0] + '_fast_eval.csv'
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['size', 'mAP', 'ci_low', 'ci_high', 'diff_to_full', 'within_tolerance'])
+        writer.writerows(table)
+    print_log('saved to {:s}'.format(csv_file), config.MISC.LOG_FILE)
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    _, val_data, val_api = get_data(config)
+    seed = config.MISC.SEED if args.seed is None else args.seed
+    if args.size > 0:
+        evaluate_subset(config, val_data, val_api, seed)
+    else:
+        calibrate(config, val_data, val_api, seed)
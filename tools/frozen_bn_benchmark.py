@@ -0,0 +1,82 @@
+"""Train step time and peak gpu memory: nn.BatchNorm2d put in eval mode by a
+per-step traversal (the former set_bn_eval in MaskRCNN.forward) vs. FrozenBatchNorm2d
+(TRAIN.BN_LEARN False). Same checkpoint and minival images for both. Run from the repo root:
+
+    python -m tools.frozen_bn_benchmark --config_file configs/105/meta_105_quick_1.yaml --iters 20
+"""
+import argparse
+import time
+import torch
+from lib.config import LAYER_REGEX
+from datasets.dataset_coco import get_data, detection_collate
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Frozen BN benchmark')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--layers', default='all', help='stage of LAYER_REGEX to train')
+parser.add_argument('--bs', default=2, type=int)
+parser.add_argument('--iters', default=20, type=int, help='iterations for step time')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'train', 'frozen_bn_benchmark')
+
+
+def set_bn_eval(m):
+    classname = m.__class__.__name__
+    if classname.find('BatchNorm') != -1:
+        m.eval()
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    _, val_data, _ = get_data(config)
+    loader = torch.utils.data.DataLoader(val_data, batch_size=args.bs, shuffle=False,
+                                         num_workers=config.DATA.LOADER_WORKER_NUM,
+                                         collate_fn=detection_collate, pin_memory=True)
+
+    table = []
+    for frozen in [False, True]:
+        # BN_LEARN True keeps nn.BatchNorm2d; the traversal below freezes it as before
+        config.TRAIN.BN_LEARN = not frozen
+        model = MaskRCNN(config)
+        config, model = update_config_and_load_model(config, model)
+        model = model.cuda()
+        model.set_trainable(LAYER_REGEX[args.layers], config.MISC.LOG_FILE)
+        optimizer = set_optimizer(model, config.TRAIN)
+
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+        t, cnt = 0., 0
+        for i, inputs in zip(range(args.iters + 1), loader):
+            torch.cuda.synchronize()
+            t_start = time.time()
+            images = Variable(inputs[0].cuda(non_blocking=True))
+            image_metas = Variable(inputs[-1].cuda(non_blocking=True))
+            gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(*inputs[1:5])
+            if not frozen:
+                model.apply(set_bn_eval)
+            outputs = model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')
+            loss = torch.sum(torch.mean(outputs[0], dim=0))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            torch.cuda.synchronize()
+            if i > 0:
+                # first iteration is warm-up
+                t += time.time() - t_start
+                cnt += 1
+        peak_mem = torch.cuda.max_memory_allocated() / 1024.**3
+        table.append(('FrozenBatchNorm2d' if frozen else 'BatchNorm2d.eval()', t / max(cnt, 1), peak_mem))
+        del model, optimizer
+        torch.cuda.empty_cache()
+
+    print_log('\n[layers {:s}] step time and peak memory at bs {:d}'.format(args.layers, args.bs),
+              config.MISC.LOG_FILE)
+    print_log('{:>20s} {:>10s} {:>14s}'.format('bn', 's/iter', 'peak mem (GB)'), config.MISC.LOG_FILE)
+    for name, step_time, peak_mem in table:
+        print_log('{:>20s} {:10.3f} {:14.2f}'.format(name, step_time, peak_mem), config.MISC.LOG_FILE)
+    (_, base_time, base_mem), (_, frozen_time, frozen_mem) = table
+    print_log('delta: {:+.3f} s/iter, {:+.2f} GB'.format(frozen_time - base_time, frozen_mem - base_mem),
+              config.MISC.LOG_FILE)
@@ -0,0 +1,85 @@
+"""Max batch per gpu and train step time for MODEL.GRAD_CHECKPOINT settings.
+
+For each setting the max batch is searched by find_max_batch_size() (single gpu,
+synthetic worst-case inputs, TRAIN.AUTO_BATCH_MARGIN kept free). Step time is measured
+on minival images at --time_bs (detection losses only). Run from the repo root:
+
+    python -m tools.grad_checkpoint_benchmark --config_file configs/105/meta_105_quick_1.yaml
+"""
+import argparse
+import time
+import torch
+from lib.config import LAYER_REGEX
+from datasets.dataset_coco import get_data, detection_collate
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Gradient checkpointing benchmark')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--layers', default='all', help='stage of LAYER_REGEX to train')
+parser.add_argument('--time_bs', default=2, type=int)
+parser.add_argument('--iters', default=10, type=int, help='iterations for step time')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'train', 'grad_checkpoint_benchmark')
+
+
+SETTINGS = [[], ['C2', 'C3', 'C4', 'C5'], ['FPN'], ['MASK'], ['C2', 'C3', 'C4', 'C5', 'FPN', 'MASK']]
+
+
+def _step(inputs):
+    images = Variable(inputs[0].cuda(non_blocking=True))
+    image_metas = Variable(inputs[-1].cuda(non_blocking=True))
+    gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(*inputs[1:5])
+    outputs = model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')
+    loss = torch.sum(torch.mean(outputs[0], dim=0))
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def _loader(bs):
+    return torch.utils.data.DataLoader(val_data, batch_size=bs, shuffle=False,
+                                       num_workers=config.DATA.LOADER_WORKER_NUM,
+                                       collate_fn=detection_collate, pin_memory=True)
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    _, val_data, _ = get_data(config)
+
+    model = MaskRCNN(config)
+    config, model = update_config_and_load_model(config, model)
+    model = model.cuda()
+    model.set_trainable(LAYER_REGEX[args.layers], config.MISC.LOG_FILE)
+    optimizer = set_optimizer(model, config.TRAIN)
+
+    table = []
+    for setting in SETTINGS:
+        model.set_grad_checkpoint(setting)
+
+        config = find_max_batch_size(model, config)
+        max_bs = config.TRAIN.BATCH_SIZE
+
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+        t, cnt = 0., 0
+        for i, inputs in zip(range(args.iters + 1), _loader(args.time_bs)):
+            torch.cuda.synchronize()
+            t_start = time.time()
+            _step(inputs)
+            torch.cuda.synchronize()
+            if i > 0:
+                # first iteration is warm-up
+                t += time.time() - t_start
+                cnt += 1
+        peak_mem = torch.cuda.max_memory_allocated() / 1024.**3
+        table.append((','.join(setting) or 'none', max_bs, t / max(cnt, 1), peak_mem))
+
+    print_log('\n[layers {:s}] step time and peak memory at bs {:d}'.format(args.layers, args.time_bs),
+              config.MISC.LOG_FILE)
+    print_log('{:>22s} {:>8s} {:>10s} {:>14s}'.format('GRAD_CHECKPOINT', 'max bs', 's/iter', 'peak mem (GB)'),
+              config.MISC.LOG_FILE)
+    for name, max_bs, step_time, peak_mem in table:
+        print_log('{:>22s} {:8d} {:10.3f} {:14.2f}'.format(name, max_bs, step_time, peak_mem), config.MISC.LOG_FILE)
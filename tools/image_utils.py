@@ -1,8 +1,10 @@
 import random
+import math
 import numpy as np
 import scipy.misc
 import scipy.ndimage
 from tools.box_utils import extract_bboxes
+from datasets.eval.PythonAPI.pycocotools import mask as maskUtils
 
 
 def compose_image_meta(image_id, image_shape, window, active_class_ids, coco_image_id):
@@ -75,7 +77,8 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
         min_dim:    if provided, resizes the image such that its smaller dimension == min_dim
         max_dim:    if provided, ensures that the image longest side doesn't exceed this value.
 
-        padding:    if true, pads image with zeros so it's size is max_dim x max_dim
+        padding:    if true, pads image with zeros so it's size is max_dim x max_dim;
+                        otherwise the batch is padded later (see pad_batch_size())
 
     Returns:
         image:      the resized image
@@ -119,6 +122,18 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
     return image, window, scale, padding
 
 
+def pad_batch_size(shapes, size_divisor=64):
+    """(height, width) to pad a batch of images to when they are not padded to a
+    square (DATA.IMAGE_PADDING=False): the max of the batch rounded up to size_divisor.
+    Images are padded on the bottom and right so that their windows do not change.
+    """
+    height = max([shape[0] for shape in shapes])
+    width = max([shape[1] for shape in shapes])
+    height = int(math.ceil(height / size_divisor) * size_divisor)
+    width = int(math.ceil(width / size_divisor) * size_divisor)
+    return height, width
+
+
 def resize_mask(mask, scale, padding):
     """Resizes a mask using the given scale and padding.
     Typically, you get the scale and padding from resize_image() to
@@ -130,7 +145,8 @@ def resize_mask(mask, scale, padding):
     """
     # TODO: erase user warning
     mask = scipy.ndimage.zoom(mask, (scale, scale, 1), order=3)
-    mask = np.pad(mask, padding, mode='constant', constant_values=0)
+    if padding:
+        mask = np.pad(mask, padding, mode='constant', constant_values=0)
     return mask
 
 
@@ -152,21 +168,91 @@ def minimize_mask(bbox, mask, mini_shape):
     return mini_mask
 
 
-# def expand_mask(bbox, mini_mask, image_shape):
-#     """Resizes mini masks back to image size. Reverses the change
-#     of minimize_mask().
-#
-#     See inspect_data.ipynb notebook for more details.
-#     """
-#     mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
-#     for i in range(mask.shape[-1]):
-#         m = mini_mask[:, :, i]
-#         y1, x1, y2, x2 = bbox[i][:4]
-#         h = y2 - y1
-#         w = x2 - x1
-#         m = scipy.misc.imresize(m.astype(float), (h, w), interp='bilinear')
-#         mask[y1:y2, x1:x2, i] = np.where(m >= 128, 1, 0)
-#     return mask
+def minimize_mask_from_rle(rles, polygons, image_shape, scale, padding, flip, mini_shape):
+    """Build boxes and mini-masks straight from the COCO annotations, without
+    decoding the full-resolution [height, width, instance_count] mask stack.
+    The result should match resize_mask() + extract_bboxes() + minimize_mask().
+
+    rles:           list of RLEs (one per instance) at the original image resolution
+    polygons:       list of polygon lists, None for instances given as RLE
+    image_shape:    [height, width, 3] of the resized (and padded) image
+    scale, padding: from resize_image()
+    flip:           whether the image was flipped horizontally
+    Returns:
+    bbox:           [instance_count, (y1, x1, y2, x2)] in the resized image
+    mini_mask:      [mini_height, mini_width, instance_count]
+    """
+    im_h, im_w = image_shape[:2]
+    top_pad, left_pad = (padding[0][0], padding[1][0]) if padding else (0, 0)
+    mini_h, mini_w = mini_shape
+
+    bbox = np.zeros([len(rles), 4], dtype=np.int32)
+    mini_mask = np.zeros(mini_shape + (len(rles),), dtype=bool)
+    if len(rles) == 0:
+        return bbox, mini_mask
+
+    # [x, y, w, h] in the original image
+    boxes = maskUtils.toBbox(rles)
+    for i in range(len(rles)):
+        x, y, w, h = boxes[i]
+        y1 = min(max(int(np.floor(y * scale)) + top_pad, 0), im_h)
+        y2 = min(max(int(np.ceil((y + h) * scale)) + top_pad, 0), im_h)
+        x1 = min(max(int(np.floor(x * scale)) + left_pad, 0), im_w)
+        x2 = min(max(int(np.ceil((x + w) * scale)) + left_pad, 0), im_w)
+        if flip:
+            x1, x2 = im_w - x2, im_w - x1
+        bbox[i] = [y1, x1, y2, x2]
+        if y2 <= y1 or x2 <= x1:
+            continue
+
+        if polygons[i] is not None:
+            # move the polygon into the resized image and then into the box;
+            # rasterize it at the mini-mask resolution directly
+            polys = []
+            for poly in polygons[i]:
+                poly = np.array(poly, dtype=np.float64).reshape(-1, 2)
+                px = poly[:, 0] * scale + left_pad
+                if flip:
+                    px = im_w - px
+                py = poly[:, 1] * scale + top_pad
+                px = (px - x1) * mini_w / (x2 - x1)
+                py = (py - y1) * mini_h / (y2 - y1)
+                polys.append(np.stack([px, py], axis=1).reshape(-1).tolist())
+            m = maskUtils.decode(maskUtils.merge(maskUtils.frPyObjects(polys, mini_h, mini_w)))
+            mini_mask[:, :, i] = m > 0
+        else:
+            # RLE: only one instance is decoded at a time and only its box is resized
+            m = maskUtils.decode(rles[i])
+            oy1, ox1 = int(np.floor(y)), int(np.floor(x))
+            oy2, ox2 = int(np.ceil(y + h)), int(np.ceil(x + w))
+            m = m[oy1:oy2, ox1:ox2]
+            if m.size == 0:
+                continue
+            if flip:
+                m = np.fliplr(m)
+            m = scipy.misc.imresize(m.astype(float), mini_shape, interp='bilinear')
+            mini_mask[:, :, i] = np.where(m >= 128, 1, 0)
+
+    return bbox, mini_mask
+
+
+def expand_mask(bbox, mini_mask, image_shape):
+    """Resizes mini masks back to image size. Reverses the change
+    of minimize_mask().
+
+    See inspect_data.ipynb notebook for more details.
+    """
+    mask = np.zeros(tuple(image_shape[:2]) + (mini_mask.shape[-1],), dtype=bool)
+    for i in range(mask.shape[-1]):
+        m = mini_mask[:, :, i]
+        y1, x1, y2, x2 = bbox[i][:4]
+        h = y2 - y1
+        w = x2 - x1
+        if h <= 0 or w <= 0:
+            continue
+        m = scipy.misc.imresize(m.astype(float), (h, w), interp='bilinear')
+        mask[y1:y2, x1:x2, i] = np.where(m >= 128, 1, 0)
+    return mask
 
 
 def unmold_mask(mask, bbox, image_shape):
@@ -212,22 +298,30 @@ def load_image_and_gt(dataset, config, image_id, augment=False, use_mini_mask=Fa
     """
     # Load image and mask
     image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
     image, window, scale, padding = \
         resize_image(image, min_dim=config.DATA.IMAGE_MIN_DIM,
                      max_dim=config.DATA.IMAGE_MAX_DIM, padding=config.DATA.IMAGE_PADDING)
-    mask = resize_mask(mask, scale, padding)
 
     # Random horizontal flips.
-    if augment:
-        if random.randint(0, 1):
-            image = np.fliplr(image)
+    flip = augment and random.randint(0, 1)
+    if flip:
+        image = np.fliplr(image)
+
+    rle_path = use_mini_mask and config.MRCNN.RLE_MASK
+    if rle_path:
+        # boxes and mini-masks come straight from the RLE/polygons
+        rles, polygons, class_ids = dataset.load_mask_rle(image_id)
+        bbox, mask = minimize_mask_from_rle(rles, polygons, image.shape, scale, padding,
+                                            flip, config.MRCNN.MINI_MASK_SHAPE)
+    else:
+        mask, class_ids = dataset.load_mask(image_id)
+        mask = resize_mask(mask, scale, padding)
+        if flip:
             mask = np.fliplr(mask)
-
-    # Bounding boxes. Note that some boxes might be all zeros
-    # if the corresponding mask got cropped out.
-    # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = extract_bboxes(mask)
+        # Bounding boxes. Note that some boxes might be all zeros
+        # if the corresponding mask got cropped out.
+        # bbox: [num_instances, (y1, x1, y2, x2)]
+        bbox = extract_bboxes(mask)
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -237,7 +331,7 @@ def load_image_and_gt(dataset, config, image_id, augment=False, use_mini_mask=Fa
     active_class_ids[source_class_ids] = 1
 
     # Resize masks to smaller size to reduce memory usage
-    if use_mini_mask:
+    if use_mini_mask and not rle_path:
         mask = minimize_mask(bbox, mask, config.MRCNN.MINI_MASK_SHAPE)
 
     # Image meta datasets
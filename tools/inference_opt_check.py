@@ -0,0 +1,95 @@
+"""Parity and latency of MaskRCNN.optimize_for_inference() (TEST.OPTIMIZE_FOR_INFERENCE).
+
+A copy of the loaded model is optimized; the fpn features (p2-p6) on minival images and
+the classifier/mask head outputs on random pooled features are compared against the
+original (max abs diff, should be < 1e-4), then the forward time per image of both is
+reported. Run from the repo root:
+
+    python -m tools.inference_opt_check --config_file configs/105/meta_105_quick_1.yaml --num_batch 20
+"""
+import argparse
+import copy
+import time
+import torch
+from lib.workflow import _mold_inputs
+from datasets.dataset_coco import get_data
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='optimize_for_inference parity and latency')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--num_batch', default=20, type=int, help='batches used for parity and timing')
+parser.add_argument('--tol', default=1e-4, type=float)
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference', 'inference_opt_check')
+
+
+def _max_diff(a, b):
+    return (a.data.float() - b.data.float()).abs().max()
+
+
+def _forward_time(net, molded_images, image_metas):
+    torch.cuda.synchronize()
+    t = time.time()
+    net([molded_images, image_metas], mode='inference')
+    torch.cuda.synchronize()
+    return time.time() - t
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    _, val_data, _ = get_data(config)
+
+    model = MaskRCNN(config)
+    config, model = update_config_and_load_model(config, model)
+    model = model.cuda().eval()
+    opt_model = copy.deepcopy(model)
+    opt_model.optimize_for_inference()
+
+    dataset = val_data.dataset
+    test_bs = config.TEST.BATCH_SIZE
+    image_ids = dataset.image_ids[:args.num_batch * test_bs]
+
+    fpn_diff = 0.
+    t_base, t_opt, n_im = 0., 0., 0
+    with torch.no_grad():
+        for i in range(0, len(image_ids), test_bs):
+            curr_ids = image_ids[i:i + test_bs]
+            molded_images, image_metas, _, _ = _mold_inputs(model, curr_ids, dataset)
+            if config.DATA.DEVICE_NORMALIZE:
+                fpn_input = model.mold_input(molded_images)
+            else:
+                fpn_input = molded_images
+            base_feats = model.fpn(fpn_input, mode='inference')[:5]
+            opt_feats = opt_model.fpn(fpn_input, mode='inference')[:5]
+            fpn_diff = max(fpn_diff, max(_max_diff(a, b) for a, b in zip(base_feats, opt_feats)))
+
+            # first batch is warm-up
+            curr_base = _forward_time(model, molded_images, image_metas)
+            curr_opt = _forward_time(opt_model, molded_images, image_metas)
+            if i > 0:
+                t_base += curr_base
+                t_opt += curr_opt
+                n_im += len(curr_ids)
+
+        # heads on random pooled features (classifier: POOL_SIZE, mask: MASK_POOL_SIZE)
+        pool, mask_pool = config.MRCNN.POOL_SIZE, config.MRCNN.MASK_POOL_SIZE
+        pooled_cls = Variable(torch.randn(64, 256, pool, pool).cuda())
+        pooled_mask = Variable(torch.randn(64, 256, mask_pool, mask_pool).cuda())
+        # the meta merge in Classifier is skipped (no small_gt_index > 0)
+        no_meta = Variable(torch.zeros(64).cuda())
+        no_meta_feat = Variable(torch.zeros(64, 1024).cuda())
+        cls_diff = max(_max_diff(a, b) for a, b in zip(
+            model.classifier(pooled_cls, no_meta_feat, no_meta, mode='inference'),
+            opt_model.classifier(pooled_cls, no_meta_feat, no_meta, mode='inference')))
+        mask_diff = _max_diff(model.mask(pooled_mask), opt_model.mask(pooled_mask))
+
+    print_log('\n[optimize_for_inference] max abs diff (tol {:g})'.format(args.tol), config.MISC.LOG_FILE)
+    for name, diff in [('fpn', fpn_diff), ('classifier', cls_diff), ('mask', mask_diff)]:
+        print_log('{:>12s} {:12.3e} {:s}'.format(name, diff, 'ok' if diff < args.tol else 'FAIL'),
+                  config.MISC.LOG_FILE)
+    print_log('{:>12s} {:>10s}'.format('', 'ms/image'), config.MISC.LOG_FILE)
+    print_log('{:>12s} {:10.2f}'.format('original', 1000. * t_base / max(n_im, 1)), config.MISC.LOG_FILE)
+    print_log('{:>12s} {:10.2f}'.format('optimized', 1000. * t_opt / max(n_im, 1)), config.MISC.LOG_FILE)
@@ -0,0 +1,133 @@
+"""Write a small synthetic COCO-2014-style tree for end-to-end tests without the download.
+
+    <root>/annotations/instances_{train,minival,valminusminival}2014.json
+    <root>/train2014/COCO_train2014_%012d.jpg, <root>/val2014/COCO_val2014_%012d.jpg
+
+The 80 COCO categories (real ids) are used. Each image is noise with filled random polygons, one
+per instance (the number of instances is Poisson with mean --density, at least one). Instances are
+stored as polygons, as compressed RLE (--rle_frac) or as crowds with uncompressed RLE
+(--crowd_frac), as in the real annotations. The layout is what get_data() reads from
+DATASET.PATH. Existing annotation files are not overwritten without --force. Run from the repo root:
+
+    python -m tools.make_synthetic_coco --root datasets/coco --train_images 200 --minival_images 50
+"""
+import argparse
+import json
+import os
+import numpy as np
+from PIL import Image
+from lib.config import CLASS_NAMES
+from datasets.eval.PythonAPI.pycocotools import mask as maskUtils
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Synthetic COCO-style dataset')
+parser.add_argument('--root', default='datasets/coco', help='DATASET.PATH')
+parser.add_argument('--year', default='2014')
+parser.add_argument('--train_images', default=200, type=int)
+parser.add_argument('--minival_images', default=50, type=int)
+parser.add_argument('--valminusminival_images', default=50, type=int)
+parser.add_argument('--density', default=7., type=float, help='mean instances per image (COCO: ~7)')
+parser.add_argument('--rle_frac', default=0.1, type=float, help='share of non-crowd instances stored as RLE')
+parser.add_argument('--crowd_frac', default=0.01, type=float, help='share of crowd instances')
+parser.add_argument('--min_size', default=320, type=int, help='shortest image side is drawn from [min, max]')
+parser.add_argument('--max_size', default=640, type=int)
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--force', action='store_true', help='overwrite existing annotation files')
+args = parser.parse_args()
+
+# category ids of COCO 2014/2017 (1..90 with gaps), in the order of CLASS_NAMES
+COCO_CAT_IDS = [i for i in range(1, 91) if i not in [12, 26, 29, 30, 45, 66, 68, 69, 71, 83]]
+
+
+def random_polygon(rng, height, width):
+    """star-shaped polygon [x1, y1, x2, y2, ...] inside the image; COCO-like log-uniform size"""
+    radius = np.exp(rng.uniform(np.log(4.), np.log(0.4 * min(height, width))))
+    cy, cx = rng.uniform(radius, height - radius), rng.uniform(radius, width - radius)
+    num_vertex = rng.randint(5, 13)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, num_vertex))
+    radii = radius * rng.uniform(0.5, 1., num_vertex)
+    xs = np.clip(cx + radii * np.cos(angles), 0, width - 1)
+    ys = np.clip(cy + radii * np.sin(angles), 0, height - 1)
+    return np.stack([xs, ys], axis=1).flatten().tolist()
+
+
+def uncompressed_rle(mask):
+    """{'counts': [...], 'size': [h, w]} of a binary mask, column-major as in COCO crowds"""
+    flat = mask.flatten(order='F')
+    changes = np.nonzero(flat[1:] != flat[:-1])[0] + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]])).tolist()
+    if flat[0]:
+        # counts start with the number of zeros
+        counts = [0] + counts
+    return {'counts': [int(c) for c in counts], 'size': list(mask.shape)}
+
+
+def make_subset(rng, folder, num_images, image_dir, first_image_id, first_ann_id):
+    images, annotations = [], []
+    ann_id = first_ann_id
+    for image_id in range(first_image_id, first_image_id + num_images):
+        short_side, long_side = rng.randint(args.min_size, args.max_size + 1), args.max_size
+        height, width = (short_side, long_side) if rng.rand() < 0.7 else (long_side, short_side)
+        image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        file_name = 'COCO_{:s}{:s}_{:012d}.jpg'.format(folder, args.year, image_id)
+
+        num_kept = 0
+        for _ in range(max(1, rng.poisson(args.density))):
+            polygon = random_polygon(rng, height, width)
+            rle = maskUtils.merge(maskUtils.frPyObjects([polygon], height, width))
+            mask = maskUtils.decode(rle)
+            if mask.sum() < 1:
+                continue
+            image[mask > 0] = rng.randint(0, 256, 3)
+            ann = {'id': ann_id, 'image_id': image_id, 'category_id': int(rng.choice(COCO_CAT_IDS)),
+                   'area': float(maskUtils.area(rle)), 'bbox': [float(x) for x in maskUtils.toBbox(rle)],
+                   'iscrowd': 0}
+            u = rng.rand()
+            if u < args.crowd_frac and num_kept > 0:
+                # not the first one: images with crowds only are skipped by COCODataset
+                ann['iscrowd'] = 1
+                ann['segmentation'] = uncompressed_rle(mask)
+            elif u < args.crowd_frac + args.rle_frac:
+                rle['counts'] = rle['counts'].decode('ascii')
+                ann['segmentation'] = rle
+            else:
+                ann['segmentation'] = [polygon]
+            annotations.append(ann)
+            ann_id += 1
+            num_kept += 1
+
+        Image.fromarray(image).save(os.path.join(image_dir, file_name), quality=90)
+        images.append({'id': image_id, 'file_name': file_name, 'height': height, 'width': width})
+    return images, annotations
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(args.seed)
+    categories = [{'id': cat_id, 'name': name, 'supercategory': 'synthetic'}
+                  for cat_id, name in zip(COCO_CAT_IDS, CLASS_NAMES[1:])]
+    ann_dir = os.path.join(args.root, 'annotations')
+    mkdir_if_missing(ann_dir)
+
+    # minival and valminusminival share val2014 (see Dataset.load_coco); ids do not overlap
+    subsets = [('train', args.train_images, 'train'), ('minival', args.minival_images, 'val'),
+               ('valminusminival', args.valminusminival_images, 'val')]
+    for subset, _, _ in subsets:
+        ann_file = os.path.join(ann_dir, 'instances_{:s}{:s}.json'.format(subset, args.year))
+        if os.path.exists(ann_file) and not args.force:
+            raise Exception('{:s} exists; use --force to overwrite'.format(ann_file))
+
+    image_id, ann_id = 1, 1
+    for subset, num_images, folder in subsets:
+        image_dir = os.path.join(args.root, folder + args.year)
+        mkdir_if_missing(image_dir)
+        images, annotations = make_subset(rng, folder, num_images, image_dir, image_id, ann_id)
+        image_id += num_images
+        ann_id += len(annotations)
+        ann_file = os.path.join(ann_dir, 'instances_{:s}{:s}.json'.format(subset, args.year))
+        with open(ann_file, 'w') as f:
+            json.dump({'info': {'description': 'synthetic COCO (tools/make_synthetic_coco.py)'},
+                       'licenses': [], 'images': images, 'annotations': annotations,
+                       'categories': categories}, f)
+        print('{:s}: {:d} images, {:d} instances ({:d} crowd) -> {:s}'.format(
+            subset, len(images), len(annotations), sum(a['iscrowd'] for a in annotations), ann_file))
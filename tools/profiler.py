@@ -0,0 +1,157 @@
+"""Named, nested timing scopes for the training hot path (CTRL.PROFILE_ANALYSIS).
+
+    from tools.profiler import PROFILER
+    with PROFILER.scope('backbone'):
+        ...
+    PROFILER.push('rpn_targets'); ...; PROFILER.pop()     # same, without re-indenting
+
+Scopes nest per thread (DataParallel replicas run in threads) and are recorded as
+'forward/backbone' etc. On gpu the start/end are cuda events on the current stream;
+otherwise time.perf_counter(). Nothing is recorded (and no cost beyond one attribute
+check) unless enabled. step() closes an iteration: it synchronizes and resolves the
+events of that step. export() writes per-scope percentiles (csv) and a Chrome trace
+(json; chrome://tracing or ui.perfetto.dev).
+"""
+import contextlib
+import csv
+import json
+import threading
+import time
+import numpy as np
+import torch
+
+
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.use_cuda = False
+        self.warmup, self.num_steps = 0, -1
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # scope -> list of durations (ms); resolved trace events
+        self.durations = {}
+        self.trace = []
+        self.step_ind = 0
+        self._start_step()
+
+    def enable(self, warmup=0, num_steps=-1, use_cuda=None):
+        """discard the first warmup steps; finished() after num_steps more (-1: never)"""
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
+        self.warmup, self.num_steps = warmup, num_steps
+        self.enabled = True
+        self.reset()
+
+    def finished(self):
+        return self.enabled and 0 <= self.num_steps <= self.step_ind - self.warmup
+
+    def disable(self):
+        self.enabled = False
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _start_step(self):
+        # per-device reference events map event times to wall clock for the trace
+        self._t0 = time.perf_counter()
+        self._ref = {}
+        self._records = []
+        if self.enabled and self.use_cuda:
+            for device in range(torch.cuda.device_count()):
+                with torch.cuda.device(device):
+                    ref = torch.cuda.Event(enable_timing=True)
+                    ref.record()
+                    self._ref[device] = ref
+
+    def _marker(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return torch.cuda.current_device(), event
+        return None, time.perf_counter()
+
+    def push(self, name):
+        if not self.enabled:
+            return
+        stack = self._stack()
+        path = '/'.join([s[0] for s in stack] + [name])
+        stack.append((name, path, self._marker()))
+
+    def pop(self):
+        if not self.enabled:
+            return
+        _, path, start = self._stack().pop()
+        with self._lock:
+            self._records.append((path, start, self._marker(), threading.get_ident()))
+
+    @contextlib.contextmanager
+    def scope(self, name):
+        self.push(name)
+        try:
+            yield
+        finally:
+            self.pop()
+
+    def record(self, name, start, end):
+        """host interval measured with time.perf_counter(), e.g. waiting for the data loader"""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        path = '/'.join([s[0] for s in stack] + [name])
+        with self._lock:
+            self._records.append((path, (None, start), (None, end), threading.get_ident()))
+
+    def step(self):
+        """end of an iteration: resolve this step's records"""
+        if not self.enabled:
+            return
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        if self.step_ind < self.warmup:
+            self._records = []
+        for path, (dev, start), (_, end), tid in self._records:
+            if dev is None:
+                start_ms, end_ms = 1000. * (start - self._t0), 1000. * (end - self._t0)
+            else:
+                ref = self._ref[dev]
+                start_ms, end_ms = ref.elapsed_time(start), ref.elapsed_time(end)
+            self.durations.setdefault(path, []).append(end_ms - start_ms)
+            self.trace.append({
+                'name': path.split('/')[-1], 'cat': path, 'ph': 'X',
+                'ts': 1e6 * self._t0 + 1000. * start_ms, 'dur': 1000. * (end_ms - start_ms),
+                'pid': 0 if dev is None else dev + 1, 'tid': tid, 'args': {'step': self.step_ind}})
+        self.step_ind += 1
+        self._start_step()
+
+    def summary(self):
+        """[(scope, count, mean, p50, p90, p99, total)] in ms, sorted by scope path"""
+        rows = []
+        for path in sorted(self.durations):
+            d = np.array(self.durations[path])
+            rows.append((path, len(d), d.mean(), np.percentile(d, 50), np.percentile(d, 90),
+                         np.percentile(d, 99), d.sum()))
+        return rows
+
+    def export(self, csv_file, trace_file):
+        with open(csv_file, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['scope', 'count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'total_ms'])
+            for row in self.summary():
+                writer.writerow([row[0], row[1]] + ['{:.3f}'.format(x) for x in row[2:]])
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': self.trace, 'displayTimeUnit': 'ms'}, f)
+
+    def format_summary(self):
+        lines = ['{:<40s} {:>7s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+            'scope (ms)', 'count', 'mean', 'p50', 'p90', 'p99')]
+        for path, cnt, mean, p50, p90, p99, _ in self.summary():
+            lines.append('{:<40s} {:7d} {:10.2f} {:10.2f} {:10.2f} {:10.2f}'.format(
+                path, cnt, mean, p50, p90, p99))
+        return '\n'.join(lines)
+
+
+PROFILER = Profiler()
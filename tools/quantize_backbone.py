@@ -0,0 +1,83 @@
+"""Int8 (static, fbgemm) quantization of the resnet backbone + FPN for cpu serving.
+
+Calibrates on --num_calib minival images (the last ones; mAP uses the first --limit),
+saves the quantized state_dict to MISC.RESULT_FOLDER/backbone_int8.pth (reload with
+lib.quantization.load_quant_fpn), then reports the cpu latency of fp32 vs. int8
+backbone + FPN and the minival mAP of the full model with either backbone (heads fp32,
+on gpu). Run from the repo root:
+
+    python -m tools.quantize_backbone --config_file configs/105/meta_105_quick_1.yaml \
+        --num_calib 100 --limit 500 --threads 8
+"""
+import argparse
+import os
+import time
+import torch
+from lib.workflow import test_model, _mold_inputs
+from lib.quantization import *
+from datasets.dataset_coco import get_data
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Int8 backbone quantization')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--num_calib', default=100, type=int, help='minival images for calibration')
+parser.add_argument('--limit', default=500, type=int, help='images used for mAP; -1 for all of minival')
+parser.add_argument('--num_latency', default=20, type=int, help='images used for cpu timing')
+parser.add_argument('--threads', default=0, type=int, help='torch cpu threads; 0 to keep the default')
+parser.add_argument('--backend', default='fbgemm', help='fbgemm (x86) or qnnpack (arm)')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference', 'quantize_backbone')
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    _, val_data, val_api = get_data(config)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    model = MaskRCNN(config)
+    config, model = update_config_and_load_model(config, model)
+    config.MISC.DET_RESULT_FILE = None
+    model = model.cuda()
+    dataset = val_data.dataset
+
+    # calibrate and convert
+    print_log('\n[quantization] calibrating on {:d} minival images ...'.format(args.num_calib), config.MISC.LOG_FILE)
+    float_fpn = build_quant_fpn(model, args.backend)
+    quant_fpn = prepare(build_quant_fpn(model, args.backend))
+    calibrate(quant_fpn, model, dataset, dataset.image_ids[-args.num_calib:])
+    quant_fpn = convert(quant_fpn)
+    quant_file = os.path.join(config.MISC.RESULT_FOLDER, 'backbone_int8.pth')
+    torch.save(quant_fpn.state_dict(), quant_file)
+    print_log('[quantization] int8 backbone saved to {:s}'.format(quant_file), config.MISC.LOG_FILE)
+
+    # cpu latency, batch of one; first image is warm-up
+    table = []
+    with torch.no_grad():
+        for name, fpn in [('fp32', float_fpn), ('int8', quant_fpn)]:
+            t, n_im = 0., 0
+            for i, curr_id in enumerate(dataset.image_ids[:args.num_latency + 1]):
+                molded_images, _, _, _ = _mold_inputs(model, [curr_id], dataset)
+                x = mold_cpu_input(model, molded_images)
+                t_start = time.time()
+                fpn(x)
+                if i > 0:
+                    t += time.time() - t_start
+                    n_im += 1
+            table.append([name, 1000. * t / max(n_im, 1)])
+
+    # mAP: full model on gpu with the fp32 or the int8 (cpu) backbone
+    fp32_mAP = test_model(model, val_data, val_api, limit=args.limit, during_train=False, vis=None)
+    model.fpn = QuantFPNWrapper(quant_fpn)
+    int8_mAP = test_model(model, val_data, val_api, limit=args.limit, during_train=False, vis=None)
+    table[0].append(fp32_mAP)
+    table[1].append(int8_mAP)
+
+    print_log('\n{:>6s} {:>16s} {:>8s}'.format('', 'cpu ms/image', 'mAP'), config.MISC.LOG_FILE)
+    for name, latency, mAP in table:
+        print_log('{:>6s} {:16.2f} {:8.4f}'.format(name, latency, mAP), config.MISC.LOG_FILE)
+    print_log('mAP drop: {:.4f}, cpu speed-up: {:.2f}x'.format(
+        fp32_mAP - int8_mAP, table[0][1] / max(table[1][1], 1e-6)), config.MISC.LOG_FILE)
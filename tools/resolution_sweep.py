@@ -0,0 +1,79 @@
+"""Latency / mAP across input resolutions with one loaded model.
+
+Anchors come from the shape-keyed prior cache (layers.PriorCache), so only
+DATA.IMAGE_MAX_DIM (and MIN_DIM, scaled by the same ratio) is changed between
+runs; the weights are loaded once. Run from the repo root:
+
+    python -m tools.resolution_sweep --config_file configs/105/meta_105_quick_1.yaml \
+        --dims 512 640 768 1024 --limit 500
+"""
+import argparse
+import math
+import time
+import numpy as np
+import torch
+from lib.workflow import test_model, _mold_inputs
+from datasets.dataset_coco import get_data
+from lib.model import MaskRCNN
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Resolution sweep')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--config_name', default='resolution_sweep')
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--dims', default=[512, 640, 768, 1024], type=int, nargs='+')
+parser.add_argument('--limit', default=500, type=int, help='images used for mAP; -1 for all of minival')
+parser.add_argument('--num_latency', default=20, type=int, help='batches used for timing')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference')
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    _, val_data, val_api = get_data(config)
+
+    model = MaskRCNN(config)
+    config, model = update_config_and_load_model(config, model)
+    # no det_result caching: each resolution is run from scratch
+    config.MISC.DET_RESULT_FILE = None
+    model = set_model(config.MISC.GPU_COUNT, model)
+    _model = model.module if isinstance(model, torch.nn.DataParallel) else model
+
+    base_min_dim, base_max_dim = config.DATA.IMAGE_MIN_DIM, config.DATA.IMAGE_MAX_DIM
+    dataset = val_data.dataset
+    test_bs = config.TEST.BATCH_SIZE
+    image_ids = dataset.image_ids[:args.num_latency * test_bs]
+
+    table = []
+    for dim in args.dims:
+        if dim % 64 != 0:
+            raise Exception('IMAGE_MAX_DIM must be a multiple of 64, got {}'.format(dim))
+        config.DATA.IMAGE_MAX_DIM = dim
+        config.DATA.IMAGE_MIN_DIM = int(round(base_min_dim * dim / base_max_dim))
+        config.DATA.IMAGE_SHAPE = np.array([dim, dim, 3])
+        config.MODEL.BACKBONE_SHAPES = np.array(
+            [[int(math.ceil(dim / stride)), int(math.ceil(dim / stride))]
+             for stride in config.MODEL.BACKBONE_STRIDES])
+        print_log('\n[resolution sweep] IMAGE_MAX_DIM {}, IMAGE_MIN_DIM {}'.format(
+            dim, config.DATA.IMAGE_MIN_DIM), config.MISC.LOG_FILE)
+
+        # latency: forward only, first batch is warm-up
+        t_forward, n_im = 0., 0
+        for i in range(0, len(image_ids), test_bs):
+            curr_ids = image_ids[i:i + test_bs]
+            molded_images, image_metas, _, _ = _mold_inputs(_model, curr_ids, dataset)
+            torch.cuda.synchronize()
+            t = time.time()
+            model([molded_images, image_metas], mode='inference')
+            torch.cuda.synchronize()
+            if i > 0:
+                t_forward += time.time() - t
+                n_im += len(curr_ids)
+
+        mAP = test_model(model, val_data, val_api, limit=args.limit, during_train=False, vis=None)
+        table.append((dim, config.DATA.IMAGE_MIN_DIM, 1000. * t_forward / max(n_im, 1), mAP))
+
+    print_log('\n{:>8s} {:>8s} {:>14s} {:>8s}'.format('max_dim', 'min_dim', 'ms/image', 'mAP'), config.MISC.LOG_FILE)
+    for dim, min_dim, latency, mAP in table:
+        print_log('{:8d} {:8d} {:14.2f} {:8.4f}'.format(dim, min_dim, latency, mAP), config.MISC.LOG_FILE)
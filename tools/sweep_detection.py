@@ -0,0 +1,84 @@
+"""Sweep the detection thresholds on cached head outputs (lib/head_cache.py).
+
+First run inference once with TEST.CACHE_HEAD_OUTPUTS True (saves head_cache_*.pth next to
+the det_result file), with RPN.POST_NMS_ROIS_INFERENCE at the largest value to sweep. Then
+every point of the grid below only runs detection_layer + COCOeval (bbox) on the cache:
+
+    python main.py --phase inference --config_file configs/105/meta_105_quick_1.yaml \
+        TEST.CACHE_HEAD_OUTPUTS True
+    python -m tools.sweep_detection --config_file configs/105/meta_105_quick_1.yaml \
+        --cache results/meta_105_quick_1/inference/head_cache_ep_0013_iter_000619.pth \
+        --min_conf 0 0.3 0.5 0.7 --nms 0.3 0.5 --max_inst 100 --rois 500 1000
+
+The table (and a csv next to the cache) gives the mAP of each combination.
+"""
+import argparse
+import csv
+import itertools
+import os
+import time
+import torch
+from lib.workflow import evaluate_coco
+from lib.head_cache import replay_detections
+from datasets.dataset_coco import get_data
+from tools.utils import *
+
+
+parser = argparse.ArgumentParser(description='Detection threshold sweep on cached head outputs')
+parser.add_argument('--config_file', default=None)
+parser.add_argument('--device_id', default='0', type=str)
+parser.add_argument('--cache', required=True, help='head_cache_*.pth written by test_model')
+parser.add_argument('--min_conf', default=None, type=float, nargs='+', help='TEST.DET_MIN_CONFIDENCE values')
+parser.add_argument('--nms', default=None, type=float, nargs='+', help='TEST.DET_NMS_THRESHOLD values')
+parser.add_argument('--max_inst', default=None, type=int, nargs='+', help='TEST.DET_MAX_INSTANCES values')
+parser.add_argument('--rois', default=None, type=int, nargs='+', help='RPN.POST_NMS_ROIS_INFERENCE values')
+parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+args = parse_tool_args(parser, 'inference', 'sweep_detection')
+
+
+if __name__ == '__main__':
+    config = tool_config(args)
+    config.MISC.LOG_FILE = os.path.join(os.path.dirname(args.cache), 'sweep_detection_log.txt')
+    _, val_data, val_api = get_data(config)
+
+    cache = torch.load(args.cache)
+    coco_image_ids = [entry['coco_id'] for entry in cache['images']]
+    print_log('\n[sweep] {:d} cached images, {:d} rois, top-{:d} classes per roi'.format(
+        len(coco_image_ids), cache['post_nms_rois'], cache['topk']), config.MISC.LOG_FILE)
+
+    # unset lists keep the config value; rois default to the cached count
+    grid = list(itertools.product(args.min_conf or [config.TEST.DET_MIN_CONFIDENCE],
+                                  args.nms or [config.TEST.DET_NMS_THRESHOLD],
+                                  args.max_inst or [config.TEST.DET_MAX_INSTANCES],
+                                  args.rois or [cache['post_nms_rois']]))
+    for _, _, _, rois in grid:
+        if rois > cache['post_nms_rois']:
+            raise Exception('--rois {:d} > the cached {:d}; re-run inference with a larger '
+                            'RPN.POST_NMS_ROIS_INFERENCE'.format(rois, cache['post_nms_rois']))
+
+    table = []
+    for min_conf, nms_thres, max_inst, rois in grid:
+        config.TEST.DET_MIN_CONFIDENCE = min_conf
+        config.TEST.DET_NMS_THRESHOLD = nms_thres
+        config.TEST.DET_MAX_INSTANCES = max_inst
+        config.RPN.POST_NMS_ROIS_INFERENCE = rois
+        t = time.time()
+        results = replay_detections(config, cache, val_data.dataset)
+        mAP = evaluate_coco(val_api, results, coco_image_ids)
+        table.append((min_conf, nms_thres, max_inst, rois, mAP, time.time() - t))
+        print_log('[sweep] min_conf {:.3f} nms {:.2f} max_inst {:d} rois {:d}: mAP {:.4f} ({:.1f}s)'.format(
+            *table[-1]), config.MISC.LOG_FILE)
+
+    print_log('\n{:>9s} {:>6s} {:>9s} {:>6s} {:>8s}'.format('min_conf', 'nms', 'max_inst', 'rois', 'mAP'),
+              config.MISC.LOG_FILE)
+    for min_conf, nms_thres, max_inst, rois, mAP, _ in sorted(table, key=lambda x: -x[4]):
+        print_log('{:9.3f} {:6.2f} {:9d} {:6d} {:8.4f}'.format(min_conf, nms_thres, max_inst, rois, mAP),
+                  config.MISC.LOG_FILE)
+
+    csv_file = os.path.splitext(args.cache)[0] + '_sweep.csv'
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['det_min_confidence', 'det_nms_threshold', 'det_max_instances', 'post_nms_rois', 'mAP',
+                         'seconds'])
+        writer.writerows(table)
+    print_log('[sweep] saved to {:s}'.format(csv_file), config.MISC.LOG_FILE)
@@ -3,8 +3,17 @@ from torch.autograd import Variable
 import torch.optim as optim
 from torch.nn.parameter import Parameter
 import torch.nn as nn
+import torch.distributed as dist
 import datetime
 import time
+import functools
+import contextlib
+import threading
+import atexit
+import queue
+import json
+import re
+import random
 
 import os
 import math
@@ -15,6 +24,12 @@ from past.builtins import basestring
 import numpy as np
 from ast import literal_eval
 import matplotlib.artist as artist
+try:
+    # pytorch >= 1.6; needed only if TRAIN.AMP or TEST.AMP
+    from torch.cuda.amp import autocast, GradScaler
+    HAS_AMP = True
+except ImportError:
+    HAS_AMP = False
 
 
 def cus_set_alpha(e, alpha):
@@ -41,12 +56,49 @@ def unique1d(variable):
     return variable[unique_bool]
 
 
+def to_device(x, cuda):
+    """x.cuda() if cuda: MISC.GPU_COUNT >= 1 in the layers that take the config, else whether their
+    inputs are on the gpu; without the nms/roi_align extensions the cpu path runs on torchvision"""
+    return x.cuda() if cuda else x
+
+
 def intersect1d(variable1, variable2):
     aux = torch.cat((variable1, variable2), dim=0)
     aux = aux.squeeze().sort()[0]
     return aux[:-1][(aux[1:] == aux[:-1])]
 
 
+def amp_autocast(enabled):
+    """torch.cuda.amp.autocast() if enabled (TRAIN.AMP/TEST.AMP); otherwise a no-op context"""
+    if not enabled:
+        return contextlib.nullcontext()
+    if not HAS_AMP:
+        raise Exception('AMP requires pytorch >= 1.6 (torch.cuda.amp)')
+    return autocast()
+
+
+def to_float(x):
+    """cast a (list of) half tensor(s) back to fp32; others are returned as they are"""
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_float(_x) for _x in x)
+    if torch.is_tensor(x) and x.is_floating_point():
+        return x.float()
+    return x
+
+
+def fp32_op(func):
+    """Decorator: run func in fp32 under autocast (half tensor args are cast to float).
+    For numerically sensitive ops: exp of box deltas, log2 level assignment, IoU, sinkhorn."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not HAS_AMP or not torch.is_autocast_enabled():
+            return func(*args, **kwargs)
+        with autocast(enabled=False):
+            return func(*to_float(args), **{k: to_float(v) for k, v in kwargs.items()})
+    return wrapper
+
+
+@fp32_op
 def log2(x):
     """Implementation of Log2. Pytorch doesn't have a native implementation."""
     ln2 = Variable(torch.log(torch.FloatTensor([2.0])), requires_grad=False)
@@ -77,6 +129,9 @@ def remove(file_name):
 
 def print_log(msg, file=None, init=False, additional_file=None, quiet_termi=False):
 
+    if not is_main_process():
+        # distributed: only rank 0 logs
+        return
     if not quiet_termi:
         print(msg)
     if file is None:
@@ -246,6 +301,27 @@ def _check_and_coerce_cfg_value_type(value_a, value_b, key, full_key):
     return value_a
 
 
+def parse_tool_args(parser, phase, config_name=None):
+    """command line of a tools/ script; sets what CocoConfig(args) expects besides --config_file,
+    --device_id and opts (main.py takes phase, config_name and debug from the command line).
+    config_name None: the parser has a --config_name option"""
+    args = parser.parse_args()
+    args.phase = phase
+    if config_name is not None:
+        args.config_name = config_name
+    args.debug = 0
+    return args
+
+
+def tool_config(args):
+    """CocoConfig of a tools/ script (see parse_tool_args); no visdom"""
+    # lib.config imports this module
+    from lib.config import CocoConfig
+    config = CocoConfig(args)
+    config.MISC.USE_VISDOM = False
+    return config
+
+
 # =========== MODEL UTILITIES ===========
 def _find_last(config):
 
@@ -331,7 +407,7 @@ def update_config_and_load_model(config, model, train_generator=None):
         model.start_epoch = checkpoints['epoch']
         model.start_iter = checkpoints['iter']
         num_train_im = train_generator.dataset.dataset.num_images
-        iter_per_epoch = math.floor(num_train_im/config.TRAIN.BATCH_SIZE)
+        iter_per_epoch = math.floor(num_train_im/(config.TRAIN.BATCH_SIZE*config.TRAIN.ACCUM_STEPS))
         if model.start_iter % iter_per_epoch == 0:
             model.start_iter = 1
             model.start_epoch += 1
@@ -347,6 +423,10 @@ def update_config_and_load_model(config, model, train_generator=None):
     model.iter = model.start_iter
 
     if phase == 'train':
+        # 3.0 optimizer, scaler, rng and sampler state; restored in train_model (resume_train_state)
+        if isinstance(checkpoints, dict) and 'epoch' in checkpoints:
+            model.start_train_state = {k: checkpoints[k] for k in ['optimizer', 'scaler', 'rng_state', 'sampler']
+                                       if k in checkpoints}
         # 3.1 load previous loss data in Visdom (for train only)
         try:
             loss_data = checkpoints['loss_data']  # could be empty list [] or dict()
@@ -374,8 +454,8 @@ def update_config_and_load_model(config, model, train_generator=None):
         if config.DEV.SWITCH and not config.DEV.BASELINE:
             try:
                 # indicate this is a resumed model
-                model.buffer = torch.from_numpy(checkpoints['buffer']).cuda()
-                model.buffer_cnt = torch.from_numpy(checkpoints['buffer_cnt']).cuda()
+                model.buffer = to_device(torch.from_numpy(checkpoints['buffer']), config.MISC.GPU_COUNT >= 1)
+                model.buffer_cnt = to_device(torch.from_numpy(checkpoints['buffer_cnt']), config.MISC.GPU_COUNT >= 1)
                 buffer_size = model.buffer.size(0)
                 if buffer_size != config.DEV.BUFFER_SIZE:
                     print_log('[WARNING] loaded buffer size: {}, config size: {}\n'
@@ -469,6 +549,10 @@ def _load_state_dict_anyway(model, state_dict, map_list, log_file=None):
                                'whose dimensions in the model are {} and '
                                'whose dimensions in the checkpoint are {}.'
                                .format(pretrain_name, own_state[target_name].size(), pretrain_param.size()))
+    # copied in place: FrozenBatchNorm2d (lib/sub_module.py) refreshes its scale/shift buffers
+    for m in model.modules():
+        if hasattr(m, 'update_scale_shift'):
+            m.update_scale_shift()
 
 
 def set_optimizer(net, opt):
@@ -522,13 +606,77 @@ def adjust_lr(optimizer, curr_ep, curr_iter, config):
     return lr
 
 
-def show_loss_terminal(config, **args):
+def metric_names(config):
+    """training scalars, in the order of MISC.VIS.LOSS_LEGEND"""
+    names = ['total_loss', 'rpn_cls', 'rpn_bbox', 'mrcnn_cls', 'mrcnn_bbox', 'mrcnn_mask_loss']
+    if config.DEV.SWITCH and not config.DEV.BASELINE:
+        names.append('meta_loss')
+    if config.DEV.SWITCH and config.DEV.BIG_SUPERVISE:
+        names.append('big_loss')
+    if config.TRAIN.FPN_OT_LOSS:
+        names.append('fpn_ot_loss')
+    return names
+
+
+class MetricsAccumulator(object):
+    """Sums the training scalars on the device, without host syncs:
+        add(values)     once per step; values are tensors (any shape, flattened) or numbers,
+                        concatenated in the order of names
+        flush(info)     stacks the means since the last flush into one tensor and starts a
+                        non-blocking copy to pinned host memory
+        collect()       waits for that copy, (info, {name: mean}); call it once the next step
+                        is queued so that the gpu is not drained. None if nothing is pending.
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        self.sum, self.count = None, 0
+        self.pending = None
+
+    def add(self, values):
+        device_ref = next(v for v in values if torch.is_tensor(v) or isinstance(v, Variable))
+        device_ref = device_ref.data if isinstance(device_ref, Variable) else device_ref
+        vec = []
+        for v in values:
+            if isinstance(v, Variable):
+                v = v.data
+            if not torch.is_tensor(v):
+                v = device_ref.new([float(v)])
+            vec.append(v.float().view(-1))
+        vec = torch.cat(vec)
+        assert vec.numel() == len(self.names)
+        self.sum = vec.clone() if self.sum is None else self.sum + vec
+        self.count += 1
+
+    def flush(self, info):
+        if self.sum is None:
+            return
+        mean = self.sum / self.count
+        if mean.is_cuda:
+            host = torch.empty(mean.size(), pin_memory=True)
+            host.copy_(mean, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host, event = mean, None
+        self.pending = (host, event, info)
+        self.sum, self.count = None, 0
+
+    def collect(self):
+        if self.pending is None:
+            return None
+        host, event, info = self.pending
+        self.pending = None
+        if event is not None:
+            event.synchronize()
+        return info, dict(zip(self.names, host.tolist()))
 
+
+def show_loss_terminal(config, **args):
+    """args['metrics']: {name: value} of metric_names(config), e.g. from MetricsAccumulator"""
     curr_iter_time_start = args['curr_iter_time_start']
     curr_ep, iter_ind, total_iter = args['curr_ep'], args['iter_ind'], args['total_iter']
-    loss = args['loss']
+    metrics = args['metrics']
     lr = args['lr']
-    detailed_loss = args['detailed_loss']
     stage_name, epoch_str = args['stage_name'], args['epoch_str']
 
     iter_time = time.time() - curr_iter_time_start
@@ -536,15 +684,12 @@ def show_loss_terminal(config, **args):
         iter_time, curr_ep, sum(config.TRAIN.SCHEDULE), iter_ind, total_iter)
 
     # additional loss fill up here
-    meta_loss = args['meta_loss']
-    big_loss = args['big_loss']
-    fpn_ot_loss = args['fpn_ot_loss']
     suffix = ' - meta_loss: {:.3f}' if config.DEV.SWITCH and not config.DEV.BASELINE else '{:s}'
     suffix += ' - big_loss: {:.3f}' if config.DEV.SWITCH and config.DEV.BIG_SUPERVISE else '{:s}'
     suffix += ' - fpn_ot: {:.3f}' if config.TRAIN.FPN_OT_LOSS else '{:s}'
-    last_out_1 = meta_loss.data.cpu()[0] if config.DEV.SWITCH and not config.DEV.BASELINE else ''
-    last_out_2 = big_loss.data.cpu()[0] if config.DEV.SWITCH and config.DEV.BIG_SUPERVISE else ''
-    last_out_3 = fpn_ot_loss.data.cpu()[0] if config.TRAIN.FPN_OT_LOSS else ''
+    last_out_1 = metrics['meta_loss'] if config.DEV.SWITCH and not config.DEV.BASELINE else ''
+    last_out_2 = metrics['big_loss'] if config.DEV.SWITCH and config.DEV.BIG_SUPERVISE else ''
+    last_out_3 = metrics['fpn_ot_loss'] if config.TRAIN.FPN_OT_LOSS else ''
 
     progress_str = '[{:s}][{:s}]{:s} {:06d}/{} [est. left: {:d} days, {:.2f} hrs] (iter_t: {:.2f})' \
                    '\tlr: {:.6f} | loss: {:.3f} - rpn_cls: {:.3f} - rpn_bbox: {:.3f} ' \
@@ -556,99 +701,424 @@ def show_loss_terminal(config, **args):
     print_log(progress_str.format(
         config_name_str, stage_name, epoch_str, iter_ind, total_iter,
         days, hrs, iter_time, lr,
-        loss.data.cpu()[0],
-        detailed_loss[0].data.cpu()[0], detailed_loss[1].data.cpu()[0],
-        detailed_loss[2].data.cpu()[0], detailed_loss[3].data.cpu()[0],
-        detailed_loss[4].data.cpu()[0],
+        metrics['total_loss'],
+        metrics['rpn_cls'], metrics['rpn_bbox'],
+        metrics['mrcnn_cls'], metrics['mrcnn_bbox'],
+        metrics['mrcnn_mask_loss'],
         last_out_1, last_out_2, last_out_3),
         config.MISC.LOG_FILE)
 
 
+def checkpoint_file(config, curr_ep, iter_ind):
+    return os.path.join(
+        config.MISC.RESULT_FOLDER, 'mask_rcnn_ep_{:04d}_iter_{:06d}.pth'.format(curr_ep, iter_ind))
+
+
+def _cpu_snapshot(obj):
+    """copy all tensors in (nested dicts/lists of) obj to cpu memory"""
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        # .cpu() of a cpu tensor is not a copy
+        return obj.cpu() if obj.is_cuda else obj.clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, _cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints in a background thread: torch.save to a hidden tmp file in the
+    same folder, then os.replace (atomic), then prunes old checkpoints. Retention:
+    the last TRAIN.CKPT_KEEP_LAST files, the last file of every TRAIN.CKPT_KEEP_EVERY_EPOCH-th
+    epoch, the best-mAP one (see update_best) and the pinned ones (waiting for their validation
+    result, see pin); CKPT_KEEP_LAST <= 0 keeps everything.
+    Only files written by this writer are pruned; those of earlier runs in the folder are kept.
+    One write is queued at most; save() blocks if the previous one is still pending."""
+    PATTERN = re.compile(r'^mask_rcnn_ep_(\d{4})_iter_(\d{6})\.pth$')
+    BEST_FILE = 'checkpoint_best.json'
+
+    def __init__(self, config):
+        self.folder = config.MISC.RESULT_FOLDER
+        self.log_file = config.MISC.LOG_FILE
+        self.keep_last = config.TRAIN.CKPT_KEEP_LAST
+        self.keep_every_epoch = config.TRAIN.CKPT_KEEP_EVERY_EPOCH
+        self.async_save = config.TRAIN.ASYNC_SAVE
+        self.best = self._load_best()
+        # (epoch, iter, name) of the checkpoints written by this writer
+        self.saved = []
+        # names of the checkpoints under (async) validation; shared with the writer thread
+        self.pinned = set()
+        self.lock = threading.Lock()
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        if self.async_save:
+            # daemon: the atexit flush waits for the pending write, not the idle thread
+            self.thread = threading.Thread(target=self._run, name='checkpoint_writer', daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def save(self, snapshot, model_file):
+        """snapshot: dict already in cpu memory (see _cpu_snapshot)"""
+        self._check_error()
+        if self.async_save:
+            self.queue.put((snapshot, model_file))
+        else:
+            self._write(snapshot, model_file)
+
+    def flush(self):
+        """block until the pending checkpoint is on disk"""
+        if self.async_save:
+            self.queue.join()
+        self._check_error()
+
+    def pin(self, model_file):
+        """keep model_file from being pruned until update_best() or unpin() is called for it"""
+        with self.lock:
+            self.pinned.add(os.path.basename(model_file))
+
+    def unpin(self, model_file):
+        with self.lock:
+            self.pinned.discard(os.path.basename(model_file))
+
+    def update_best(self, model_file, mAP):
+        """called after validation; model_file must have been passed to save() before. Unpins it."""
+        self.unpin(model_file)
+        if mAP is None or (self.best is not None and mAP <= self.best['mAP']):
+            return
+        self.flush()
+        if not os.path.exists(model_file):
+            print_log('[WARNING] {:s} (mAP {:.4f}) no longer exists; not recorded as the best checkpoint'.format(
+                model_file, mAP), self.log_file)
+            return
+        self.best = {'file': os.path.basename(model_file), 'mAP': float(mAP)}
+        with open(os.path.join(self.folder, self.BEST_FILE), 'w') as f:
+            json.dump(self.best, f)
+        print_log('best mAP so far: {:.4f} ({:s})'.format(mAP, self.best['file']), self.log_file)
+
+    def _load_best(self):
+        try:
+            with open(os.path.join(self.folder, self.BEST_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing checkpoint failed: {}'.format(error))
+
+    def _run(self):
+        while True:
+            snapshot, model_file = self.queue.get()
+            try:
+                self._write(snapshot, model_file)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, snapshot, model_file):
+        tmp_file = os.path.join(os.path.dirname(model_file), '.' + os.path.basename(model_file) + '.tmp')
+        torch.save(snapshot, tmp_file)
+        os.replace(tmp_file, model_file)
+        m = self.PATTERN.match(os.path.basename(model_file))
+        if m and os.path.dirname(os.path.abspath(model_file)) == os.path.abspath(self.folder):
+            self.saved.append((int(m.group(1)), int(m.group(2)), m.group(0)))
+        self._prune()
+
+    def _prune(self):
+        if self.keep_last <= 0:
+            return
+        ckpts = sorted(set(self.saved))
+        keep = set(name for _, _, name in ckpts[-self.keep_last:])
+        if self.keep_every_epoch > 0:
+            last_of_epoch = {}
+            for ep, _, name in ckpts:
+                last_of_epoch[ep] = name
+            keep.update(name for ep, name in last_of_epoch.items() if ep % self.keep_every_epoch == 0)
+        if self.best is not None:
+            keep.add(self.best['file'])
+        with self.lock:
+            keep.update(self.pinned)
+        for _, _, name in ckpts:
+            if name not in keep:
+                remove(os.path.join(self.folder, name))
+        self.saved = [ckpt for ckpt in ckpts if ckpt[2] in keep]
+
+
+_CKPT_WRITER = None
+
+
+def get_checkpoint_writer(config):
+    global _CKPT_WRITER
+    if _CKPT_WRITER is None or _CKPT_WRITER.folder != config.MISC.RESULT_FOLDER:
+        if _CKPT_WRITER is not None:
+            _CKPT_WRITER.flush()
+        _CKPT_WRITER = CheckpointWriter(config)
+    return _CKPT_WRITER
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy':  np.random.get_state(),
+        'torch':  torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def resume_train_state(model, optimizer, scaler, train_generator):
+    """Restore optimizer (momentum), loss scaler and rng state of the checkpoint loaded by
+    update_config_and_load_model() (model.start_train_state), and make the sampler skip the
+    batches already seen in the resumed epoch. Called once, at the first stage that trains."""
+    state = getattr(model, 'start_train_state', None)
+    if state is None:
+        return
+    model.start_train_state = None
+    config = model.config
+    if 'optimizer' in state:
+        optimizer.load_state_dict(state['optimizer'])
+    if scaler is not None and 'scaler' in state:
+        scaler.load_state_dict(state['scaler'])
+    if 'rng_state' in state:
+        set_rng_state(state['rng_state'])
+    sampler = state.get('sampler', None)
+    if model.iter > 1 and sampler is not None and hasattr(train_generator.batch_sampler, 'set_start'):
+        if sampler['epoch'] == model.epoch and sampler['batch_size'] == config.TRAIN.BATCH_SIZE:
+            # set_epoch() is called before the pass starts; the skip applies to that pass only
+            train_generator.batch_sampler.set_start(sampler['batches_done'])
+            print_log('resume: skip the first {:d} batches of epoch {:d}'.format(
+                sampler['batches_done'], model.epoch), config.MISC.LOG_FILE)
+        else:
+            print_log('[WARNING] resume: batch size or epoch changed; epoch {:d} restarts from its first '
+                      'batch'.format(model.epoch), config.MISC.LOG_FILE)
+
+
 def save_model(model, **args):
+    if not is_main_process():
+        # distributed: only rank 0 saves checkpoints
+        return
     config = model.config
     curr_ep, iter_ind = args['epoch'], args['iter']
     loss_data = args['loss_data']
 
-    model_file = os.path.join(
-        config.MISC.RESULT_FOLDER, 'mask_rcnn_ep_{:04d}_iter_{:06d}.pth'.format(curr_ep, iter_ind))
+    model_file = checkpoint_file(config, curr_ep, iter_ind)
     print_log('saving model: {:s}\n'.format(model_file), config.MISC.LOG_FILE)
     if config.DEV.SWITCH and not config.DEV.BASELINE:  # has meta-loss
         buffer, buffer_cnt = model.buffer.cpu().numpy(), model.buffer_cnt.cpu().numpy()
     else:
         buffer, buffer_cnt = [], []
-    torch.save({
-        'state_dict':   model.state_dict(),
+    # snapshot to cpu here; serialization and disk i/o in the writer thread
+    snapshot = {
+        'state_dict':   _cpu_snapshot(model.state_dict()),
         'epoch':        curr_ep,        # or model.epoch
         'iter':         iter_ind,       # or model.iter
         'buffer':       buffer,
         'buffer_cnt':   buffer_cnt,
-        'loss_data':    loss_data
-    }, model_file)
+        'loss_data':    copy.deepcopy(loss_data),
+        # for mid-epoch resume, see resume_train_state()
+        'rng_state':    get_rng_state(),
+        'sampler':      {'epoch': curr_ep, 'batches_done': iter_ind * config.TRAIN.ACCUM_STEPS,
+                         'batch_size': config.TRAIN.BATCH_SIZE},
+    }
+    if args.get('optimizer') is not None:
+        snapshot['optimizer'] = _cpu_snapshot(args['optimizer'].state_dict())
+    if args.get('scaler') is not None:
+        snapshot['scaler'] = args['scaler'].state_dict()
+    get_checkpoint_writer(config).save(snapshot, model_file)
+    return model_file
+
+
+def _synthetic_batch(config, bs):
+    """Worst case for memory: the largest input (DATA.IMAGE_SHAPE) with DATA.MAX_GT_INSTANCES
+    small (32 x 32) objects on a grid, so that all rois are assigned to P2.
+    Same format as detection_collate()."""
+    from tools.image_utils import compose_image_meta
+    h, w = config.DATA.IMAGE_SHAPE[:2]
+    num_gt, num_cls = config.DATA.MAX_GT_INSTANCES, config.DATASET.NUM_CLASSES
+    grid = int(math.ceil(math.sqrt(num_gt)))
+    ys, xs = np.meshgrid(np.arange(grid) * (h // grid), np.arange(grid) * (w // grid), indexing='ij')
+    y1, x1 = ys.flatten()[:num_gt] + 4, xs.flatten()[:num_gt] + 4
+    boxes = np.stack([y1, x1, y1 + 32, x1 + 32], axis=1).astype(np.float32)
+
+    if config.MRCNN.USE_MINI_MASK:
+        masks = torch.ones(bs, num_gt, *config.MRCNN.MINI_MASK_SHAPE).byte()
+    else:
+        masks = torch.zeros(bs, num_gt, h, w).byte()
+        for i, (_y1, _x1, _y2, _x2) in enumerate(boxes.astype(np.int64)):
+            masks[:, i, _y1:_y2, _x1:_x2] = 1
+    if config.DATA.DEVICE_NORMALIZE:
+        images = torch.from_numpy(np.random.randint(0, 256, size=(bs, 3, h, w)).astype(np.uint8))
+    else:
+        images = torch.randn(bs, 3, h, w) * 50.
+    class_ids = torch.from_numpy(np.arange(num_gt) % (num_cls - 1) + 1).short().unsqueeze(0).repeat(bs, 1)
+    meta = compose_image_meta(0, [h, w, 3], [0, 0, h, w], np.ones(num_cls, dtype=np.int32), 0)
+    metas = torch.from_numpy(np.stack([meta] * bs))
+    return [images, class_ids, torch.from_numpy(boxes).unsqueeze(0).repeat(bs, 1, 1), masks,
+            torch.LongTensor([num_gt] * bs), metas]
+
+
+def find_max_batch_size(model, config):
+    """
+    Largest per-gpu train batch whose peak allocated memory (forward + backward on synthetic
+    worst-case inputs, plus the optimizer state) stays below (1 - TRAIN.AUTO_BATCH_MARGIN) of
+    the gpu memory. Binary search; no optimizer step is taken, so weights are untouched and
+    buffers (BN stats) are restored. Writes TRAIN.BATCH_SIZE (and TEST.BATCH_SIZE) in config.
+    Call before get_data(): the loaders use TRAIN.BATCH_SIZE.
+    """
+    model = model.cuda()
+    device = torch.cuda.current_device()
+    budget = (1. - config.TRAIN.AUTO_BATCH_MARGIN) * torch.cuda.get_device_properties(device).total_memory
+    # optimizer state is not allocated here: momentum (sgd) or two moments (adam) per trainable param
+    num_state = 2 if config.TRAIN.OPTIM_METHOD == 'adam' else int(config.TRAIN.MOMENTUM > 0)
+    optim_bytes = num_state * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+    saved_buffers = {name: b.clone() for name, b in model.named_buffers()}
+    has_meta = config.DEV.SWITCH and not config.DEV.BASELINE
+    saved_meta = (getattr(model, 'buffer', None), getattr(model, 'buffer_cnt', None))
+
+    def _peak_mem(bs):
+        torch.cuda.empty_cache()
+        torch.cuda.reset_max_memory_allocated(device)
+        try:
+            inputs = _synthetic_batch(config, bs)
+            images = Variable(inputs[0].cuda())
+            image_metas = Variable(inputs[-1].cuda())
+            gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(*inputs[1:5])
+            outputs = model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')
+            loss = torch.sum(torch.mean(outputs[0], dim=0))
+            if has_meta:
+                model.buffer = torch.zeros(config.DEV.BUFFER_SIZE, 1024, config.DATASET.NUM_CLASSES).cuda()
+                model.buffer_cnt = torch.zeros(config.DEV.BUFFER_SIZE, 1, config.DATASET.NUM_CLASSES).cuda()
+                loss = loss + model.meta_loss(list(outputs[1:5]) + list(outputs[6:8]))
+            loss.backward()
+            peak = torch.cuda.max_memory_allocated(device) + optim_bytes
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            peak = float('inf')
+        inputs = images = image_metas = gt_class_ids = gt_boxes = gt_masks = outputs = loss = None
+        for p in model.parameters():
+            p.grad = None
+        torch.cuda.empty_cache()
+        print_log('\tbatch size per gpu {:d}: peak mem {:.2f} GB (budget {:.2f} GB)'.format(
+            bs, peak / 1024.**3, budget / 1024.**3), config.MISC.LOG_FILE)
+        return peak
+
+    print_log('\nsearching for the max batch size per gpu (synthetic inputs) ...', config.MISC.LOG_FILE)
+    # doubling, then binary search in (fit, not_fit)
+    fit, not_fit = 0, None
+    bs = 1
+    while bs <= config.TRAIN.AUTO_BATCH_MAX:
+        if _peak_mem(bs) > budget:
+            not_fit = bs
+            break
+        fit, bs = bs, 2 * bs
+    if not_fit is None:
+        not_fit = config.TRAIN.AUTO_BATCH_MAX + 1
+    while not_fit - fit > 1:
+        bs = (fit + not_fit) // 2
+        if _peak_mem(bs) > budget:
+            not_fit = bs
+        else:
+            fit = bs
+
+    # restore
+    for name, b in model.named_buffers():
+        b.copy_(saved_buffers[name])
+    if has_meta:
+        model.buffer, model.buffer_cnt = saved_meta
+    if fit == 0:
+        raise Exception('batch size 1 does not fit in gpu memory (margin {})'.format(config.TRAIN.AUTO_BATCH_MARGIN))
+
+    num_gpu = config.MISC.WORLD_SIZE if config.MISC.DISTRIBUTED else max(config.MISC.GPU_COUNT, 1)
+    config.TRAIN.BATCH_SIZE = fit * num_gpu
+    # as in Config._set_value() and init_distributed()
+    config.TEST.BATCH_SIZE = 2 * fit if config.MISC.DISTRIBUTED else 2 * config.TRAIN.BATCH_SIZE
+    print_log('max batch size per gpu: {:d}; set TRAIN.BATCH_SIZE = {:d}\n'.format(
+        fit, config.TRAIN.BATCH_SIZE), config.MISC.LOG_FILE)
+    return config
+
+
+def set_model(gpu_cnt, model, distributed=False):
+    if distributed:
+        # one gpu per process (init_distributed() has set the device); cpu if gpu_cnt < 1 (gloo).
+        # some parameters are unused in a given iter (frozen stages, no positive rois, etc.)
+        print('distributed mode (rank {:d}/{:d}) ...'.format(get_rank(), get_world_size()))
+        if gpu_cnt < 1:
+            model = nn.parallel.DistributedDataParallel(model, device_ids=None, find_unused_parameters=True)
+        else:
+            model = nn.parallel.DistributedDataParallel(
+                model.cuda(), device_ids=[torch.cuda.current_device()],
+                output_device=torch.cuda.current_device(), find_unused_parameters=True)
+    elif gpu_cnt < 1:
+        print('cpu mode ...')
+    elif gpu_cnt == 1:
+        print('single gpu mode ...')
+        model = model.cuda()
+    else:
+        print('multi-gpu mode ...')
+        # only the first gpu_cnt visible gpus (others may be left for TRAIN.ASYNC_VALIDATION)
+        model = nn.DataParallel(model, device_ids=list(range(gpu_cnt))).cuda()
+    return model
 
 
-def check_max_mem(input_model, data_loader, MaskRCNN):
+def init_distributed(config):
+    """called before building the model; MISC.DISTRIBUTED=True only"""
+    if config.DEV.SWITCH and not config.DEV.BASELINE and config.DEV.LOSS_CHOICE == 'ot':
+        # the ot meta-loss has parameters outside forward(), which DDP cannot reduce
+        raise Exception('DEV.LOSS_CHOICE=ot is not supported with MISC.DISTRIBUTED')
+    if config.MISC.GPU_COUNT >= 1:
+        # any backend: the model, the layers and .cuda() calls use the current device
+        torch.cuda.set_device(config.MISC.LOCAL_RANK)
+    dist.init_process_group(backend=config.MISC.DIST_BACKEND, init_method=config.MISC.DIST_URL)
 
-    config = input_model.config
-    input_model = set_model(config.MISC.GPU_COUNT, input_model)
+    config.MISC.RANK = get_rank()
+    config.MISC.WORLD_SIZE = get_world_size()
+    if config.TRAIN.BATCH_SIZE % config.MISC.WORLD_SIZE != 0:
+        raise Exception('TRAIN.BATCH_SIZE ({:d}) must be divisible by the number of processes ({:d})'.format(
+            config.TRAIN.BATCH_SIZE, config.MISC.WORLD_SIZE))
+    # validation during train runs on rank 0 alone
+    config.TEST.BATCH_SIZE = 2 * config.TRAIN.BATCH_SIZE // config.MISC.WORLD_SIZE
+    if config.MISC.RANK != 0:
+        config.MISC.USE_VISDOM = False
+    return config
 
-    if isinstance(input_model, nn.DataParallel):
-        model = input_model.module
-    else:
-        # single-gpu
-        model = input_model
-
-    print_log('\nchecking possibly MAX mem cost ...', config.MISC.LOG_FILE)
-    # set optimizer
-    optimizer = set_optimizer(model, config.TRAIN)
-    model.buffer = torch.zeros(model.config.DEV.BUFFER_SIZE, 1024, config.DATASET.NUM_CLASSES).cuda()
-    model.buffer_cnt = torch.zeros(config.DEV.BUFFER_SIZE, 1, config.DATASET.NUM_CLASSES).cuda()
-
-    for iter_ind, inputs in zip(range(1, 11), data_loader):
-        images = Variable(inputs[0].cuda())
-        image_metas = Variable(inputs[-1].cuda())
-        gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(inputs[1], inputs[2], inputs[3])
-        merged_loss, big_feat, big_cnt, small_feat, small_cnt, big_loss = \
-            input_model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')
-        detailed_loss = torch.mean(merged_loss, dim=0)
 
-        if config.DEV.SWITCH and not config.DEV.BASELINE:
-            # big_feat: gpu_num x scale_num x 1024 x 81; also update the buffer
-            meta_loss = model.meta_loss([big_feat, big_cnt, small_feat, small_cnt])
-            meta_loss *= config.DEV.LOSS_FAC
-        else:
-            meta_loss = 0
+def get_rank():
+    if not dist.is_available() or not dist.is_initialized():
+        return 0
+    return dist.get_rank()
 
-        # big-loss
-        if config.DEV.SWITCH and config.DEV.BIG_SUPERVISE:
-            # big loss: gpu_num x scale_num x 1
-            big_loss = torch.mean(big_loss)
-            big_loss *= config.DEV.BIG_LOSS_FAC
-        else:
-            big_loss = 0
 
-        loss = torch.sum(detailed_loss) + meta_loss + big_loss
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+def get_world_size():
+    if not dist.is_available() or not dist.is_initialized():
+        return 1
+    return dist.get_world_size()
 
-    print_log('passed maximum GPU mem test!', config.MISC.LOG_FILE)
-    del optimizer, model
 
-    # set optimizer
-    model = MaskRCNN(config)
-    optimizer = set_optimizer(model, config.TRAIN)
-    print_log('set back to original model weights ...\n', config.MISC.LOG_FILE)
+def is_main_process():
+    return get_rank() == 0
 
-    return optimizer, model
 
+def synchronize():
+    """barrier; no-op if not distributed"""
+    if get_world_size() > 1:
+        dist.barrier()
 
-def set_model(gpu_cnt, model):
-    if gpu_cnt < 1:
-        print('cpu mode ...')
-    elif gpu_cnt == 1:
-        print('single gpu mode ...')
-        model = model.cuda()
-    else:
-        print('multi-gpu mode ...')
-        model = nn.DataParallel(model).cuda()
-    return model
\ No newline at end of file
+
+def all_reduce_sum(tensor):
+    """in-place sum over all processes; no-op if not distributed"""
+    if get_world_size() > 1:
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
\ No newline at end of file
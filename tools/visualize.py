@@ -455,18 +455,9 @@ class Visualizer(object):
         curr_ep, iter_ind, total_iter = args['curr_ep'], args['iter_ind'], args['total_iter']
         y_num = len(self.loss_data['legend'])
 
-        loss = torch.cat((args['loss'], args['detailed_loss']))   # total loss plus other losses in Mask-RCNN
-        if self.opt.DEV.SWITCH and not self.opt.DEV.BASELINE:
-            # indicates there is meta_loss
-            loss = torch.cat((loss, args['meta_loss']))
-        if self.opt.DEV.SWITCH and self.opt.DEV.BIG_SUPERVISE:
-            loss = torch.cat((loss, args['big_loss']))
-        if self.opt.TRAIN.FPN_OT_LOSS:
-            loss = torch.cat((loss, args['fpn_ot_loss']))
-        assert loss.size(0) == y_num
-
+        # args['metrics']: {name: value}, names as in MISC.VIS.LOSS_LEGEND (see utils.metric_names)
         x_progress = [curr_ep - 1 + float(iter_ind/total_iter) for _ in range(y_num)]
-        loss_list = [loss[i].data.cpu()[0] for i in range(y_num)]
+        loss_list = [args['metrics'][name] for name in self.loss_data['legend']]
         self.loss_data['X'].append(x_progress)
         self.loss_data['Y'].append(loss_list)
         self.vis.line(